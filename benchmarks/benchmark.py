@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# End-to-end benchmarks for PyLibby against the mock OverDrive server.
+# Runs list, search, borrow, download-all and tagging on synthetic accounts of different sizes
+# and reports latency and throughput for each operation.
+#
+#   python benchmarks/benchmark.py --sizes 5,25,100 --latency 0.02
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pylibby  # noqa: E402
+from tabulate import tabulate  # noqa: E402
+from mock_overdrive import MockOverDriveServer  # noqa: E402
+
+
+class Result:
+    def __init__(self, size: int, operation: str):
+        self.size = size
+        self.operation = operation
+        self.latencies = []
+        self.bytes = 0
+        self.items = 0
+        self.total = 0.0
+
+    def row(self) -> dict:
+        latencies = sorted(self.latencies) or [0.0]
+        return {
+            "Loans": self.size,
+            "Operation": self.operation,
+            "Count": len(self.latencies),
+            "Total (s)": round(self.total, 3),
+            "Mean (ms)": round(statistics.fmean(latencies) * 1000, 2),
+            "p95 (ms)": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2),
+            "Items/s": round(self.items / self.total, 2) if self.total else 0,
+            "MB/s": round(self.bytes / 1000 / 1000 / self.total, 2) if self.total else 0,
+        }
+
+
+@contextlib.contextmanager
+def measure(result: Result, items: int = 1):
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    result.latencies.append(elapsed)
+    result.total += elapsed
+    result.items += items
+
+
+def quiet():
+    # PyLibby prints progress for everything, keep it out of the report.
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def clear_caches(libby: pylibby.Libby):
+    # Otherwise every repeat after the first only measures the caches.
+    for cache in [pylibby.media_info_cache, pylibby.availability_cache, pylibby.cover_cache]:
+        cache.clear()
+    libby.sync_state = None
+
+
+def folder_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def run(size: int, args) -> list[Result]:
+    server = MockOverDriveServer(latency=args.latency, bandwidth=args.bandwidth, failure_rate=args.failure_rate,
+                                 loans=size, holds=max(1, size // 4), cards=args.cards, catalog=size * 2,
+                                 parts=args.parts, part_size=args.part_size)
+    results = []
+    with server, tempfile.TemporaryDirectory() as tmp:
+        for key, value in server.urls.items():
+            setattr(pylibby, key, value)
+
+        with quiet():
+            libby = pylibby.Libby(os.path.join(tmp, "id.json"), archive_path=os.path.join(tmp, "archive.json"),
+                                  code="12345678", timeout=args.timeout, max_retries=args.retry, part_delay=0)
+
+        # -ls: sync plus the media info of every loan, cold every time like a new run
+        result = Result(size, "list")
+        for _ in range(args.repeat):
+            clear_caches(libby)
+            with quiet(), measure(result, items=size):
+                loans = libby.get_sync_state().raw["loans"]
+                pylibby.get_media_infos([lo["id"] for lo in loans], timeout=args.timeout)
+        results.append(result)
+
+        result = Result(size, "search")
+        for i in range(args.repeat):
+            with quiet(), measure(result):
+                libby.search_for_book_in_logged_in_libraries(f"Title 10{i}")
+        results.append(result)
+
+        # Borrow titles from the catalog that are not on loan or on hold yet.
+        result = Result(size, "borrow")
+        sync = libby.get_sync()
+        taken = {lo["id"] for lo in sync["loans"]} | {h["id"] for h in sync["holds"]}
+        candidates = [t for t in server.account.media if t not in taken][:args.borrows]
+        for title_id in candidates:
+            with quiet(), measure(result):
+                libby.borrow_book_on_any_logged_in_library(title_id)
+        results.append(result)
+
+        output = os.path.join(tmp, "output")
+        os.makedirs(output)
+        # -dla: the whole path, with the bulk media info lookup, opening the next book ahead of time, duplicate
+        # and free space checks.
+        result = Result(size, "download-all")
+        loans = [lo for lo in libby.get_loans() if "audiobook-mp3" in pylibby.get_formats(lo)]
+        clear_caches(libby)
+        with quiet(), measure(result, items=len(loans) * args.parts):
+            libby.download_all_loans("audiobook-mp3", output, format_string="%o")
+        result.bytes = folder_size(output)
+        results.append(result)
+
+        result = Result(size, "tagging")
+        for loan in loans[:args.tag_books]:
+            with quiet():
+                audiobook_info = libby.open_audiobook(loan["cardId"], loan["id"])
+            toc = pylibby.get_toc_from_audiobook_info(audiobook_info)
+            book_path = os.path.join(output, loan["id"])
+            cover = next((os.path.join(book_path, f) for f in os.listdir(book_path) if f.endswith(".jpg")), "")
+            for filename in sorted(f for f in os.listdir(book_path) if f.endswith(".mp3")):
+                with measure(result):
+                    pylibby.embed_tag_data(os.path.join(book_path, filename), toc[filename], audiobook_info, cover)
+                result.bytes += os.path.getsize(os.path.join(book_path, filename))
+        results.append(result)
+
+        if args.verbose:
+            print(f"Requests served for {size} loans: {server.request_counts}", file=sys.stderr)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks for PyLibby against a mock OverDrive server.")
+    parser.add_argument("--sizes", default="5,25", help="Comma separated number of loans per synthetic account.")
+    parser.add_argument("--cards", type=int, default=3, help="Library cards per account.")
+    parser.add_argument("--parts", type=int, default=4, help="Mp3 parts per audiobook.")
+    parser.add_argument("--part-size", type=int, default=512 * 1024, help="Size of each part in bytes.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean latency added to each request (seconds).")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Per-connection bandwidth cap in bytes/s.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests failing with 503.")
+    parser.add_argument("--retry", type=int, default=0, help="Retries passed on to Libby.")
+    parser.add_argument("--timeout", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions of list and search.")
+    parser.add_argument("--borrows", type=int, default=5, help="Number of titles to borrow.")
+    parser.add_argument("--tag-books", type=int, default=3, help="Number of downloaded books to re-tag.")
+    parser.add_argument("-j", "--json", action="store_true", help="Output JSON instead of a table.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print request counts per service.")
+    args = parser.parse_args()
+
+    rows = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        rows.extend(r.row() for r in run(size, args))
+
+    if args.json:
+        print(json.dumps(rows, indent=4))
+    else:
+        print(tabulate(rows, headers="keys", tablefmt="grid"))
+
+
+if __name__ == "__main__":
+    main()
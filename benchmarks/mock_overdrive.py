@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# A stand-in for the OverDrive services PyLibby talks to, so it can be run and benchmarked without real loans.
+# Everything is served from one HTTP server, the services are told apart by path prefix:
+#   /sentry  -> sentry-read.svc.overdrive.com (chip, sync, open, fulfill, loans and holds)
+#   /thunder -> thunder.api.overdrive.com (media, bulk media, availability and search)
+#   /cdn     -> the audiobook CDN (cookie handshake, openbook.json, mp3 parts, covers and fulfilled files)
+#   /resize  -> ic.od-cdn.com/resize (cover resizer)
+# Point PyLibby at it with the SENTRY_URL, THUNDER_URL and COVER_RESIZE_URL environment variables.
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# MPEG-1 Layer III, 128 kbit/s, 44.1 kHz, joint stereo. 144 * 128000 / 44100 = 417 bytes per frame.
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x44"
+MP3_FRAME_SIZE = 417
+MP3_FRAME_DURATION = 1152 / 44100
+
+# Smallest thing that looks like a JPEG, good enough for APIC frames.
+JPEG_BYTES = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00" + b"\x00" * 512 + b"\xff\xd9"
+
+IDENTITY = "mock-identity"
+
+
+def make_mp3(size: int) -> bytes:
+    frame = MP3_FRAME_HEADER + b"\x00" * (MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    return frame * max(1, size // MP3_FRAME_SIZE)
+
+
+class MockAccount:
+    """
+    Synthetic Libby account with a catalog of titles spread over a number of library cards.
+    """
+
+    def __init__(self, base_url: str, loans: int = 10, holds: int = 5, cards: int = 2, catalog: int = 0,
+                 parts: int = 5, part_size: int = 256 * 1024, seed: int = 0):
+        self.base_url = base_url
+        self.parts = parts
+        self.part_size = part_size
+        self.lock = threading.Lock()
+        rand = random.Random(seed)
+
+        self.cards = [{
+            "cardId": str(10000000 + i),
+            "advantageKey": f"library{i}",
+            "cardName": f"Library {i}",
+            "counts": {"loan": 0, "hold": 0},
+            "limits": {"loan": 10000, "hold": 10000},
+        } for i in range(cards)]
+
+        self.media = {}
+        for i in range(max(catalog, loans + holds) or 1):
+            title_id = str(100000 + i)
+            is_audiobook = i % 5 != 4
+            self.media[title_id] = self.create_media_info(title_id, is_audiobook, rand)
+
+        self.loans = []
+        self.holds = []
+        title_ids = list(self.media.keys())
+        for i, title_id in enumerate(title_ids[:loans]):
+            self.loans.append(self.create_entry(title_id, self.cards[i % cards]))
+        for i, title_id in enumerate(title_ids[loans:loans + holds]):
+            hold = self.create_entry(title_id, self.cards[i % cards])
+            hold["estimatedWaitDays"] = rand.randint(1, 60)
+            hold["holdListPosition"] = rand.randint(1, 20)
+            self.holds.append(hold)
+        self.update_counts()
+
+    def create_media_info(self, title_id: str, is_audiobook: bool, rand: random.Random) -> dict:
+        formats = ["audiobook-mp3", "audiobook-overdrive"] if is_audiobook else ["ebook-epub-adobe", "ebook-overdrive"]
+        media_info = {
+            "id": title_id,
+            "title": f"Title {title_id}",
+            "sortTitle": f"Title {title_id}",
+            "type": {"id": "audiobook" if is_audiobook else "ebook", "name": "Audiobook" if is_audiobook else "eBook"},
+            "creators": [{"name": f"Author {int(title_id) % 97}", "role": "Author"},
+                         {"name": f"Narrator {int(title_id) % 31}", "role": "Narrator"}],
+            "publisher": {"id": "1", "name": "Mock Publishing"},
+            "publishDate": f"{2000 + int(title_id) % 23}-01-01T00:00:00Z",
+            "description": f"<p>Synthetic title {title_id}.</p>",
+            "subjects": [{"id": "1", "name": "Fiction"}],
+            "keywords": ["mock"],
+            "languages": [{"id": "en", "name": "English"}],
+            "formats": [{"id": f, "identifiers": [{"type": "ISBN", "value": f"978{int(title_id):010d}"}]}
+                        for f in formats],
+            "covers": {"cover510Wide": {"href": f"{self.base_url}/cdn/covers/{title_id}.jpg", "width": 510}},
+            "siteAvailabilities": {},
+        }
+        if int(title_id) % 3 == 0:
+            media_info["detailedSeries"] = {"seriesName": f"Series {int(title_id) % 7}", "readingOrder": "1"}
+        media_info["availability"] = {card["advantageKey"]: rand.random() < 0.5 for card in self.cards}
+        media_info["siteAvailabilities"] = {lib: {"isAvailable": available}
+                                            for lib, available in media_info["availability"].items()}
+        return media_info
+
+    def create_entry(self, title_id: str, card: dict) -> dict:
+        media_info = self.media[title_id]
+        return {
+            "id": title_id,
+            "title": media_info["title"],
+            "type": media_info["type"],
+            "formats": [{"id": f["id"]} for f in media_info["formats"]],
+            "covers": media_info["covers"],
+            "firstCreatorName": media_info["creators"][0]["name"],
+            "cardId": card["cardId"],
+            "advantageKey": card["advantageKey"],
+            "expireDate": "2099-01-01T00:00:00Z",
+        }
+
+    def update_counts(self):
+        for card in self.cards:
+            card["counts"]["loan"] = sum(1 for loan in self.loans if loan["cardId"] == card["cardId"])
+            card["counts"]["hold"] = sum(1 for hold in self.holds if hold["cardId"] == card["cardId"])
+
+    def get_card(self, card_id: str) -> dict:
+        return next((c for c in self.cards if c["cardId"] == card_id), {})
+
+    def availability(self, library: str, title_id: str) -> dict:
+        media_info = self.media.get(title_id)
+        if not media_info:
+            return {"errorCode": "NotFound"}
+        available = media_info["availability"].get(library, False)
+        digest = int(hashlib.md5(f"{library}/{title_id}".encode()).hexdigest(), 16)
+        return {
+            "id": title_id,
+            "isAvailable": available,
+            "ownedCopies": 1 + digest % 5,
+            "availableCopies": 1 if available else 0,
+            "holdsCount": 0 if available else digest % 40,
+            "estimatedWaitDays": 0 if available else 1 + digest % 90,
+        }
+
+    def sync(self) -> dict:
+        with self.lock:
+            return {"result": "synchronized", "cards": self.cards, "loans": list(self.loans),
+                    "holds": list(self.holds)}
+
+    def borrow(self, card_id: str, title_id: str) -> dict:
+        with self.lock:
+            card = self.get_card(card_id)
+            if not card or title_id not in self.media:
+                return {}
+            loan = self.create_entry(title_id, card)
+            self.loans.append(loan)
+            self.update_counts()
+            return loan
+
+    def return_loan(self, card_id: str, title_id: str) -> bool:
+        with self.lock:
+            before = len(self.loans)
+            self.loans = [lo for lo in self.loans if not (lo["id"] == title_id and lo["cardId"] == card_id)]
+            self.update_counts()
+            return len(self.loans) != before
+
+    def hold(self, card_id: str, title_id: str) -> dict:
+        with self.lock:
+            card = self.get_card(card_id)
+            if not card or title_id not in self.media:
+                return {}
+            hold = self.create_entry(title_id, card)
+            hold["estimatedWaitDays"] = self.availability(card["advantageKey"], title_id)["estimatedWaitDays"]
+            hold["holdListPosition"] = 1
+            self.holds.append(hold)
+            self.update_counts()
+            return hold
+
+    def cancel_hold(self, card_id: str, title_id: str) -> bool:
+        with self.lock:
+            before = len(self.holds)
+            self.holds = [h for h in self.holds if not (h["id"] == title_id and h["cardId"] == card_id)]
+            self.update_counts()
+            return len(self.holds) != before
+
+    def spine_path(self, title_id: str, part: int) -> str:
+        return f"{{{title_id}}}Fmt425-Part{part:02}.mp3"
+
+    def openbook(self, title_id: str) -> dict:
+        frames = max(1, self.part_size // MP3_FRAME_SIZE)
+        spine = [{"path": self.spine_path(title_id, p), "media-type": "audio/mpeg",
+                  "audio-duration": frames * MP3_FRAME_DURATION, "-odread-file-bytes": frames * MP3_FRAME_SIZE}
+                 for p in range(1, self.parts + 1)]
+        toc = []
+        for p in range(1, self.parts + 1):
+            toc.append({"title": f"Chapter {p}", "path": self.spine_path(title_id, p)})
+            if p % 2 == 0:
+                middle = f"{self.spine_path(title_id, p)}#{frames * MP3_FRAME_DURATION / 2:.3f}"
+                toc.append({"title": f"Chapter {p} (00:00)", "path": middle})
+        return {"title": {"main": self.media[title_id]["title"]}, "spine": spine, "nav": {"toc": toc}}
+
+
+class MockOverDriveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "MockOverDriveServer"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, body: bytes, status: int = 200, content_type: str = "application/json",
+                  headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        # Throttle the transfer to the configured bytes/s for this connection.
+        chunk_size = 16 * 1024
+        start = time.monotonic()
+        for sent in range(0, len(body), chunk_size):
+            self.wfile.write(body[sent:sent + chunk_size])
+            ahead = (sent + chunk_size) / bandwidth - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def send_json(self, obj, status: int = 200, headers: dict = None):
+        self.send_body(json.dumps(obj).encode(), status=status, headers=headers)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def handle_request(self):
+        self.read_body()
+        parsed = urllib.parse.urlparse(self.path)
+        path = urllib.parse.unquote(parsed.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        service = path.split("/")[1] if path.count("/") else ""
+
+        self.server.count_request(service)
+        if self.server.latency:
+            time.sleep(self.server.latency * random.uniform(0.5, 1.5))
+        if self.server.failure_rate and service in self.server.failure_services and \
+                random.random() < self.server.failure_rate:
+            self.send_json({"errorCode": "InjectedFailure"}, status=503)
+            return
+
+        handler = getattr(self, f"handle_{service}", None)
+        if handler is None or not handler(path[len(service) + 1:], query):
+            self.send_json({"errorCode": "NotFound", "path": path}, status=404)
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_DELETE = handle_request
+    do_HEAD = handle_request
+
+    def is_authorized(self) -> bool:
+        return self.headers.get("Authorization") == f"Bearer {IDENTITY}"
+
+    def handle_sentry(self, path: str, query: dict) -> bool:
+        account = self.server.account
+        if path == "/chip" and self.command == "POST":
+            self.send_json({"identity": IDENTITY, "chip": "mock-chip", "syncable": False, "primary": True})
+        elif path == "/chip/clone/code" and self.command == "POST":
+            self.send_json({"result": "cloned"})
+        elif path == "/chip/sync":
+            self.send_json(account.sync() if self.is_authorized() else {"result": "missing_chip"})
+        elif not self.is_authorized():
+            self.send_json({"result": "missing_chip"}, status=401)
+        elif m := re.fullmatch(r"/open/(audiobook|book)/card/(\d+)/title/(\d+)", path):
+            title_id = m.group(3)
+            if not any(lo["id"] == title_id for lo in account.sync()["loans"]):
+                self.send_json({"errorCode": "NotCheckedOut"}, status=403)
+            else:
+                web = f"{self.server.base_url}/cdn/{title_id}/"
+                self.send_json({"message": f"m=mock-{title_id}",
+                                "urls": {"web": web, "openbook": f"{web}openbook.json"}})
+        elif m := re.fullmatch(r"/card/(\d+)/loan/(\d+)/fulfill/([\w-]+)", path):
+            extension = "odm" if m.group(3) == "audiobook-mp3" else "acsm"
+            self.send_json({"fulfill": {"href": f"{self.server.base_url}/cdn/fulfill/{m.group(2)}.{extension}"}})
+        elif m := re.fullmatch(r"/card/(\d+)/(loan|hold)/(\d+)", path):
+            card_id, kind, title_id = m.groups()
+            if self.command == "POST":
+                entry = account.borrow(card_id, title_id) if kind == "loan" else account.hold(card_id, title_id)
+                self.send_json(entry if entry else {"errorCode": "NotFound"}, status=200 if entry else 404)
+            elif self.command == "DELETE":
+                if kind == "loan":
+                    ok = account.return_loan(card_id, title_id)
+                else:
+                    ok = account.cancel_hold(card_id, title_id)
+                self.send_json({} if ok else {"errorCode": "NotFound"}, status=200 if ok else 404)
+            else:
+                return False
+        else:
+            return False
+        return True
+
+    def handle_thunder(self, path: str, query: dict) -> bool:
+        account = self.server.account
+        if path == "/v2/media/search":
+            libraries = set(query.get("libraryKey", []))
+            words = query.get("query", [""])[0].lower().split()
+            hits = [m for m in account.media.values()
+                    if all(w in (m["title"] + " " + m["creators"][0]["name"]).lower() for w in words)]
+            self.send_json([dict(m, siteAvailabilities={k: v for k, v in m["siteAvailabilities"].items()
+                                                        if k in libraries}) for m in hits])
+        elif path == "/v2/media/bulk":
+            title_ids = query.get("titleIds", [""])[0].split(",")
+            self.send_json([account.media[t] for t in title_ids if t in account.media])
+        elif m := re.fullmatch(r"/v2/media/(\d+)", path):
+            media_info = account.media.get(m.group(1))
+            self.send_json(media_info if media_info else {"errorCode": "NotFound"}, status=200 if media_info else 404)
+        elif m := re.fullmatch(r"/v2/libraries/([\w-]+)/media/(\d+)/availability", path):
+            self.send_json(account.availability(m.group(1), m.group(2)))
+        else:
+            return False
+        return True
+
+    def handle_cdn(self, path: str, query: dict) -> bool:
+        account = self.server.account
+        if m := re.fullmatch(r"/covers/(\d+)\.jpg", path):
+            self.send_body(JPEG_BYTES, content_type="image/jpeg")
+        elif m := re.fullmatch(r"/fulfill/(\d+)\.(odm|acsm)", path):
+            self.send_body(f"<{m.group(2)} id='{m.group(1)}'/>".encode(), content_type="application/xml")
+        elif m := re.fullmatch(r"/(\d+)/", path):
+            title_id = m.group(1)
+            self.send_body(b"<html></html>", content_type="text/html",
+                           headers={"Set-Cookie": f"_ODAUTH=mock-{title_id}; Path=/cdn/{title_id}/"})
+        elif m := re.fullmatch(r"/(\d+)/(.*)", path):
+            title_id, resource = m.groups()
+            if self.headers.get("Cookie", "").find(f"_ODAUTH=mock-{title_id}") == -1:
+                self.send_json({"errorCode": "MissingCookie"}, status=403)
+            elif resource == "openbook.json":
+                self.send_json(account.openbook(title_id))
+            elif re.fullmatch(r"\{\d+}Fmt425-Part\d+\.mp3", resource):
+                self.send_body(self.server.mp3_body, content_type="audio/mpeg")
+            else:
+                return False
+        else:
+            return False
+        return True
+
+    def handle_resize(self, path: str, query: dict) -> bool:
+        self.send_body(JPEG_BYTES, content_type="image/jpeg")
+        return True
+
+
+class MockOverDriveServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, bandwidth: int = 0,
+                 failure_rate: float = 0.0, failure_services: tuple = ("sentry", "thunder", "cdn", "resize"),
+                 verbose: bool = False, **account_kwargs):
+        super().__init__((host, port), MockOverDriveHandler)
+        self.base_url = f"http://{host}:{self.server_address[1]}"
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.failure_services = failure_services
+        self.verbose = verbose
+        self.account = MockAccount(self.base_url, **account_kwargs)
+        self.mp3_body = make_mp3(self.account.part_size)
+        self.request_counts = {}
+        self.request_counts_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def urls(self) -> dict:
+        return {
+            "SENTRY_URL": f"{self.base_url}/sentry",
+            "THUNDER_URL": f"{self.base_url}/thunder",
+            "COVER_RESIZE_URL": f"{self.base_url}/resize",
+        }
+
+    def count_request(self, service: str):
+        with self.request_counts_lock:
+            self.request_counts[service] = self.request_counts.get(service, 0) + 1
+
+    def start(self) -> "MockOverDriveServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OverDrive server for PyLibby.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--loans", type=int, default=10, help="Number of loans on the synthetic account.")
+    parser.add_argument("--holds", type=int, default=5, help="Number of holds on the synthetic account.")
+    parser.add_argument("--cards", type=int, default=2, help="Number of library cards.")
+    parser.add_argument("--catalog", type=int, default=0, help="Number of titles in the catalog (min loans+holds).")
+    parser.add_argument("--parts", type=int, default=5, help="Number of mp3 parts per audiobook.")
+    parser.add_argument("--part-size", type=int, default=256 * 1024, help="Size of each mp3 part in bytes.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean added latency per request (seconds).")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Per-connection bandwidth cap in bytes/s.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests answered with 503.")
+    parser.add_argument("--failure-services", default="sentry,thunder,cdn,resize",
+                        help="Comma separated services failures are injected into.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request.")
+    args = parser.parse_args()
+
+    server = MockOverDriveServer(args.host, args.port, latency=args.latency, bandwidth=args.bandwidth,
+                                 failure_rate=args.failure_rate,
+                                 failure_services=tuple(args.failure_services.split(",")), verbose=args.verbose,
+                                 loans=args.loans, holds=args.holds, cards=args.cards, catalog=args.catalog,
+                                 parts=args.parts, part_size=args.part_size, seed=args.seed)
+    for key, value in server.urls.items():
+        print(f"export {key}={value}")
+    print("Log in with any code, e.g. 'python pylibby.py -c 12345678'.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,11 +18,33 @@
 # along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
 
 import random
+import heapq
 import json
+import atexit
 import sys
+import threading
+import contextlib
+import cProfile
+import pstats
+import weakref
+import hashlib
+import mmap
+import errno
+import shutil
+import struct
+import base64
+import io
+import asyncio
+import http.client
+import http.cookiejar
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import collections
 import urllib.parse
 import requests
 from requests.adapters import HTTPAdapter, Retry
+from requests.cookies import RequestsCookieJar, create_cookie, extract_cookies_to_jar
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
 import os
 import dicttoxml
 import html
@@ -30,7 +52,7 @@ import time
 import re
 from mutagen.mp3 import MP3
 from mutagen.id3 import (
-    TXXX, TPE1, TIT2, TIT3, TPUB, TYER, TCOM, TCON, TALB, TDRL, COMM, CHAP, CTOC, CTOCFlags,
+    ID3, TXXX, TPE1, TIT2, TIT3, TPUB, TYER, TCOM, TCON, TALB, TDRL, COMM, CHAP, CTOC, CTOCFlags,
     APIC, Encoding, PictureType
 )
 from typing import Callable
@@ -39,10 +61,973 @@ import datetime
 import argparse
 from tabulate import tabulate
 import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    import httpx
+except ImportError:
+    # Only needed for AsyncLibby.
+    httpx = None
 
 
 VERSION = "0.4.0"
 
+# Base URLs for the OverDrive services, can be overridden to point PyLibby at a mock server.
+SENTRY_URL = os.getenv("SENTRY_URL", "https://sentry-read.svc.overdrive.com")
+THUNDER_URL = os.getenv("THUNDER_URL", "https://thunder.api.overdrive.com")
+COVER_RESIZE_URL = os.getenv("COVER_RESIZE_URL", "https://ic.od-cdn.com/resize")
+
+
+def get_endpoint_class(url: str) -> str:
+    """
+    Group a request URL by the service it goes to, "sentry", "thunder", "cover" or "cdn".
+    """
+    if url.startswith(SENTRY_URL):
+        return "sentry"
+    if url.startswith(THUNDER_URL):
+        return "thunder"
+    if url.startswith(COVER_RESIZE_URL):
+        return "cover"
+    return "cdn"
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Profiler:
+    """
+    Records wall-clock time spent in each phase of a run (sync, open, archive, tagging, sleeping...),
+    and optionally a cProfile of everything.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = {}
+        self.lock = threading.Lock()
+        self.cprofile = None
+
+    def start(self, use_cprofile: bool = False):
+        self.enabled = True
+        if use_cprofile:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.spans.setdefault(name, []).append(elapsed)
+
+    def stop(self, cprofile_path: str = None):
+        if self.cprofile:
+            self.cprofile.disable()
+            if cprofile_path:
+                self.cprofile.dump_stats(cprofile_path)
+                print(f"Wrote cProfile stats to {cprofile_path}.")
+            else:
+                pstats.Stats(self.cprofile).sort_stats("cumulative").print_stats(25)
+        self.enabled = False
+
+    def summary(self) -> list:
+        with self.lock:
+            return [{
+                "Phase": name,
+                "Count": len(times),
+                "Total (s)": round(sum(times), 3),
+                "Mean (ms)": round(sum(times) / len(times) * 1000, 2),
+                "Max (ms)": round(max(times) * 1000, 2),
+            } for name, times in sorted(self.spans.items(), key=lambda i: sum(i[1]), reverse=True)]
+
+
+class HTTPTracer:
+    """
+    Response hook that keeps a record of every request: method, endpoint class, status, bytes,
+    whether the connection was reused and how long it took.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.lock = threading.Lock()
+        self.connections = weakref.WeakSet()
+
+    def hook(self, response: requests.Response, *args, **kwargs):
+        if not self.enabled:
+            return
+        connection = getattr(response.raw, "connection", None) or getattr(response.raw, "_connection", None)
+        with self.lock:
+            reused = connection is not None and connection in self.connections
+            if connection is not None:
+                self.connections.add(connection)
+
+        latency = response.elapsed.total_seconds()
+        streamed = bool(kwargs.get("stream"))
+        if streamed:
+            # The body is read later by the caller, so the size is all we know for now.
+            size = int(response.headers.get("Content-Length", 0))
+        else:
+            start = time.perf_counter()
+            size = len(response.content)
+            latency += time.perf_counter() - start
+
+        parsed = urllib.parse.urlparse(response.url)
+        record = {
+            "time": time.time() - latency,
+            "method": response.request.method,
+            "endpoint": get_endpoint_class(response.url),
+            "host": parsed.netloc,
+            # No query string, it can contain tokens.
+            "path": parsed.path,
+            "status": response.status_code,
+            "http": "2" if getattr(response.raw, "version", 11) == 20 else "1.1",
+            "bytes": size,
+            "reused": reused,
+            "streamed": streamed,
+            "latency": round(latency, 6),
+        }
+        with self.lock:
+            self.records.append(record)
+
+    def write(self, trace_path: str):
+        with self.lock:
+            with open(trace_path, "w") as w:
+                w.write(json.dumps(self.records, indent=4))
+        print(f"Wrote HTTP trace with {len(self.records)} requests to {trace_path}.")
+
+    def summary(self) -> list:
+        endpoints = {}
+        with self.lock:
+            for r in self.records:
+                endpoints.setdefault(r["endpoint"], []).append(r)
+        return [{
+            "Endpoint": endpoint,
+            "Requests": len(records),
+            "Errors": sum(1 for r in records if r["status"] >= 400),
+            "Reused": f"{sum(1 for r in records if r['reused']) / len(records):.0%}",
+            "MB": round(sum(r["bytes"] for r in records) / 1000 / 1000, 2),
+            "Mean (ms)": round(sum(r["latency"] for r in records) / len(records) * 1000, 2),
+            "p95 (ms)": round(percentile([r["latency"] for r in records], 0.95) * 1000, 2),
+            "Max (ms)": round(max(r["latency"] for r in records) * 1000, 2),
+        } for endpoint, records in sorted(endpoints.items())]
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms in the Prometheus text format. They can be served on /metrics
+    or written to a file for node_exporter's textfile collector.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    DEFINITIONS = {
+        "pylibby_http_request_duration_seconds": ("histogram", "Latency of HTTP requests by endpoint class."),
+        "pylibby_http_requests_total": ("counter", "HTTP requests by endpoint class and status code."),
+        "pylibby_downloaded_bytes_total": ("counter", "Bytes downloaded by endpoint class."),
+        "pylibby_parts_downloaded_total": ("counter", "Audiobook parts downloaded."),
+        "pylibby_archive_operation_duration_seconds": ("histogram", "Time spent loading and writing the archive."),
+        "pylibby_retries_total": ("counter", "Retried HTTP requests by endpoint class."),
+        "pylibby_rate_limit_waits_total": ("counter", "Times a transfer waited because of rate limiting."),
+        "pylibby_rate_limit_wait_seconds_total": ("counter", "Seconds spent waiting because of rate limiting."),
+        "pylibby_part_delay_seconds_total": ("counter", "Seconds spent in the random delay between parts."),
+        "pylibby_queue_depth": ("gauge", "Loans waiting to be downloaded by account."),
+        "pylibby_bandwidth_limit_bytes": ("gauge", "Current bandwidth cap in bytes per second, 0 is unlimited."),
+        "pylibby_bandwidth_wait_seconds_total": ("counter", "Seconds transfers spent waiting for the bandwidth cap."),
+        "pylibby_bandwidth_pause_seconds_total": ("counter", "Seconds spent paused by the bandwidth schedule."),
+        "pylibby_watch_polls_total": ("counter", "Availability checks made for watched titles."),
+        "pylibby_circuit_open": ("gauge", "1 while the circuit breaker of an endpoint class is open."),
+        "pylibby_circuit_rejections_total": ("counter", "Requests failed right away because the circuit was open."),
+        "pylibby_hedged_requests_total": ("counter", "Duplicate requests sent because the first was slower than p95."),
+        "pylibby_watch_errors_total": ("counter", "Rounds of --watch checks that failed on the network."),
+        "pylibby_watch_borrows_total": ("counter", "Watched titles borrowed."),
+    }
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self.lock:
+            buckets, total, count = self.histograms.get(key, ([0] * len(self.BUCKETS), 0.0, 0))
+            for i, le in enumerate(self.BUCKETS):
+                if value <= le:
+                    buckets[i] += 1
+            self.histograms[key] = (buckets, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def hook(self, response: requests.Response, *args, **kwargs):
+        if not self.enabled:
+            return
+        endpoint = get_endpoint_class(response.url)
+        latency = response.elapsed.total_seconds()
+        if not kwargs.get("stream"):
+            start = time.perf_counter()
+            self.inc("pylibby_downloaded_bytes_total", len(response.content), endpoint=endpoint)
+            latency += time.perf_counter() - start
+        self.observe("pylibby_http_request_duration_seconds", latency, endpoint=endpoint)
+        self.inc("pylibby_http_requests_total", endpoint=endpoint, status=str(response.status_code))
+
+    def render(self) -> str:
+        def format_labels(labels: tuple) -> str:
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+        lines = []
+        with self.lock:
+            for name, (metric_type, help_text) in self.DEFINITIONS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                if metric_type == "histogram":
+                    for (n, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                        if n != name:
+                            continue
+                        for le, bucket in zip(self.BUCKETS, buckets):
+                            lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {bucket}")
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                        lines.append(f"{name}_count{format_labels(labels)} {count}")
+                else:
+                    for (n, labels), value in sorted(self.values.items()):
+                        if n == name:
+                            lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_path: str):
+        # Write to a temporary file and rename it, the textfile collector must never see a half written file.
+        temp_path = metrics_path + ".tmp"
+        with open(temp_path, "w") as w:
+            w.write(self.render())
+        os.replace(temp_path, metrics_path)
+
+    def start_file_writer(self, metrics_path: str, interval: float = 15):
+        def writer():
+            while True:
+                time.sleep(interval)
+                self.write(metrics_path)
+
+        threading.Thread(target=writer, daemon=True).start()
+
+    def serve(self, port: int, host: str = ""):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{host or '0.0.0.0'}:{server.server_address[1]}/metrics")
+        return server
+
+
+profiler = Profiler()
+http_tracer = HTTPTracer()
+metrics = Metrics()
+
+
+class CountingRetry(Retry):
+    """
+    Retry that reports every retried request to the metrics.
+    """
+
+    def increment(self, method=None, url=None, *args, **kwargs):
+        new_retry = super().increment(method, url, *args, **kwargs)
+        # urllib3 only gives us the path, the pool knows which host it was.
+        pool = kwargs.get("_pool")
+        endpoint = "cdn"
+        if pool is not None:
+            port = f":{pool.port}" if pool.port not in (None, 80, 443) else ""
+            endpoint = get_endpoint_class(f"{pool.scheme}://{pool.host}{port}{url or ''}")
+        metrics.inc("pylibby_retries_total", endpoint=endpoint)
+        return new_retry
+
+
+class RateLimiter:
+    """
+    Token bucket limiting requests per second. There is one for the whole process, so it's shared by
+    every account when running several at once.
+    """
+
+    def __init__(self, rate: float = 0, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token and returns how long to wait before using it.
+        """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now, even if it isn't there yet, so waiting requests are served in order.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            metrics.inc("pylibby_rate_limit_waits_total")
+            metrics.inc("pylibby_rate_limit_wait_seconds_total", wait)
+        return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class SharedCache:
+    """
+    Thread-safe cache shared by every Libby in the process. Concurrent lookups of the same key
+    wait for the first one instead of all going to the network.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch: Callable, should_cache: Callable = None):
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[0] > time.monotonic():
+                    return entry[1]
+                event = self.pending.get(key)
+                if event is None:
+                    event = self.pending[key] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            value = fetch()
+            if should_cache is None or should_cache(value):
+                self.set(key, value)
+            return value
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+    def get(self, key):
+        """
+        Returns the cached value or None, without waiting for pending fetches.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+        return None
+
+    def set(self, key, value):
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                # Dicts keep insertion order, so this drops the oldest entry.
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def parse_bandwidth(bandwidth: str, allow_pause: bool = False) -> float:
+    """
+    Bytes per second from a string like 500K or 2.5M. "pause" is BandwidthLimiter.PAUSE, only for schedule windows
+    since a pause without an end would never resume.
+    """
+    bandwidth = bandwidth.strip().upper()
+    if bandwidth == "PAUSE":
+        if not allow_pause:
+            raise RuntimeError("Bandwidth limit can't be pause, only windows of --bandwidth-schedule can.")
+        return BandwidthLimiter.PAUSE
+    multipliers = {"K": 1000, "M": 1000 * 1000, "G": 1000 * 1000 * 1000}
+    try:
+        if bandwidth[-1:] in multipliers:
+            return float(bandwidth[:-1]) * multipliers[bandwidth[-1]]
+        return float(bandwidth)
+    except ValueError:
+        raise RuntimeError(f"Invalid bandwidth: {bandwidth}, use bytes per second like 500K or 2M.")
+
+
+def parse_bandwidth_schedule(schedule: str) -> list:
+    """
+    Windows like "08:00-18:00=500K,18:00-08:00=0" as a list of (start minute, end minute, bytes per second).
+    """
+    windows = []
+    for window in filter(None, (w.strip() for w in schedule.split(","))):
+        m = re.fullmatch(r"(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)", window)
+        if not m:
+            raise RuntimeError(f"Invalid bandwidth window: {window}, use HH:MM-HH:MM=rate.")
+        hours, minutes = [int(m.group(i)) for i in (1, 3)], [int(m.group(i)) for i in (2, 4)]
+        if max(hours) > 23 or max(minutes) > 59:
+            raise RuntimeError(f"Invalid bandwidth window: {window}, times go from 00:00 to 23:59.")
+        start = hours[0] * 60 + minutes[0]
+        end = hours[1] * 60 + minutes[1]
+        if start == end:
+            # Would cover the whole day, so a pause would never end.
+            raise RuntimeError(f"Invalid bandwidth window: {window}, it starts when it ends.")
+        windows.append((start, end, parse_bandwidth(m.group(5), allow_pause=True)))
+    return windows
+
+
+class BandwidthLimiter:
+    """
+    Caps the bytes per second of all part downloads in the process together. The cap can change with the time
+    of day, and a window can pause downloads. Pauses start at part boundaries, so a part is never cut off.
+    """
+    PAUSE = -1.0
+
+    def __init__(self, rate: float = 0, schedule: list = None):
+        self.rate = rate
+        self.schedule = schedule or []
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get_rate(self, now: datetime.datetime = None) -> float:
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            # Windows can go past midnight, like 22:00-06:00.
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return rate
+        return self.rate
+
+    def get_seconds_to_next_window(self, now: datetime.datetime = None) -> float:
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        boundaries = {b for start, end, _ in self.schedule for b in (start, end)}
+        minutes = min(((b - minute - 1) % (24 * 60)) + 1 for b in boundaries) if boundaries else 24 * 60
+        return minutes * 60 - now.second - now.microsecond / 1000000
+
+    def get_pause(self) -> float:
+        if self.get_rate() != self.PAUSE:
+            return 0
+        seconds = self.get_seconds_to_next_window()
+        print(f"Downloads are paused by the bandwidth schedule, resuming in {round(seconds / 60)} minutes.")
+        metrics.inc("pylibby_bandwidth_pause_seconds_total", seconds)
+        return seconds
+
+    def wait_for_window(self):
+        """
+        Call between parts, waits while the schedule says pause.
+        """
+        while seconds := self.get_pause():
+            time.sleep(seconds)
+
+    async def wait_for_window_async(self):
+        while seconds := self.get_pause():
+            await asyncio.sleep(seconds)
+
+    def reserve(self, size: int) -> float:
+        """
+        Takes size bytes from the bucket and returns how long to wait before using them.
+        """
+        rate = self.get_rate()
+        if rate == self.PAUSE:
+            # The part was started before the pause, let it finish at the normal rate.
+            rate = self.rate
+        metrics.set("pylibby_bandwidth_limit_bytes", max(rate, 0))
+        if rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            # The bucket holds a second worth of data.
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait > 0:
+            metrics.inc("pylibby_bandwidth_wait_seconds_total", wait)
+        return wait
+
+    def consume(self, size: int):
+        wait = self.reserve(size)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def consume_async(self, size: int):
+        wait = self.reserve(size)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+rate_limiter = RateLimiter()
+bandwidth_limiter = BandwidthLimiter()
+media_info_cache = SharedCache()
+# Short lived, so polls of the same title at the same library at about the same time make one request.
+availability_cache = SharedCache(ttl=5)
+cover_cache = SharedCache(max_entries=256)
+# Every Libby shares the same archive file, so changes to it have to happen one at a time.
+archive_lock = threading.RLock()
+# One lock per title id, so accounts that have the same book on loan don't download it into the same folder at once.
+title_locks = {}
+
+
+@contextlib.contextmanager
+def claim_title(title_id: str):
+    with archive_lock:
+        lock = title_locks.setdefault(title_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        print(f"{title_id} is being downloaded by another account, waiting for it.")
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class EndpointHealth:
+    """
+    Latency and failures of one endpoint class. The circuit breaker opens after FAILURE_THRESHOLD failures
+    in a row (errors, timeouts and 5xx), then requests fail right away for COOLDOWN seconds instead of each
+    waiting for the timeout. After that one request is let through to see if the host is back.
+    """
+    FAILURE_THRESHOLD = 5
+    COOLDOWN = 30
+    # Latencies kept for the p95, and how many we need before hedging.
+    WINDOW = 200
+    MIN_SAMPLES = 20
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.latencies = collections.deque(maxlen=self.WINDOW)
+        self.failures = 0
+        self.open_until = 0.0
+        self.testing = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.failures < self.FAILURE_THRESHOLD:
+                return
+            if time.monotonic() < self.open_until or self.testing:
+                metrics.inc("pylibby_circuit_rejections_total", endpoint=self.endpoint)
+                raise CircuitOpenError(f"Too many failed requests to {self.endpoint}, not trying it again for "
+                                       f"{max(round(self.open_until - time.monotonic()), 0)} seconds.")
+            self.testing = True
+
+    def record(self, latency: float, ok: bool):
+        with self.lock:
+            self.testing = False
+            if ok:
+                self.latencies.append(latency)
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= self.FAILURE_THRESHOLD:
+                    if self.failures == self.FAILURE_THRESHOLD:
+                        print(f"Too many failed requests to {self.endpoint}, pausing it for {self.COOLDOWN} seconds.")
+                    self.open_until = time.monotonic() + self.COOLDOWN
+            metrics.set("pylibby_circuit_open", int(self.failures >= self.FAILURE_THRESHOLD), endpoint=self.endpoint)
+
+    def get_hedge_delay(self) -> float:
+        """
+        Seconds to wait for a response before sending a duplicate request, None if we don't know enough yet.
+        """
+        with self.lock:
+            if len(self.latencies) < self.MIN_SAMPLES:
+                return None
+            return percentile(list(self.latencies), 0.95)
+
+
+class RequestGuard:
+    """
+    Keeps an EndpointHealth for each endpoint class, shared by all sessions in the process. If hedge is set,
+    a GET or HEAD that takes longer than the p95 of its endpoint gets a duplicate and the first good response
+    is used.
+    """
+
+    def __init__(self):
+        self.hedge = False
+        self.endpoints = {endpoint: EndpointHealth(endpoint) for endpoint in ["sentry", "thunder", "cover", "cdn"]}
+        # Threads are only started when needed, it just has to be big enough to never queue a request.
+        self.executor = ThreadPoolExecutor(max_workers=64)
+
+    def send(self, request, send: Callable) -> requests.Response:
+        health = self.endpoints[get_endpoint_class(request.url)]
+        health.before_request()
+        delay = health.get_hedge_delay() if self.hedge and request.method in ("GET", "HEAD") else None
+        start = time.perf_counter()
+        try:
+            response = send() if delay is None else self.send_hedged(send, delay, health.endpoint)
+        except Exception:
+            health.record(time.perf_counter() - start, ok=False)
+            raise
+        health.record(time.perf_counter() - start, ok=response.status_code < 500)
+        return response
+
+    def send_hedged(self, send: Callable, delay: float, endpoint: str) -> requests.Response:
+        def is_good(future) -> bool:
+            return future.exception() is None and future.result().status_code < 500
+
+        def send_again() -> requests.Response:
+            rate_limiter.acquire()
+            return send()
+
+        def discard(future):
+            if future.exception() is None:
+                future.result().close()
+
+        first = self.executor.submit(send)
+        if wait([first], timeout=delay).done:
+            return first.result()
+        metrics.inc("pylibby_hedged_requests_total", endpoint=endpoint)
+        second = self.executor.submit(send_again)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner, loser = (first, second) if first in done else (second, first)
+        if not is_good(winner):
+            # Give the other one a chance before failing.
+            wait([loser])
+            if is_good(loser):
+                winner, loser = loser, winner
+        loser.add_done_callback(discard)
+        return winner.result()
+
+
+request_guard = RequestGuard()
+
+
+class ReplayBody(io.BytesIO):
+    """
+    Body of a replayed response, so it can be used as the raw of a requests Response.
+    """
+
+    def __init__(self, body: bytes, headers: list):
+        super().__init__(body)
+        self.version = 11
+        self.connection = None
+        # requests reads cookies from the headers of the original http.client response.
+        self.msg = http.client.HTTPMessage()
+        for name, value in headers:
+            self.msg[name] = value
+        self._original_response = self
+
+    def read(self, amt: int = None, decode_content: bool = None) -> bytes:
+        return super().read(amt)
+
+    def release_conn(self):
+        pass
+
+
+class Cassette:
+    """
+    Records the HTTP traffic of every session to a file, or serves a recorded file instead of the network,
+    so runs against real loans can be repeated offline. Identities, the message token and cookie values are
+    scrubbed, request headers and query strings aren't stored at all. Recorded responses are matched by method
+    and URL without the query string, in the order they were recorded.
+    """
+    SCRUBBED_KEYS = {"identity", "message", "token"}
+    # Only bodies of these types are cut, JSON and everything else is always recorded whole.
+    BINARY_TYPES = ("audio/", "video/", "image/", "application/octet-stream")
+    DEFAULT_MAX_BODY = 64 * 1024
+
+    def __init__(self):
+        self.mode = None
+        # Binary bodies longer than this are cut when recording and padded with zeros when replaying, 0 keeps all.
+        # Without a limit every mp3 part would be kept in memory until the cassette is written.
+        self.max_body = self.DEFAULT_MAX_BODY
+        # Replayed responses take the recorded time multiplied by this, 0 answers right away.
+        self.scale = 1.0
+        self.interactions = []
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(method: str, url: str) -> str:
+        parsed = urllib.parse.urlparse(url)
+        return f"{method} {parsed.scheme}://{parsed.netloc}{parsed.path}"
+
+    def scrub(self, value):
+        if isinstance(value, dict):
+            return {k: "scrubbed" if k in self.SCRUBBED_KEYS else self.scrub(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.scrub(v) for v in value]
+        return value
+
+    def scrub_body(self, body: bytes) -> bytes:
+        try:
+            return json.dumps(self.scrub(json.loads(body))).encode()
+        except ValueError:
+            return body
+
+    def send(self, request, send: Callable, **kwargs) -> requests.Response:
+        if self.mode == "replay":
+            return self.replay(request)
+        if self.mode != "record":
+            return send(request, **kwargs)
+
+        start = time.perf_counter()
+        response = send(request, **kwargs)
+        elapsed = time.perf_counter() - start
+        # Read streamed bodies as well, requests serves them from memory afterwards.
+        body = response.content
+        transfer = time.perf_counter() - start - elapsed
+
+        original = getattr(response.raw, "_original_response", None)
+        headers = original.msg.items() if original is not None else response.headers.items()
+        headers = [(k, re.sub(r"^([^=]*)=[^;]*", r"\1=scrubbed", v) if k.lower() == "set-cookie" else v)
+                   for k, v in headers if k.lower() not in ("content-encoding", "transfer-encoding")]
+        body = self.scrub_body(body)
+        is_binary = response.headers.get("Content-Type", "").lower().startswith(self.BINARY_TYPES)
+        recorded_body = body[:self.max_body] if self.max_body and is_binary else body
+        with self.lock:
+            self.interactions.append({
+                "method": request.method,
+                "url": self.get_key(request.method, request.url).split(" ", 1)[1],
+                "status": response.status_code,
+                "reason": response.reason,
+                "headers": headers,
+                "size": len(body),
+                "body": base64.b64encode(recorded_body).decode(),
+                "elapsed": round(elapsed, 6),
+                "transfer": round(transfer, 6),
+            })
+        return response
+
+    def replay(self, request) -> requests.Response:
+        key = self.get_key(request.method, request.url)
+        with self.lock:
+            queue = self.queues.get(key)
+            if not queue:
+                raise requests.exceptions.ConnectionError(f"Nothing recorded for {key}.", request=request)
+            # The last response is kept for requests that were made more often than when recording.
+            interaction = queue.pop(0) if len(queue) > 1 else queue[0]
+        time.sleep((interaction["elapsed"] + interaction["transfer"]) * self.scale)
+
+        body = base64.b64decode(interaction["body"])
+        body += b"\0" * (interaction["size"] - len(body))
+        headers = [(k, v) for k, v in interaction["headers"] if k.lower() != "content-length"]
+        headers.append(("Content-Length", str(len(body))))
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.reason = interaction["reason"]
+        response.headers = CaseInsensitiveDict()
+        for name, value in headers:
+            response.headers[name] = f"{response.headers[name]}, {value}" if name in response.headers else value
+        response.raw = ReplayBody(body, headers)
+        response.url = request.url
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.request = request
+        extract_cookies_to_jar(response.cookies, request, response.raw)
+        return response
+
+    def start_recording(self, max_body: int = DEFAULT_MAX_BODY):
+        self.mode = "record"
+        self.max_body = max_body
+
+    def start_replay(self, cassette_path: str, scale: float = 1.0):
+        with open(cassette_path, "r") as r:
+            self.interactions = json.loads(r.read())["interactions"]
+        for interaction in self.interactions:
+            self.queues.setdefault(f"{interaction['method']} {interaction['url']}", []).append(interaction)
+        self.mode = "replay"
+        self.scale = scale
+        print(f"Replaying {len(self.interactions)} recorded requests from {cassette_path}.")
+
+    def write(self, cassette_path: str):
+        with self.lock:
+            with open(cassette_path, "w") as w:
+                w.write(json.dumps({"version": 1, "interactions": self.interactions}, indent=4))
+        print(f"Recorded {len(self.interactions)} requests to {cassette_path}.")
+
+
+cassette = Cassette()
+
+
+class LibbyHTTPAdapter(HTTPAdapter):
+    """
+    Adapter mounted on all our sessions, anything that has to happen before a request goes out goes here.
+    """
+
+    def send(self, request, **kwargs):
+        rate_limiter.acquire()
+        return request_guard.send(request, lambda: cassette.send(request, self.transport_send, **kwargs))
+
+    def transport_send(self, request, **kwargs):
+        """
+        Actually sends the request, override this to use another HTTP client.
+        """
+        return super().send(request, **kwargs)
+
+
+def create_no_cookies_jar() -> http.cookiejar.CookieJar:
+    """
+    Jar that never stores or sends anything, for httpx clients where we handle cookies ourselves.
+    """
+    return http.cookiejar.CookieJar(policy=http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+
+class HTTP2Body:
+    """
+    Body of a streamed httpx response, so it can be used as the raw of a requests Response.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.chunks = response.iter_bytes()
+        self.buffer = bytearray()
+        self.version = 20 if response.http_version == "HTTP/2" else 11
+        # The same object for every request on a connection, the HTTP tracer uses it to see reuse.
+        self.connection = response.extensions.get("network_stream")
+        # requests reads cookies from the headers of the original http.client response.
+        self.msg = http.client.HTTPMessage()
+        for name, value in response.headers.multi_items():
+            self.msg[name] = value
+        self._original_response = self
+
+    def read(self, amt: int = None, decode_content: bool = None) -> bytes:
+        while amt is None or len(self.buffer) < amt:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.close()
+                break
+            self.buffer += chunk
+        amt = len(self.buffer) if amt is None else amt
+        data = bytes(self.buffer[:amt])
+        del self.buffer[:amt]
+        return data
+
+    def close(self):
+        self.response.close()
+
+    def release_conn(self):
+        self.close()
+
+
+class HTTP2Adapter(LibbyHTTPAdapter):
+    """
+    Sends requests with httpx over HTTP/2, so parallel requests to a host share one connection.
+    Falls back to the normal adapter if h2 isn't installed, or if HTTP/2 fails for a GET.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = None
+        if httpx is None:
+            print("HTTP/2 needs httpx (pip install httpx[http2]), using HTTP/1.1.")
+            return
+        try:
+            transport = httpx.HTTPTransport(http2=True, retries=int(self.max_retries.total or 0))
+        except ImportError:
+            print("HTTP/2 needs h2 (pip install httpx[http2]), using HTTP/1.1.")
+            return
+        self.client = httpx.Client(transport=transport, cookies=create_no_cookies_jar())
+        # requests already sets the headers we want, and some requests must go out without any.
+        self.client.headers.clear()
+
+    def transport_send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if self.client is None:
+            return super().transport_send(request, stream=stream, timeout=timeout, verify=verify, cert=cert,
+                                          proxies=proxies)
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            h2_request = self.client.build_request(request.method, request.url, headers=dict(request.headers),
+                                                   content=request.body, timeout=timeout)
+            h2_response = self.client.send(h2_request, stream=True)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.ProtocolError as e:
+            if request.method not in ("GET", "HEAD"):
+                raise requests.exceptions.ConnectionError(e, request=request)
+            print(f"HTTP/2 failed ({e}), using HTTP/1.1.")
+            self.client = None
+            return super().transport_send(request, stream=stream, timeout=timeout, verify=verify, cert=cert,
+                                          proxies=proxies)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = h2_response.status_code
+        response.headers = CaseInsensitiveDict(h2_response.headers.items())
+        response.raw = HTTP2Body(h2_response)
+        response.reason = h2_response.reason_phrase
+        response.url = request.url
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.request = request
+        response.connection = self
+        extract_cookies_to_jar(response.cookies, request, response.raw)
+        return response
+
+    def close(self):
+        super().close()
+        if self.client is not None:
+            self.client.close()
+
+
+def mount_adapter(session: requests.Session, adapter: HTTPAdapter):
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+# Session for the requests that don't need our identity (thunder and covers).
+anonymous_session = requests.Session()
+mount_adapter(anonymous_session, LibbyHTTPAdapter())
+anonymous_session.hooks["response"].append(http_tracer.hook)
+anonymous_session.hooks["response"].append(metrics.hook)
+
 
 def compat_datetime_fromisoformat(date_string):
     """
@@ -63,6 +1048,93 @@ def get_filename_from_url(url: str) -> str:
     return path.basename(url_parsed)
 
 
+class InsufficientSpaceError(RuntimeError):
+    pass
+
+
+def check_free_space(_path: str, required: int, what: str):
+    free = shutil.disk_usage(_path).free
+    if free < required:
+        raise InsufficientSpaceError(f"{what} needs {required // 1000 // 1000} MB but only "
+                                     f"{free // 1000 // 1000} MB is free in {_path}.")
+
+
+def preallocate_file(fd: int, size: int):
+    """
+    Reserve size bytes for a file before writing it, so it isn't fragmented and we fail early if the disk is full.
+    """
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except AttributeError:
+        # No fallocate on this OS, setting the size is the best we can do.
+        os.ftruncate(fd, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise InsufficientSpaceError(f"No space left for {size // 1000 // 1000} MB file.")
+        # Not supported on this file system.
+        os.ftruncate(fd, size)
+
+
+def scan_tree(path: str, workers: int = 8) -> dict:
+    """
+    Size and mtime of every file under path as {folder: {filename: (size, mtime_ns)}}, without opening any of them.
+    All folders at the same depth are scanned at the same time.
+    """
+    def scan(folder: str) -> tuple[dict, list]:
+        files, folders = {}, []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except OSError as e:
+            print(f"Couldn't scan {folder}: {e}")
+        return files, folders
+
+    tree = {}
+    level = [os.path.realpath(path)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            next_level = []
+            for folder, (files, folders) in zip(level, executor.map(scan, level)):
+                tree[folder] = files
+                next_level.extend(folders)
+            level = next_level
+    return tree
+
+
+def hash_file(file_path: str, block_size: int = 1024 * 1024) -> tuple[int, str]:
+    """
+    Return size and SHA-256 of a file. Uses mmap so hashlib can work on the whole file without copying it,
+    falls back to large block reads on filesystems that can't be mapped.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as r:
+        size = os.fstat(r.fileno()).st_size
+        if size:
+            try:
+                with mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    digest.update(m)
+            except (OSError, ValueError):
+                for block in iter(lambda: r.read(block_size), b""):
+                    digest.update(block)
+    return size, digest.hexdigest()
+
+
+def get_cover(url: str, timeout: int = 10) -> bytes:
+    # Only the status and the bytes are kept, not the whole response.
+    def fetch() -> tuple[int, bytes]:
+        response = anonymous_session.get(url, timeout=timeout)
+        return response.status_code, response.content
+
+    return cover_cache.get_or_fetch(url, fetch, should_cache=lambda r: r[0] == 200)[1]
+
+
 def download_cover(media_info: dict, _path: str, timeout: int = 10, should_resize_to_square: bool = True) -> str:
     downloaded_cover_path = ""
     if "covers" in media_info:
@@ -72,15 +1144,15 @@ def download_cover(media_info: dict, _path: str, timeout: int = 10, should_resiz
                 downloaded_cover_path = os.path.join(_path, best[0] + ".jpg")
                 with open(downloaded_cover_path, "wb") as w:
                     if not should_resize_to_square:
-                        w.write(requests.get(best[1]["href"], timeout=timeout).content)
+                        w.write(get_cover(best[1]["href"], timeout=timeout))
                     else:
-                        resize_url = f"https://ic.od-cdn.com/resize?type=auto" \
+                        resize_url = f"{COVER_RESIZE_URL}?type=auto" \
                                      f"&width={best[1]['width']}" \
                                      f"&quality=80" \
                                      f"&force=true" \
                                      f"&height={best[1]['width']}" \
                                      f"&url={urllib.parse.urlparse(best[1]['href']).path}"
-                        w.write(requests.get(resize_url, timeout=timeout).content)
+                        w.write(get_cover(resize_url, timeout=timeout))
                     return downloaded_cover_path
         except KeyError:
             print("Cover has unspecified width!")
@@ -90,31 +1162,316 @@ def download_cover(media_info: dict, _path: str, timeout: int = 10, should_resiz
             downloaded_cover_path = os.path.join(_path, "cover510Wide.jpg")
             with open(downloaded_cover_path, "wb") as w:
                 if not should_resize_to_square:
-                    w.write(requests.get(media_info["covers"]["cover510Wide"]["href"], timeout=timeout).content)
+                    w.write(get_cover(media_info["covers"]["cover510Wide"]["href"], timeout=timeout))
                 else:
-                    resize_url = f"https://ic.od-cdn.com/resize?type=auto" \
+                    resize_url = f"{COVER_RESIZE_URL}?type=auto" \
                                  f"&width=510" \
                                  f"&quality=80" \
                                  f"&force=true" \
                                  f"&height=510" \
                                  f"&url={urllib.parse.urlparse(media_info['covers']['cover510Wide']['href']).path}"
-                    w.write(requests.get(resize_url, timeout=timeout).content)
+                    w.write(get_cover(resize_url, timeout=timeout))
 
     return downloaded_cover_path
 
-def get_media_info(title_id: str, timeout: int = 10) -> dict:
+def create_cookie_jar(cookies: list) -> RequestsCookieJar:
+    jar = RequestsCookieJar()
+    for c in cookies:
+        jar.set_cookie(create_cookie(c["name"], c["value"], domain=c["domain"], path=c["path"], expires=c["expires"]))
+    return jar
+
+
+def get_cookie_header(cookies: list, url: str) -> str:
+    """
+    Cookie header for url, for clients where we can't pass a cookie jar per request.
+    """
+    parsed = urllib.parse.urlparse(url)
+    host = parsed.hostname or ""
+    return "; ".join(f"{c['name']}={c['value']}" for c in cookies
+                     if (host == c["domain"].lstrip(".") or host.endswith("." + c["domain"].lstrip(".")))
+                     and parsed.path.startswith(c["path"] or "/")
+                     and (not c["expires"] or c["expires"] > time.time()))
+
+
+# URLs, request bodies and response parsing, shared by Libby and AsyncLibby.
+def get_sync_url() -> str:
+    return f"{SENTRY_URL}/chip/sync"
+
+
+def get_chip_url() -> str:
+    return f"{SENTRY_URL}/chip"
+
+
+def get_clone_by_code_url() -> str:
+    return f"{SENTRY_URL}/chip/clone/code"
+
+
+def get_loan_url(card_id: str, title_id: str) -> str:
+    return f"{SENTRY_URL}/card/{card_id}/loan/{title_id}"
+
+
+def get_hold_url(card_id: str, title_id: str) -> str:
+    return f"{SENTRY_URL}/card/{card_id}/hold/{title_id}"
+
+
+def get_fulfill_url(loan: dict, format_id: str) -> str:
+    return f"{get_loan_url(loan['cardId'], loan['id'])}/fulfill/{format_id}"
+
+
+def get_open_url(loan: dict, card_id: str, title_id: str) -> str:
+    return f"{SENTRY_URL}/open/{'audiobook' if loan['type']['id'] == 'audiobook' else 'book'}/card/{card_id}/title/{title_id}"
+
+
+def get_media_info_url(title_id: str) -> str:
     # API documentation: https://thunder-api.overdrive.com/docs/ui/index
-    return requests.get(f"https://thunder.api.overdrive.com/v2/media/{title_id}", timeout=timeout).json()
+    return f"{THUNDER_URL}/v2/media/{title_id}"
 
 
-def is_book_available(library: str, title_id: str, timeout: int = 10) -> bool:
-    availability = requests.get(
-        f"https://thunder.api.overdrive.com/v2/libraries/{library}/media/{title_id}/availability", timeout=timeout).json()
+def get_availability_url(library: str, title_id: str) -> str:
+    return f"{THUNDER_URL}/v2/libraries/{library}/media/{title_id}/availability"
+
+
+def get_media_bulk_url(title_ids: list) -> str:
+    return f"{THUNDER_URL}/v2/media/bulk?{urllib.parse.urlencode({'titleIds': ','.join(title_ids)})}"
+
+
+def get_search_url(libraries: list, query: str) -> str:
+    params = [("libraryKey", library) for library in libraries] + [("query", query)]
+    return f"{THUNDER_URL}/v2/media/search?{urllib.parse.urlencode(params)}"
+
+
+def get_web_url_with_message(audiobook: dict) -> str:
+    # Requesting this sets the cookie we need for the CDN.
+    return audiobook["urls"]["web"] + "?" + audiobook["message"]
+
+
+def get_download_urls(audiobook_info: dict) -> list:
+    return [audiobook_info["audiobook_urls"]["urls"]["web"] + s["path"] for s in audiobook_info["openbook"]["spine"]]
+
+
+def create_borrow_json(media_info: dict, days: int = 21) -> dict:
+    return {
+        "period": days,
+        "units": "days",
+        "lucky_day": None,
+        "title_format": media_info["type"]["id"]
+    }
+
+
+def create_hold_json() -> dict:
+    return {
+        "days_to_suspend": 0,
+        "email_address": ""
+    }
+
+
+def get_cookies(cookie_jars: list) -> list:
+    """
+    Cookies from the responses of a request (including redirects) as plain dicts we can store.
+    """
+    return [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires}
+            for jar in cookie_jars for c in jar]
+
+
+def check_sentry_response(response, action: str):
+    """
+    Works for both requests and httpx responses.
+    """
+    if response.status_code != 200:
+        raise RuntimeError(f"Couldn't {action}: {response.json()}, you may need to verify your card in the app.")
+
+
+def parse_availability(availability: dict) -> bool:
     if "isAvailable" in availability:
         return availability["isAvailable"]
     return False
 
 
+def parse_bulk_response(response: requests.Response) -> list:
+    """
+    Items of a bulk lookup, or None if it didn't work and the titles have to be fetched one at a time.
+    """
+    if response.status_code != 200:
+        return None
+    try:
+        items = response.json()
+    except ValueError:
+        return None
+    if isinstance(items, dict):
+        items = items.get("items")
+    return items if isinstance(items, list) else None
+
+
+def get_chunks(items: list, size: int) -> list:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def find_title(entries: list, title_id: str) -> dict:
+    return next((entry for entry in entries if entry["id"] == title_id), {})
+
+
+class SyncCard:
+    __slots__ = ("card_id", "library", "loan_count", "loan_limit", "raw")
+
+    def __init__(self, card: dict):
+        self.card_id = card["cardId"]
+        self.library = card["advantageKey"]
+        self.loan_count = int(card["counts"]["loan"]) if "loan" in card.get("counts", {}) else 0
+        # None if the card doesn't say.
+        self.loan_limit = int(card["limits"]["loan"]) if "loan" in card.get("limits", {}) else None
+        self.raw = card
+
+    def is_at_loan_limit(self) -> bool:
+        return self.loan_limit is not None and self.loan_count >= self.loan_limit
+
+
+class SyncEntry:
+    """
+    A loan or a hold, raw is the dict from the sync that the rest of PyLibby works with.
+    """
+    __slots__ = ("title_id", "card_id", "raw")
+
+    def __init__(self, entry: dict):
+        self.title_id = entry["id"]
+        self.card_id = entry.get("cardId")
+        self.raw = entry
+
+
+class SyncState:
+    """
+    A sync parsed once, with cards, loans and holds indexed by card id, library and title id.
+    The same title can be borrowed or held at several libraries, so the title indexes hold lists.
+    """
+    __slots__ = ("raw", "time", "cards", "cards_by_id", "cards_by_library", "loans", "holds",
+                 "loans_by_title", "holds_by_title")
+
+    def __init__(self, sync: dict):
+        self.raw = sync
+        self.time = time.monotonic()
+        self.cards = [SyncCard(c) for c in sync.get("cards", [])]
+        self.cards_by_id = {c.card_id: c for c in self.cards}
+        self.cards_by_library = {}
+        for card in self.cards:
+            self.cards_by_library.setdefault(card.library, []).append(card)
+        self.loans = [SyncEntry(e) for e in sync.get("loans", [])]
+        self.holds = [SyncEntry(e) for e in sync.get("holds", [])]
+        self.loans_by_title = self.index(self.loans)
+        self.holds_by_title = self.index(self.holds)
+
+    @staticmethod
+    def index(entries: list) -> dict:
+        by_title = {}
+        for entry in entries:
+            by_title.setdefault(entry.title_id, []).append(entry)
+        return by_title
+
+    @staticmethod
+    def find(by_title: dict, title_id: str, card_id: str = None) -> dict:
+        return next((e.raw for e in by_title.get(title_id, ()) if card_id is None or e.card_id == card_id), {})
+
+    def get_loan(self, title_id: str, card_id: str = None) -> dict:
+        """
+        The loan of title_id, at card_id if given, else the first one. Empty if there is none.
+        """
+        return self.find(self.loans_by_title, title_id, card_id)
+
+    def get_hold(self, title_id: str, card_id: str = None) -> dict:
+        return self.find(self.holds_by_title, title_id, card_id)
+
+    def get_library(self, card_id: str) -> str:
+        card = self.cards_by_id.get(card_id)
+        return card.library if card else ""
+
+    def get_libraries(self) -> list:
+        return list(self.cards_by_library)
+
+
+def filter_by_type(media_infos: list, type_id: str) -> list:
+    return [m for m in media_infos if m["type"]["id"] == type_id]
+
+
+def get_media_info(title_id: str, timeout: int = 10) -> dict:
+    def fetch() -> dict:
+        with profiler.span("media_info"):
+            return anonymous_session.get(get_media_info_url(title_id), timeout=timeout).json()
+
+    # Media info is the same for everyone, so it's cached for all accounts.
+    return media_info_cache.get_or_fetch(title_id, fetch, should_cache=lambda m: "id" in m)
+
+
+# Thunder's bulk lookups take a limited number of ids, longer lists are split into chunks of this size.
+BULK_CHUNK_SIZE = 24
+# Bulk lookups thunder turned down, they aren't tried again until the next run.
+unsupported_bulk_lookups = set()
+
+
+def fetch_bulk(url: str, timeout: int, what: str) -> list:
+    """
+    One bulk request to thunder. None if it failed, so the caller can fall back to single requests.
+    """
+    if what in unsupported_bulk_lookups:
+        return None
+    try:
+        with profiler.span(f"{what}.bulk"):
+            response = anonymous_session.get(url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"Bulk {what} lookup failed ({e}), getting the titles one at a time.")
+        return None
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        print(f"Bulk {what} lookup isn't supported (HTTP {response.status_code}), getting titles one at a time.")
+        unsupported_bulk_lookups.add(what)
+    return parse_bulk_response(response)
+
+
+def get_media_infos(title_ids: list, timeout: int = 10) -> dict:
+    """
+    Media info of many titles by title id, with one request for each BULK_CHUNK_SIZE titles that aren't cached.
+    Titles the bulk lookup doesn't return are fetched one at a time.
+    """
+    media_infos = {title_id: media_info_cache.get(title_id) for title_id in title_ids}
+    missing = [title_id for title_id, media_info in media_infos.items() if media_info is None]
+    # A single title might as well use the normal lookup.
+    for chunk in get_chunks(missing, BULK_CHUNK_SIZE) if len(missing) > 1 else []:
+        for media_info in fetch_bulk(get_media_bulk_url(chunk), timeout, "media_info") or []:
+            if media_info.get("id") in media_infos:
+                media_info_cache.set(media_info["id"], media_info)
+                media_infos[media_info["id"]] = media_info
+    for title_id, media_info in media_infos.items():
+        if media_info is None:
+            media_infos[title_id] = get_media_info(title_id, timeout=timeout)
+    return media_infos
+
+
+def get_availability(library: str, title_id: str, timeout: int = 10) -> dict:
+    def fetch() -> dict:
+        with profiler.span("availability"):
+            return anonymous_session.get(get_availability_url(library, title_id), timeout=timeout).json()
+
+    return availability_cache.get_or_fetch((library, title_id), fetch,
+                                           should_cache=lambda a: "isAvailable" in a)
+
+
+def get_poll_interval(availability: dict, min_interval: float, max_interval: float) -> float:
+    """
+    Seconds until a watched title should be checked again. Titles that should be available soon are checked
+    often, titles with a long wait rarely. availability can include holdListPosition from our hold.
+    """
+    position = availability.get("holdListPosition")
+    copies = max(int(availability.get("ownedCopies", 1)), 1)
+    if position is not None and int(position) <= copies:
+        # We're next for one of the copies, it can be returned at any moment.
+        return min_interval
+    wait_days = availability.get("estimatedWaitDays")
+    if wait_days is None:
+        return max_interval
+    # About 48 checks over the estimated wait, so a title that should come in a day is checked every half hour.
+    return min(max(float(wait_days) * 24 * 60 * 60 / 48, min_interval), max_interval)
+
+
+def is_book_available(library: str, title_id: str, timeout: int = 10) -> bool:
+    return parse_availability(get_availability(library, title_id, timeout=timeout))
+
+
 def get_authors(media_info: dict, delim=" & ") -> str:
     return delim.join([creator["name"] for creator in media_info["creators"] if creator["role"] == "Author"])
 
@@ -127,6 +1484,71 @@ def get_narrators(media_info: dict, delim=" & ") -> str:
     return delim.join([creator["name"] for creator in media_info["creators"] if creator["role"] == "Narrator"])
 
 
+# Saved with every audiobook, so --retag and --catalog have its metadata without -si or the network.
+BOOK_INFO_FILE = ".pylibby.json"
+
+
+def save_book_info(book_path: str, audiobook_info: dict):
+    """
+    The parts of an opened audiobook needed to tag it again: media info, openbook and where the parts came from.
+    No cookies or tokens.
+    """
+    info = {
+        "media_info": audiobook_info["media_info"],
+        "openbook": audiobook_info["openbook"],
+        "audiobook_urls": {"urls": {"web": audiobook_info["audiobook_urls"]["urls"]["web"]}},
+    }
+    with open(os.path.join(book_path, BOOK_INFO_FILE), "w") as w:
+        w.write(json.dumps(info))
+
+
+# Files we download, other files in the output folder (covers, info.json, ...) are never orphans.
+DOWNLOAD_EXTENSIONS = (".mp3", ".odm", ".acsm", ".epub")
+
+
+# Archived format of audiobook-mp3 loans downloaded as an ODM with -odm, the files are different.
+ODM_FORMAT = "audiobook-mp3-odm"
+
+
+def get_archived_format(entry: dict) -> str:
+    """
+    The format of the files of an archive entry. Entries from older versions have none, then it comes from the files.
+    """
+    if "Format" in entry:
+        return entry["Format"]
+    extensions = {".mp3": "audiobook-mp3", ".odm": ODM_FORMAT, ".acsm": "ebook-epub-adobe", ".epub": "ebook-epub-open"}
+    return next((extensions[os.path.splitext(f)[1].lower()] for f in get_archived_filenames(entry)
+                 if os.path.splitext(f)[1].lower() in extensions), "")
+
+
+def get_archived_filenames(entry: dict) -> list:
+    """
+    The files an archive entry says are on disk.
+    """
+    if "Merged" in entry:
+        return [entry["Merged"]]
+    return entry["Parts"] + [f for f in entry.get("Files", {}) if f not in entry["Parts"]]
+
+
+def get_isbns(media_info: dict, format_id: str = None) -> list:
+    """
+    ISBNs of the given format, or of all formats if format_id is None or the format has none.
+    """
+    def isbns_of(formats):
+        return list(dict.fromkeys(i["value"] for f in formats for i in f.get("identifiers", [])
+                                  if i["type"] == "ISBN"))
+
+    if format_id:
+        isbns = isbns_of(f for f in media_info["formats"] if f["id"] == format_id)
+        if isbns:
+            return isbns
+    return isbns_of(media_info["formats"])
+
+
+# What is left out of the folder name with the year when a book has no publish date. Order is important.
+YEAR_FORMATS = [" [%y] ", "[%y] - ", "[%y] ", "[%y]", "-%y-", " - %y - ", ".%y.", "%y - ", "%y-", "%y.", "%y"]
+
+
 def get_download_path(media_info: dict, format_string="%a/%y - %t", should_replace_space=False) -> str:
     # this takes "%s{/}", and replaces it with "/", but only if the series
     # exists.  We do this to allow for creating subfolders, but only if there is a series.
@@ -136,9 +1558,9 @@ def get_download_path(media_info: dict, format_string="%a/%y - %t", should_repla
         format_string = format_string.replace("%y",
                                               str(compat_datetime_fromisoformat(media_info['publishDate']).year))
     else:
-        # Removing the stuff people usually put around. Maybe we can find a regex for this? Order is important.
+        # Removing the stuff people usually put around. Maybe we can find a regex for this?
         # Maybe make "%y{%y - }" possible instead?
-        for y in [" [%y] ", "[%y] - ", "[%y] ", "[%y]", "-%y-", " - %y - ", ".%y.", "%y - ", "%y-", "%y.", "%y"]:
+        for y in YEAR_FORMATS:
             format_string = format_string.replace(y, "")
     format_string = format_string.replace("%o", media_info['id'])
     format_string = format_string.replace("%p", media_info['publisher']['name'])
@@ -150,10 +1572,9 @@ def get_download_path(media_info: dict, format_string="%a/%y - %t", should_repla
         format_string = re.sub(r"%S\{([^{}]*)\}", "", format_string)
         format_string = format_string.replace("%S", "")
 
-    for f in media_info["formats"]:
-        for i in f["identifiers"]:
-            if i["type"] == "ISBN":
-                format_string = format_string.replace("%i", i['value'])
+    isbns = get_isbns(media_info)
+    if isbns:
+        format_string = format_string.replace("%i", isbns[0])
 
     if "detailedSeries" in media_info:
         format_string = re.sub(r"%s\{([^{}]*)\}", r"\1", format_string)
@@ -177,6 +1598,39 @@ def get_download_path(media_info: dict, format_string="%a/%y - %t", should_repla
         return format_string
 
 
+def get_download_path_regex(format_string="%a/%y - %t", should_replace_space=False) -> re.Pattern:
+    """
+    Compiled regex matching the folders get_download_path makes with format_string, relative to the output folder
+    with / as separator. The title id, author(s) and title are captured as the groups o, a and t if they are in it.
+    """
+    # Books without a publish date have the year left out with what is around it.
+    year = next((y for y in YEAR_FORMATS if y in format_string), None)
+    if year:
+        format_string = format_string.replace(year, f"%y{{{year}}}", 1)
+    named = set()
+
+    def convert(part: str) -> str:
+        regex = ""
+        for token in re.split(r"(%[a-zA-Z]\{[^{}]*\}|%[a-zA-Z])", part):
+            if token.startswith("%") and len(token) > 2:
+                # %s{STRING} and the like are only there for some books.
+                regex += f"(?:{convert(token[3:-1])})?"
+            elif token == "%y":
+                regex += r"\d+"
+            elif token in ["%o", "%a", "%t"] and token[1] not in named:
+                named.add(token[1])
+                regex += r"(?P<o>\d+)" if token == "%o" else rf"(?P<{token[1]}>[^/]+?)"
+            elif token.startswith("%"):
+                regex += r"[^/]*?"
+            elif should_replace_space:
+                regex += re.escape(token).replace(r"\ ", "[ _]")
+            else:
+                regex += re.escape(token)
+        return regex
+
+    return re.compile(convert(format_string))
+
+
 def get_toc_from_audiobook_info(audiobook_info: dict) -> dict:
     toc = {}
 
@@ -221,56 +1675,56 @@ def create_opf(media_info: dict) -> str:
     def html_to_xml(html_string: str) -> str:
         return dicttoxml.escape_xml(html.unescape(html_string))
 
-    opf = """<?xml version='1.0' encoding='utf-8'?>
+    # Lines are collected in a list and joined once, the catalog builds thousands of these.
+    opf = ["""<?xml version='1.0' encoding='utf-8'?>
 <ns0:package xmlns:dc='http://purl.org/dc/elements/1.1/' xmlns:ns0='http://www.idpf.org/2007/opf' unique-identifier='BookId' version='2.0'>
-<ns0:metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">"""
-    opf += f'\n    <dc:title>{html_to_xml(media_info["title"])}</dc:title>'
+<ns0:metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">"""]
+    opf.append(f'    <dc:title>{html_to_xml(media_info["title"])}</dc:title>')
     if "subtitle" in media_info:
-        opf += f'\n    <dc:subtitle>{html_to_xml(media_info["subtitle"])}</dc:subtitle>'
+        opf.append(f'    <dc:subtitle>{html_to_xml(media_info["subtitle"])}</dc:subtitle>')
     if "description" in media_info:
         description = re.sub("<.*?>", "", media_info["description"].replace("<br>", "\n").replace("<BR>", "\n"))
-        opf += f'\n    <dc:description>{html_to_xml(description)}</dc:description>'
+        opf.append(f'    <dc:description>{html_to_xml(description)}</dc:description>')
     for a in get_authors(media_info, delim=",").split(","):
         if a:
-            opf += f'\n    <dc:creator opf:role="aut">{html_to_xml(a)}</dc:creator>'
+            opf.append(f'    <dc:creator opf:role="aut">{html_to_xml(a)}</dc:creator>')
     for n in get_narrators(media_info, delim=",").split(","):
         if n:
-            opf += f'\n    <dc:creator opf:role="nrt">{html_to_xml(n)}</dc:creator>'
+            opf.append(f'    <dc:creator opf:role="nrt">{html_to_xml(n)}</dc:creator>')
     if "publisher" in media_info:
-        opf += f'\n    <dc:publisher>{html_to_xml(media_info["publisher"]["name"])}</dc:publisher>'
+        opf.append(f'    <dc:publisher>{html_to_xml(media_info["publisher"]["name"])}</dc:publisher>')
     if "publishDate" in media_info:
-        opf += f'\n    <dc:date>{media_info["publishDate"]}</dc:date>'
+        opf.append(f'    <dc:date>{media_info["publishDate"]}</dc:date>')
     if "languages" in media_info:
         for lang in media_info["languages"]:
             # Should this be id or name? "en" or "English"?
             # https://www.w3.org/publishing/epub3/epub-packages.html#sec-opf-dclanguage suggests "id"/"en"
             # "The metadata section MUST include at least one language element with a value conforming to [BCP47]."
             # Can there be multiple dc:language, or should multiple languages be separated by "," or maybe "/"?
-            # opf += f'\n    <dc:language>{lang["id"]}</dc:language>'
-            opf += f'\n    <dc:language>{html_to_xml(lang["name"])}</dc:language>'
+            # opf.append(f'    <dc:language>{lang["id"]}</dc:language>')
+            opf.append(f'    <dc:language>{html_to_xml(lang["name"])}</dc:language>')
     if "subjects" in media_info:
         for s in media_info["subjects"]:
-            opf += f'\n    <dc:subject>{html_to_xml(s["name"])}</dc:subject>'
+            opf.append(f'    <dc:subject>{html_to_xml(s["name"])}</dc:subject>')
     if "keywords" in media_info:
         for k in media_info["keywords"]:
-            opf += f'\n    <dc:tag>{html_to_xml(k)}</dc:tag>'
+            opf.append(f'    <dc:tag>{html_to_xml(k)}</dc:tag>')
     if "detailedSeries" in media_info:
         if "seriesName" in media_info["detailedSeries"]:
-            opf += f'\n    <ns0:meta name="calibre:series" content="{html_to_xml(media_info["detailedSeries"]["seriesName"])}"/>'
+            opf.append(f'    <ns0:meta name="calibre:series" content="{html_to_xml(media_info["detailedSeries"]["seriesName"])}"/>')
         if "readingOrder" in media_info["detailedSeries"]:
-            opf += f'\n    <ns0:meta name="calibre:series_index" content="{html_to_xml(media_info["detailedSeries"]["readingOrder"])}"/>'
+            opf.append(f'    <ns0:meta name="calibre:series_index" content="{html_to_xml(media_info["detailedSeries"]["readingOrder"])}"/>')
 
     # Adding overdrive id in case it is ever needed.
     if "id" in media_info:
-        opf += f'\n    <dc:identifier opf:scheme="ODID">{html_to_xml(media_info["id"])}</dc:identifier>'
-    for f in media_info["formats"]:
-        for i in f["identifiers"]:
-            if i["type"] == "ISBN":
-                opf += f'\n    <dc:identifier opf:scheme="ISBN">{html_to_xml(i["value"])}</dc:identifier>'
-                opf += "\n  </ns0:metadata>\n</ns0:package>"
-                return opf
+        opf.append(f'    <dc:identifier opf:scheme="ODID">{html_to_xml(media_info["id"])}</dc:identifier>')
+    # Only the first ISBN.
+    isbn = next(iter(get_isbns(media_info)), None)
+    if isbn is not None:
+        opf.append(f'    <dc:identifier opf:scheme="ISBN">{html_to_xml(isbn)}</dc:identifier>')
+    opf.append("  </ns0:metadata>\n</ns0:package>")
 
-    return opf + "\n  </ns0:metadata>\n</ns0:package>"
+    return "\n".join(opf)
 
 
 def get_formats(media_info: dict) -> list[str]:
@@ -278,13 +1732,7 @@ def get_formats(media_info: dict) -> list[str]:
     return [f["id"] for f in media_info["formats"]]
 
 
-def embed_tag_data(filename: str, toc_entry_for_file: str, audiobook_info: dict, cover_file_path: str):
-    # open file for tag embedding
-    file = MP3(filename)
-    if file.tags is None:
-        file.add_tags()
-    tag = file.tags
-
+def add_book_tags(tag: ID3, audiobook_info: dict, cover_file_path: str):
     # create and add tags
     author = TPE1(text=get_authors(audiobook_info["media_info"], delim="/"))
     tag.add(author)
@@ -320,25 +1768,31 @@ def embed_tag_data(filename: str, toc_entry_for_file: str, audiobook_info: dict,
     language = TXXX(desc="language", text=get_languages(audiobook_info["media_info"]))
     tag.add(language)
 
-    isbn = None
-    for f in audiobook_info["media_info"]["formats"]:
-        for i in f["identifiers"]:
-            if i["type"] == "ISBN":
-                isbn = TXXX(desc="ISBN", text=i['value'])
-    if isbn is not None:
-        tag.add(isbn)
+    isbns = get_isbns(audiobook_info["media_info"])
+    if isbns:
+        tag.add(TXXX(desc="ISBN", text=isbns[-1]))
 
-    overdrive_mediamarkers = TXXX(desc="OverDrive MediaMarkers", text=toc_entry_for_file)
-    tag.add(overdrive_mediamarkers)
+    if cover_file_path:
+        # embed cover
+        with open(cover_file_path, "rb") as f:
+            tag.add(
+                APIC(
+                    encoding=Encoding.UTF8, mime="image/jpeg", type=PictureType.COVER_FRONT,
+                    desc="Cover", data=f.read()
+                )
+            )
 
-    # chapters looks like this: [("chapter title", int(starttime_in_seconds)), ...]
-    chapters = sorted([(m[0].text, convert_timestamp_to_seconds(m[1].text)) for m
-                       in ET.fromstring(toc_entry_for_file).findall("Marker")], key=lambda x: x[1])
+
+def add_chapter_tags(tag: ID3, chapters: list, length: float):
+    # chapters looks like this: [("chapter title", starttime_in_seconds), ...], length is also in seconds
+    # Remove old chapters when retagging, there may have been more of them.
+    tag.delall("CHAP")
+    tag.delall("CTOC")
     chapter_tags = []
     start_time = 0
     for i in range(len(chapters)):
         c = CHAP(element_id=f"Chapter {i}", start_time=start_time,
-                 end_time=chapters[i+1][1]*1000 if len(chapters) > i+1 else int(file.info.length*1000),
+                 end_time=int(chapters[i+1][1]*1000) if len(chapters) > i+1 else int(length*1000),
                  sub_frames=[
                     TIT2(text=chapters[i][0])
                 ])
@@ -355,31 +1809,287 @@ def embed_tag_data(filename: str, toc_entry_for_file: str, audiobook_info: dict,
     for c in chapter_tags:
         tag.add(c)
 
+
+# Markers for a part that has no entry in the table of contents.
+CONTINUED_MARKERS = "<Markers><Marker><Name>(continued)</Name><Time>0:00.000</Time></Marker></Markers>"
+# Stored in every file we tag, so --retag can skip files whose tags are already current.
+TAG_HASH_DESC = "PyLibby Tag Hash"
+# Bump this when the tags we write change, so --retag updates files tagged by older versions.
+TAG_VERSION = 1
+
+
+def get_tag_hash(markers, media_info: dict, cover_file_path: str) -> str:
+    digest = hashlib.sha256(json.dumps([TAG_VERSION, markers, media_info], sort_keys=True).encode())
     if cover_file_path:
-        # embed cover
-        with open(cover_file_path, "rb") as f:
-            tag.add(
-                APIC(
-                    encoding=Encoding.UTF8, mime="image/jpeg", type=PictureType.COVER_FRONT,
-                    desc="Cover", data=f.read()
-                )
-            )
+        digest.update(hash_file(cover_file_path)[1].encode())
+    return digest.hexdigest()
+
+
+def embed_tag_data(filename: str, toc_entry_for_file: str, audiobook_info: dict, cover_file_path: str):
+    # open file for tag embedding
+    file = MP3(filename)
+    if file.tags is None:
+        file.add_tags()
+    tag = file.tags
+
+    add_book_tags(tag, audiobook_info, cover_file_path)
+    tag.add(TXXX(desc=TAG_HASH_DESC,
+                 text=get_tag_hash(toc_entry_for_file, audiobook_info["media_info"], cover_file_path)))
+
+    overdrive_mediamarkers = TXXX(desc="OverDrive MediaMarkers", text=toc_entry_for_file)
+    tag.add(overdrive_mediamarkers)
+
+    chapters = sorted([(m[0].text, convert_timestamp_to_seconds(m[1].text)) for m
+                       in ET.fromstring(toc_entry_for_file).findall("Marker")], key=lambda x: x[1])
+    add_chapter_tags(tag, chapters, file.info.length)
+
+    file.save()
+
+
+# MPEG audio Layer III, which is what OverDrive uses. Bitrates in kbit/s by bitrate index.
+MP3_BITRATES = {
+    "MPEG1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    "MPEG2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Sample rates by version bits and sample rate index.
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def parse_mp3_frame_header(header: bytes) -> tuple:
+    """
+    Returns (frame length, samples per frame, sample rate) of a Layer III frame header, or None if it isn't one.
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 3
+    layer = (header[1] >> 1) & 3
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES["MPEG1" if version == 3 else "MPEG2"][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    samples = 1152 if version == 3 else 576
+    padding = (header[2] >> 1) & 1
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+def get_xing_offset(header: bytes) -> int:
+    # The Xing header comes right after the side information, which depends on version and channels.
+    is_mpeg1 = (header[1] >> 3) & 3 == 3
+    is_mono = header[3] >> 6 == 3
+    return 4 + (17 if is_mono else 32) if is_mpeg1 else 4 + (9 if is_mono else 17)
+
+
+def scan_mp3(file_path: str, block_size: int = 1024 * 1024) -> dict:
+    """
+    Finds the audio frames of an MP3 by reading only the frame headers. ID3 tags, Xing/Info/VBRI frames and
+    anything after the last whole frame are left out.
+    Returns {"Start", "End", "Frames", "Samples", "SampleRate", "Header", "Bitrates"}, Samples is per frame.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as r:
+        head = r.read(10)
+        start = 0
+        if head[:3] == b"ID3" and len(head) == 10:
+            # The tag size is stored as 4 bytes of 7 bits, plus a footer if the flag is set.
+            start = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]) + (10 if head[5] & 0x10 else 0)
+        end = size
+        if size >= 128:
+            r.seek(size - 128)
+            if r.read(3) == b"TAG":
+                end = size - 128
+
+        buffer = b""
+        buffer_start = 0
+
+        def read(position: int, length: int) -> bytes:
+            nonlocal buffer, buffer_start
+            if position < buffer_start or position + length > buffer_start + len(buffer):
+                r.seek(position)
+                buffer = r.read(max(block_size, length))
+                buffer_start = position
+            return buffer[position - buffer_start:position - buffer_start + length]
+
+        # Skip anything before the first frame. Two frames in a row, so a stray 0xFF doesn't count as one.
+        position = start
+        while position + 4 <= end:
+            frame = parse_mp3_frame_header(read(position, 4))
+            if frame and parse_mp3_frame_header(read(position + frame[0], 4)):
+                break
+            position += 1
+        else:
+            raise RuntimeError(f"No MP3 frames found in {file_path}.")
+
+        first_header = read(position, 4)
+        frame_length, samples, sample_rate = parse_mp3_frame_header(first_header)
+        offset = get_xing_offset(first_header)
+        if read(position + offset, 4) in (b"Xing", b"Info") or read(position + 36, 4) == b"VBRI":
+            position += frame_length
+        audio_start = position
+
+        frames = 0
+        bitrates = set()
+        while position + 4 <= end:
+            header = read(position, 4)
+            frame = parse_mp3_frame_header(header)
+            if frame is None or position + frame[0] > end:
+                break
+            if frame[2] != sample_rate:
+                raise RuntimeError(f"Sample rate changes in {file_path}, can't merge it.")
+            bitrates.add(header[2] >> 4)
+            frames += 1
+            position += frame[0]
+
+    return {"Start": audio_start, "End": position, "Frames": frames, "Samples": samples, "SampleRate": sample_rate,
+            "Header": first_header, "Bitrates": bitrates}
+
+
+def create_xing_frame(scans: list) -> bytes:
+    """
+    An empty frame with a Xing header (or Info for constant bitrate) for the frames in scans, so players
+    know the duration and can seek.
+    """
+    first = scans[0]["Header"]
+    # Same version, sample rate and channels as the audio, no CRC, no padding, and big enough for the header.
+    for bitrate_index in range(first[2] >> 4, 15):
+        header = bytes([0xFF, first[1] | 1, (bitrate_index << 4) | (first[2] & 0x0C), first[3]])
+        frame_length = parse_mp3_frame_header(header)[0]
+        if frame_length >= 200:
+            break
+
+    frames = sum(s["Frames"] for s in scans)
+    part_bytes = [s["End"] - s["Start"] for s in scans]
+    total_bytes = frame_length + sum(part_bytes)
+    # Byte position at every percent of the duration, interpolated within each part.
+    toc = []
+    for percent in range(100):
+        target = frames * percent / 100
+        done_frames, done_bytes = 0, frame_length
+        position = total_bytes
+        for scan, size in zip(scans, part_bytes):
+            if target < done_frames + scan["Frames"]:
+                position = done_bytes + (target - done_frames) / scan["Frames"] * size
+                break
+            done_frames += scan["Frames"]
+            done_bytes += size
+        toc.append(min(255, int(position * 256 / total_bytes)))
+
+    is_vbr = len(set().union(*[s["Bitrates"] for s in scans])) > 1
+    # Flags: frames, bytes and TOC are present.
+    xing = (b"Xing" if is_vbr else b"Info") + struct.pack(">III", 0x7, frames, total_bytes) + bytes(toc)
+    offset = get_xing_offset(header)
+    return header + bytes(offset - 4) + xing + bytes(frame_length - offset - len(xing))
+
+
+def merge_mp3_files(file_paths: list, output_path: str, tag: ID3 = None, scans: list = None,
+                    block_size: int = 1024 * 1024):
+    """
+    Concatenates the audio frames of file_paths into one MP3 without re-encoding. The parts' own tags and Xing
+    headers are dropped and replaced by tag and one new Xing header. The files are streamed, not read into memory.
+    """
+    scans = scans or [scan_mp3(p) for p in file_paths]
+    if len({(s["SampleRate"], s["Samples"]) for s in scans}) > 1:
+        raise RuntimeError("The parts have different sample rates, they can't be merged without re-encoding.")
 
+    temp_path = output_path + ".part"
+    try:
+        open(temp_path, "wb").close()
+        if tag is not None:
+            tag.save(temp_path)
+        with open(temp_path, "ab") as w:
+            w.write(create_xing_frame(scans))
+            for file_path, scan in zip(file_paths, scans):
+                with open(file_path, "rb") as r:
+                    r.seek(scan["Start"])
+                    remaining = scan["End"] - scan["Start"]
+                    while remaining > 0:
+                        chunk = r.read(min(block_size, remaining))
+                        if not chunk:
+                            break
+                        w.write(chunk)
+                        remaining -= len(chunk)
+    except BaseException:
+        # Also on Ctrl-C, half a merged file must not be left behind.
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, output_path)
+
+
+def embed_merged_tag_data(filename: str, chapters: list, audiobook_info: dict, cover_file_path: str):
+    """
+    Tags for a file made by --merge. Existing chapters are kept if chapters is None.
+    """
+    file = MP3(filename)
+    if file.tags is None:
+        file.add_tags()
+    add_book_tags(file.tags, audiobook_info, cover_file_path)
+    if chapters is not None:
+        add_chapter_tags(file.tags, chapters, file.info.length)
+    tag_hash = get_tag_hash(get_toc_from_audiobook_info(audiobook_info), audiobook_info["media_info"], cover_file_path)
+    file.tags.add(TXXX(desc=TAG_HASH_DESC, text=tag_hash))
     file.save()
 
 
+def get_merged_chapters(audiobook_info: dict, filenames: list, durations: list) -> list:
+    """
+    Chapters of the whole book as [("chapter title", starttime_in_seconds), ...], with the markers of each part
+    moved by the duration of the parts before it.
+    """
+    markers = get_toc_from_audiobook_info(audiobook_info)
+    chapters = []
+    offset = 0
+    for filename, duration in zip(filenames, durations):
+        if filename in markers:
+            for m in ET.fromstring(markers[filename]).findall("Marker"):
+                # A chapter that continues from the previous part isn't a new chapter in one file.
+                if m[0].text == "(continued)" and chapters:
+                    continue
+                minutes, seconds = m[1].text.split(":")
+                chapters.append((m[0].text, offset + int(minutes) * 60 + float(seconds)))
+        offset += duration
+    return sorted(chapters, key=lambda x: x[1])
+
+
 class Libby:
     id_path: str
     archive: dict
 
-    def __init__(self, id_path: str, archive_path: str = "", code: str = None, timeout: int = 10, max_retries: int = 0):
+    def __init__(self, id_path: str, archive_path: str = "", code: str = None, timeout: int = 10, max_retries: int = 0,
+                 part_delay: float = 2, open_cache_path: str = "", open_cache_ttl: float = 6 * 60 * 60,
+                 http2: bool = False, part_workers: int = 1, min_free_space: int = 100 * 1000 * 1000,
+                 duplicates: str = "download"):
         self.id_path = id_path
+        # The last sync parsed, reused for lookups until it's older than sync_max_age seconds or we change
+        # something with borrow, return, hold or cancel.
+        self.sync_state = None
+        self.sync_max_age = 60
+        # What to do with a loan whose ISBN we already downloaded from another library: download, skip or link.
+        self.duplicates = duplicates
+        # Bytes that have to be left free on the disk after downloading a book.
+        self.min_free_space = min_free_space
+        # Upper bound for the random pause between downloaded parts (seconds).
+        self.part_delay = part_delay
+        # How many parts of a book to download at the same time, best used with http2.
+        self.part_workers = part_workers
+        # Folder for opened audiobooks (openbook, urls and cookies), so resuming a download doesn't open it again.
+        self.open_cache_path = open_cache_path
+        self.open_cache_ttl = open_cache_ttl
 
         http_session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(total=max_retries, backoff_factor=0.1))
-        http_session.mount("http://", adapter)
-        http_session.mount("https://", adapter)
+        adapter_class = HTTP2Adapter if http2 else LibbyHTTPAdapter
+        mount_adapter(http_session, adapter_class(max_retries=CountingRetry(total=max_retries, backoff_factor=0.1)))
+        http_session.hooks["response"].append(http_tracer.hook)
+        http_session.hooks["response"].append(metrics.hook)
         self.http_session = http_session
+        # For requests that can run alongside others, like media info while opening a book.
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        # Books opened ahead of time. A separate single thread, so a prefetch never waits for a slot in the
+        # executor it is using itself.
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        self.prefetched = {}
+        self.prefetch_lock = threading.Lock()
         self.archive_path = archive_path
         self.timeout = timeout
 
@@ -432,42 +2142,26 @@ class Libby:
 
     def borrow_book(self, title_id: str, card_id: str, days: int = 21) -> dict:
         media_info = get_media_info(title_id, timeout=self.timeout)
-        j = {
-            "period": days,
-            "units": "days",
-            "lucky_day": None,
-            "title_format": media_info["type"]["id"]
-        }
-
-        url = f"https://sentry-read.svc.overdrive.com/card/{card_id}/loan/{title_id}"
-        resp = self.http_session.post(url, json=j, timeout=self.timeout)
-        if resp.status_code != 200:
-            raise RuntimeError(f"Couldn't borrow book: {resp.json()}, you may need to verify your card in the app.")
+        j = create_borrow_json(media_info, days)
+        resp = self.http_session.post(get_loan_url(card_id, title_id), json=j, timeout=self.timeout)
+        self.sync_state = None
+        check_sentry_response(resp, "borrow book")
         return resp.json()
 
     def hold_book(self, title_id: str, card_id: str) -> dict:
-        sync = self.get_sync()
-        for card in sync["cards"]:
-            if is_book_available(card["advantageKey"], title_id, timeout=self.timeout):
-                print(f"Book available at {card['advantageKey']}. Not creating hold.")
-                return {}
-        for loan in sync["loans"]:
-            if loan["id"] == title_id:
-                print(f"Book already borrowed. Not creating hold.")
-                return {}
-        for hold in sync["holds"]:
-            if hold["id"] == title_id:
-                print(f"Book already on hold. Not creating hold.")
-                return {}
-
-        j = {
-            "days_to_suspend": 0,
-            "email_address": ""
-        }
-        url = f"https://sentry-read.svc.overdrive.com/card/{card_id}/hold/{title_id}"
-        resp = self.http_session.post(url, json=j, timeout=self.timeout)
-        if resp.status_code != 200:
-            raise RuntimeError(f"Couldn't hold book: {resp.json()}, you may need to verify your card in the app.")
+        state = self.get_sync_state()
+        if title_id in state.loans_by_title:
+            print(f"Book already borrowed. Not creating hold.")
+            return {}
+        if title_id in state.holds_by_title:
+            print(f"Book already on hold. Not creating hold.")
+            return {}
+        if self.is_book_available_in_any_logged_in_library(title_id):
+            return {}
+
+        resp = self.http_session.post(get_hold_url(card_id, title_id), json=create_hold_json(), timeout=self.timeout)
+        self.sync_state = None
+        check_sentry_response(resp, "hold book")
         return resp.json()
 
     def cancel_hold(self, title_id: str, card_id: str = None):
@@ -479,29 +2173,30 @@ class Libby:
         if not card_id:
             raise RuntimeError("Couldn't find cardId on hold or couldn't find hold at all, can't cancel it.")
 
-        url = f"https://sentry-read.svc.overdrive.com/card/{card_id}/hold/{title_id}"
-        resp = self.http_session.delete(url, timeout=self.timeout)
-        if resp.status_code != 200:
-            raise RuntimeError(f"Couldn't cancel hold on book: {resp.json()}, you may need to verify your card in the app.")
-
-    def hold_book_on_library_with_shortest_wait_time(self, title_id: str) -> dict:
+        resp = self.http_session.delete(get_hold_url(card_id, title_id), timeout=self.timeout)
+        self.sync_state = None
+        check_sentry_response(resp, "cancel hold on book")
+
+    def hold_book_on_library_with_shortest_wait_time(self, title_id: str, availabilities: dict = None) -> dict:
+        """
+        availabilities is the title's availability by library, if it was already looked up.
+        """
+        state = self.get_sync_state()
+        if title_id in state.loans_by_title:
+            print(f"Book already borrowed. Not creating hold.")
+            return {}
+        if title_id in state.holds_by_title:
+            print(f"Book already on hold. Not creating hold.")
+            return {}
+        by_library = availabilities or self.get_title_availabilities(title_id)
         availabilities = []
-        sync = self.get_sync()
-        for loan in sync["loans"]:
-            if loan["id"] == title_id:
-                print(f"Book already borrowed. Not creating hold.")
-                return {}
-        for hold in sync["holds"]:
-            if hold["id"] == title_id:
-                print(f"Book already on hold. Not creating hold.")
+        for card in state.cards:
+            a = dict(by_library[card.library])
+            if parse_availability(a):
+                print(f"Book available at {card.library}. Not creating hold.")
                 return {}
-        for card in sync["cards"]:
-            if is_book_available(card["advantageKey"], title_id, timeout=self.timeout):
-                print(f"Book available at {card['advantageKey']}. Not creating hold.")
-                return {}
-            a = requests.get(f"https://thunder.api.overdrive.com/v2/libraries/{card['advantageKey']}/media/{title_id}/availability", timeout=self.timeout).json()
-            a["cardId"] = card['cardId'] # Add back the cardId so we can find it later
-            a["library"] = card['advantageKey'] # Add back library so we can find it later
+            a["cardId"] = card.card_id # Add back the cardId so we can find it later
+            a["library"] = card.library # Add back library so we can find it later
             availabilities.append(a)
 
         try:
@@ -517,43 +2212,158 @@ class Libby:
 
         return {}
 
-    def borrow_book_on_any_logged_in_library(self, title_id: str, days: int = 21) -> dict:
-        for card in self.get_sync()["cards"]:
-            if int(card["counts"]["loan"]) >= int(card["limits"]["loan"]):
-                print(f"Card {card['cardId']} at {card['advantageKey']} is at its limit, skipping.")
-            elif is_book_available(card["advantageKey"], title_id, timeout=self.timeout):
-                print(f"Book available at {card['advantageKey']}.")
-                return self.borrow_book(title_id, card["cardId"], days)
+    def borrow_book_on_any_logged_in_library(self, title_id: str, days: int = 21, availabilities: dict = None) -> dict:
+        """
+        availabilities is the title's availability by library, if it was already looked up.
+        """
+        availabilities = availabilities or self.get_title_availabilities(title_id)
+        for card in self.get_sync_state().cards:
+            if card.is_at_loan_limit():
+                print(f"Card {card.card_id} at {card.library} is at its limit, skipping.")
+            elif parse_availability(availabilities[card.library]):
+                print(f"Book available at {card.library}.")
+                return self.borrow_book(title_id, card.card_id, days)
             else:
-                print(f"Book not available at {card['advantageKey']}.")
+                print(f"Book not available at {card.library}.")
         print("Book not available at any of your libraries.")
         return {}
 
+    def watch_holds(self, title_ids: list = None, days: int = 21, min_interval: float = 60,
+                    max_interval: float = 60 * 60) -> list:
+        """
+        Borrow each of title_ids, or every title we have on hold if empty, as soon as a copy is available at
+        any of our libraries. Each title is checked at its own rate, see get_poll_interval. Sync is only
+        refreshed every max_interval and after borrowing. Returns the new loans.
+        """
+        state = self.get_sync_state()
+        title_ids = list(dict.fromkeys(title_ids or state.holds_by_title))
+        for title_id in title_ids:
+            if title_id in state.loans_by_title:
+                print(f"{title_id} is already borrowed, not watching it.")
+        queue = [(time.monotonic(), title_id) for title_id in title_ids if title_id not in state.loans_by_title]
+        heapq.heapify(queue)
+        if queue:
+            print(f"Watching {len(queue)} titles at {len(state.cards)} cards.")
+
+        loans = []
+        failures = 0
+        while queue:
+            due, title_id = heapq.heappop(queue)
+            time.sleep(max(due - time.monotonic(), 0))
+            # Everything else that is due now is checked at the same time.
+            title_ids = [title_id]
+            while queue and queue[0][0] <= time.monotonic():
+                title_ids.append(heapq.heappop(queue)[1])
+            try:
+                if time.monotonic() - state.time >= max_interval:
+                    self.get_sync()
+                    state = self.sync_state
+                availabilities = self.get_availabilities(title_ids)
+                metrics.inc("pylibby_watch_polls_total", len(title_ids) * len(availabilities))
+                while title_ids:
+                    interval, loan = self.borrow_watched_title(
+                        title_ids[0], state, {library: a[title_ids[0]] for library, a in availabilities.items()},
+                        days, min_interval, max_interval)
+                    if loan:
+                        loans.append(loan)
+                        # Loan counts changed.
+                        state = self.get_sync_state()
+                    else:
+                        heapq.heappush(queue, (time.monotonic() + interval, title_ids[0]))
+                    title_ids.pop(0)
+                failures = 0
+            except requests.exceptions.RequestException as e:
+                # Also when a circuit breaker is open. The network comes back, the watch has to keep going.
+                failures += 1
+                backoff = min(max_interval, min_interval * 2 ** (failures - 1)) * random.uniform(0.9, 1.1)
+                print(f"Checking {len(title_ids)} titles failed ({e}), trying again in {round(backoff)} seconds.")
+                metrics.inc("pylibby_watch_errors_total")
+                for title_id in title_ids:
+                    heapq.heappush(queue, (time.monotonic() + backoff, title_id))
+        return loans
+
+    def get_availabilities(self, title_ids: list) -> dict:
+        """
+        Availability of the titles at each of our libraries, {library: {title_id: availability}}.
+        Thunder has no bulk availability lookup, so all titles at all libraries are looked up at the same time.
+        """
+        libraries = self.get_sync_state().get_libraries()
+        lookups = [(library, title_id) for library in libraries for title_id in title_ids]
+        availabilities = {library: {} for library in libraries}
+        for (library, title_id), availability in zip(lookups, self.executor.map(
+                lambda lookup: get_availability(*lookup, timeout=self.timeout), lookups)):
+            availabilities[library][title_id] = availability
+        return availabilities
+
+    def get_title_availabilities(self, title_id: str) -> dict:
+        """
+        Availability of one title at each of our libraries, {library: availability}.
+        """
+        return {library: a[title_id] for library, a in self.get_availabilities([title_id]).items()}
+
+    def borrow_watched_title(self, title_id: str, state: SyncState, availabilities: dict, days: int,
+                             min_interval: float, max_interval: float) -> tuple[float, dict]:
+        """
+        Borrow a watched title at the first of our libraries where it's available, availabilities is by library.
+        Returns the seconds until the next check and the loan, which is empty if it wasn't borrowed.
+        """
+        interval = max_interval
+        for card in state.cards:
+            availability = dict(availabilities[card.library])
+            hold = state.get_hold(title_id, card.card_id)
+            # A hold that is ready is kept for us even though the library has no copies for anyone else.
+            if parse_availability(availability) or hold.get("isAvailable"):
+                if card.is_at_loan_limit():
+                    print(f"{title_id} is available at {card.library}, but card {card.card_id} is at its limit.")
+                else:
+                    try:
+                        loan = self.borrow_book(title_id, card.card_id, days)
+                        print(f"Book borrowed: {title_id} at {card.library}.")
+                        metrics.inc("pylibby_watch_borrows_total")
+                        return 0, loan
+                    except RuntimeError as e:
+                        # Someone else got the copy first.
+                        print(e)
+                interval = min_interval
+            availability.update({k: hold[k] for k in ["holdListPosition", "estimatedWaitDays"] if k in hold})
+            interval = min(interval, get_poll_interval(availability, min_interval, max_interval))
+
+        # So titles that were added together don't keep getting checked together.
+        return interval * random.uniform(0.9, 1.1), {}
+
     def return_book(self, title_id: str, card_id: str = None):
         if not card_id:
-            loans = self.get_loans()
-            for loan in loans:
-                if loan["id"] == title_id:
-                    card_id = loan["cardId"]
-                    break
+            card_id = self.get_loan(title_id).get("cardId")
 
         if not card_id:
             raise RuntimeError("Couldn't find cardId on loan or couldn't find loan at all, can't return it.")
 
-        url = f"https://sentry-read.svc.overdrive.com/card/{card_id}/loan/{title_id}"
-        resp = self.http_session.delete(url, timeout=self.timeout)
-        if resp.status_code != 200:
-            raise RuntimeError(f"Couldn't return book: {resp.json()}, you may need to verify your card in the app.")
+        resp = self.http_session.delete(get_loan_url(card_id, title_id), timeout=self.timeout)
+        self.sync_state = None
+        check_sentry_response(resp, "return book")
 
     def get_sync(self) -> dict:
-        return self.http_session.get("https://sentry-read.svc.overdrive.com/chip/sync", timeout=self.timeout).json()
+        with profiler.span("sync"):
+            sync = self.http_session.get(get_sync_url(), timeout=self.timeout).json()
+        self.sync_state = SyncState(sync)
+        return sync
+
+    def get_sync_state(self) -> SyncState:
+        """
+        The last sync, parsed. Syncs again if there is none that is new enough.
+        """
+        state = self.sync_state
+        if state is None or time.monotonic() - state.time > self.sync_max_age:
+            self.get_sync()
+            state = self.sync_state
+        return state
 
     def get_loans(self) -> list:
         return self.get_sync()["loans"]
 
     def get_chip(self) -> dict:
         response = self.http_session.post(
-            "https://sentry-read.svc.overdrive.com/chip", params={"client": "dewey"}, timeout=self.timeout).json()
+            get_chip_url(), params={"client": "dewey"}, timeout=self.timeout).json()
         self.http_session.headers.update({'Authorization': f'Bearer {response["identity"]}'})
         with open(self.id_path, "w") as w:
             w.write(json.dumps(response, indent=4, sort_keys=True))
@@ -562,70 +2372,198 @@ class Libby:
 
     def clone_by_code(self, code: str) -> dict:
         resp = self.http_session.post(
-            "https://sentry-read.svc.overdrive.com/chip/clone/code", data={"code": code}, timeout=self.timeout)
+            get_clone_by_code_url(), data={"code": code}, timeout=self.timeout)
         self.get_chip()
         return resp.json()
 
     def have_loan(self, title_id: str) -> bool:
-        return any(loan for loan in self.get_sync()["loans"] if loan["id"] == title_id)
+        return title_id in self.get_sync_state().loans_by_title
 
-    def get_loan(self, title_id: str) -> dict:
-        return next((loan for loan in self.get_sync()["loans"] if loan["id"] == title_id), {})
+    def get_loan(self, title_id: str, card_id: str = None) -> dict:
+        return self.get_sync_state().get_loan(title_id, card_id)
 
     def have_hold(self, title_id: str) -> bool:
-        return any(hold for hold in self.get_sync()["holds"] if hold["id"] == title_id)
+        return title_id in self.get_sync_state().holds_by_title
 
-    def get_hold(self, title_id: str) -> dict:
-        return next((hold for hold in self.get_sync()["holds"] if hold["id"] == title_id), {})
+    def get_hold(self, title_id: str, card_id: str = None) -> dict:
+        return self.get_sync_state().get_hold(title_id, card_id)
 
-    def open_audiobook(self, card_id: str, title_id: str) -> dict:
-        loan = self.get_loan(title_id)
+    def open_audiobook(self, card_id: str, title_id: str, loan: dict = None) -> dict:
+        # Media info only needs the title id, so get it while we talk to sentry and the CDN.
+        media_info_future = self.executor.submit(get_media_info, title_id, self.timeout)
+
+        # No need for a full sync if we were given the loan.
+        if not loan:
+            with profiler.span("open.get_loan"):
+                loan = self.get_loan(title_id, card_id)
         if not loan:
             raise RuntimeError("Can't open a book if it is not checked out.")
 
-        url = f"https://sentry-read.svc.overdrive.com/open/{'audiobook' if loan['type']['id'] == 'audiobook' else 'book'}/card/{card_id}/title/{title_id}"
-        audiobook = self.http_session.get(url, timeout=self.timeout).json()
-        message = audiobook["message"]
+        with profiler.span("open.open"):
+            audiobook = self.http_session.get(get_open_url(loan, card_id, title_id), timeout=self.timeout).json()
         openbook_url = audiobook["urls"]["openbook"]
 
         # THIS IS IMPORTANT
-        old_headers = self.http_session.headers
-        self.http_session.headers = None
+        # The web URL has to be requested without any of our headers. Setting a header to None removes it
+        # for this request only, so the session can still be used from other threads.
+        no_headers = {k: None for k in self.http_session.headers}
         # We need this to set a cookie for us
-        web_url_with_message = audiobook["urls"]["web"] + "?" + message
-        self.http_session.get(web_url_with_message, timeout=self.timeout)
-
-        self.http_session.headers = old_headers
+        with profiler.span("open.cookie"):
+            response = self.http_session.get(get_web_url_with_message(audiobook), headers=no_headers,
+                                             timeout=self.timeout)
+        # Keep the cookies for this book, the session's cookies are overwritten when the next book is opened.
+        cookies = get_cookies([r.cookies for r in response.history + [response]])
+
+        with profiler.span("open.openbook"):
+            openbook = self.http_session.get(openbook_url, cookies=create_cookie_jar(cookies),
+                                             timeout=self.timeout).json()
+        with profiler.span("open.media_info"):
+            media_info = media_info_future.result()
 
         return {
                 "audiobook_urls": audiobook,
-                "openbook":  self.http_session.get(openbook_url, timeout=self.timeout).json(),
-                "media_info": get_media_info(title_id, timeout=self.timeout)
+                "openbook": openbook,
+                "media_info": media_info,
+                "cookies": cookies
                 }
 
+    def get_open_cache_file(self, loan: dict) -> str:
+        # By card as well, the cookies belong to the account that borrowed the book.
+        return os.path.join(self.open_cache_path, f"{loan['cardId']}-{loan['id']}.json")
+
+    def load_open_cache(self, loan: dict) -> dict:
+        if not self.open_cache_path or not os.path.isfile(self.get_open_cache_file(loan)):
+            return {}
+        try:
+            with open(self.get_open_cache_file(loan), "r") as r:
+                cached = json.loads(r.read())
+        except (OSError, ValueError):
+            return {}
+        if cached.get("Expires", 0) <= time.time():
+            self.remove_open_cache(loan)
+            return {}
+        return cached["AudiobookInfo"]
+
+    def save_open_cache(self, loan: dict, audiobook_info: dict):
+        if not self.open_cache_path:
+            return
+        # Valid until the first of our own limit, the cookies or the loan expires.
+        expires = [time.time() + self.open_cache_ttl]
+        expires += [c["expires"] for c in audiobook_info["cookies"] if c["expires"]]
+        if "expireDate" in loan:
+            expires.append(compat_datetime_fromisoformat(loan["expireDate"]).timestamp())
+        os.makedirs(self.open_cache_path, exist_ok=True)
+        # Only readable by us since it has the cookies, and renamed into place so it's never half written.
+        cache_file = self.get_open_cache_file(loan)
+        with open(os.open(cache_file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as w:
+            w.write(json.dumps({"Expires": min(expires), "AudiobookInfo": audiobook_info}))
+        os.replace(cache_file + ".tmp", cache_file)
+
+    def remove_open_cache(self, loan: dict):
+        if self.open_cache_path and os.path.isfile(self.get_open_cache_file(loan)):
+            os.remove(self.get_open_cache_file(loan))
+
+    def open_audiobook_cached(self, loan: dict) -> tuple[dict, bool]:
+        """
+        Returns the opened audiobook from the open cache if we have it, else opens it and stores it there.
+        The second value is True if it came from the cache.
+        """
+        audiobook_info = self.load_open_cache(loan)
+        if audiobook_info:
+            print(f"Using cached openbook for {loan['id']}.")
+            return audiobook_info, True
+        audiobook_info = self.open_audiobook(loan["cardId"], loan["id"], loan)
+        self.save_open_cache(loan, audiobook_info)
+        return audiobook_info, False
+
+    def prefetch_audiobook(self, loan: dict):
+        """
+        Start opening an audiobook in the background, download_audiobook_mp3 picks up the result.
+        """
+        with self.prefetch_lock:
+            if loan["id"] not in self.prefetched:
+                self.prefetched[loan["id"]] = self.prefetch_executor.submit(self.open_audiobook_cached, loan)
+
+    def drop_prefetch(self, loan: dict):
+        """
+        Forget a prefetch that won't be used, it is cancelled if it hasn't started yet.
+        """
+        with self.prefetch_lock:
+            future = self.prefetched.pop(loan["id"], None)
+        if future:
+            future.cancel()
+
+    def will_be_downloaded(self, loan: dict, format_id: str, should_get_odm: bool = False) -> bool:
+        """
+        False if download_loan is going to skip the loan as a duplicate, so it isn't worth opening ahead of time.
+        """
+        if self.duplicates == "download":
+            return True
+        media_info = media_info_cache.get(loan["id"])
+        # The same check as download_loan, so both agree on which books are duplicates.
+        return not (media_info and self.find_duplicate(media_info, format_id, should_get_odm))
+
+    def close(self):
+        """
+        Stop the background threads, the Libby can't download or look up availability in parallel afterwards.
+        """
+        self.prefetch_executor.shutdown(cancel_futures=True)
+        self.executor.shutdown(cancel_futures=True)
+
+    def get_opened_audiobook(self, loan: dict) -> tuple[dict, bool]:
+        with self.prefetch_lock:
+            future = self.prefetched.pop(loan["id"], None)
+        if future:
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"Prefetching {loan['id']} failed ({e}), opening it again.")
+        return self.open_audiobook_cached(loan)
+
+    def get_part_sizes(self, audiobook_info: dict, download_urls: list, cookie_jar: RequestsCookieJar) -> dict:
+        """
+        Expected size of each part by filename, from the openbook or else a HEAD request. 0 if unknown.
+        """
+        spine = {get_filename_from_url(url): s for url, s in
+                 zip(get_download_urls(audiobook_info), audiobook_info["openbook"]["spine"])}
+
+        def get_size(download_url: str) -> int:
+            size = spine.get(get_filename_from_url(download_url), {}).get("-odread-file-bytes")
+            if not size:
+                resp = self.http_session.head(download_url, cookies=cookie_jar, timeout=self.timeout,
+                                              allow_redirects=True)
+                size = resp.headers.get("Content-Length", 0) if resp.status_code == 200 else 0
+            return int(size)
+
+        # The HEAD requests go out at the same time, one after another they can take longer than the first part.
+        return dict(zip(map(get_filename_from_url, download_urls), self.executor.map(get_size, download_urls)))
+
     def is_book_available_in_any_logged_in_library(self, title_id: str) -> str:
-        for card in self.get_sync()["cards"]:
-            if is_book_available(card["advantageKey"], title_id, timeout=self.timeout):
-                print(f"Book available at {card['advantageKey']}. Not creating hold.")
-                return card["advantageKey"]
+        for library, availability in self.get_title_availabilities(title_id).items():
+            if parse_availability(availability):
+                print(f"Book available at {library}. Not creating hold.")
+                return library
 
     def search_for_book_in_logged_in_libraries(self, query: str) -> list:
         # TODO: make this more readable
-        return requests.get(f"https://thunder.api.overdrive.com/v2/media/search?libraryKey={'libraryKey='.join([card['advantageKey'] + '&' for card in self.get_sync()['cards']])}query={query}", timeout=self.timeout).json()
+        with profiler.span("search"):
+            libraries = self.get_sync_state().get_libraries()
+            return anonymous_session.get(get_search_url(libraries, query), timeout=self.timeout).json()
 
     def search_for_audiobook_in_logged_in_libraries(self, query: str) -> list:
-        return [h for h in self.search_for_book_in_logged_in_libraries(query) if h["type"]["id"] == "audiobook"]
+        return filter_by_type(self.search_for_book_in_logged_in_libraries(query), "audiobook")
 
     def search_for_ebook_in_logged_in_libraries(self, query: str) -> list:
-        return [h for h in self.search_for_book_in_logged_in_libraries(query) if h["type"]["id"] == "ebook"]
+        return filter_by_type(self.search_for_book_in_logged_in_libraries(query), "ebook")
 
 
     def download_audiobook_mp3(self, loan: dict, output_path: str, format_string,
                                callback_functions: list[Callable[[str, int], None]] = None,
                                should_save_info=False, should_download_cover=True, should_embed_metadata=False,
-                               should_replace_space=False, should_create_opf=False):
+                               should_replace_space=False, should_create_opf=False, should_merge=False):
         # Workaround for getting audiobook without ODM
-        audiobook_info = self.open_audiobook(loan["cardId"], loan["id"])
+        with profiler.span("open"):
+            audiobook_info, is_cached = self.get_opened_audiobook(loan)
         if not os.path.exists(output_path):
             raise RuntimeError(f"Path does not exist: {output_path}")
 
@@ -644,12 +2582,15 @@ class Libby:
 
         if should_save_info:
             with open(os.path.join(final_path, "info.json"), "w") as w:
-                w.write(json.dumps(audiobook_info, indent=4))
+                # Cookies are only valid for a while, and nobody else should have them.
+                w.write(json.dumps({k: v for k, v in audiobook_info.items() if k != "cookies"}, indent=4))
                 print("Wrote info.json.")
+        save_book_info(final_path, audiobook_info)
 
         cover_file_path = ""
         if should_download_cover:
-            cover_file_path = download_cover(loan, final_path, self.timeout)
+            with profiler.span("download.cover"):
+                cover_file_path = download_cover(loan, final_path, self.timeout)
             print("Downloaded cover.")
 
         if should_create_opf:
@@ -657,20 +2598,52 @@ class Libby:
                 w.write(create_opf(audiobook_info["media_info"]))
                 print("Wrote metadata.opf.")
 
-        download_urls = [audiobook_info["audiobook_urls"]["urls"]["web"] + s["path"] for s in audiobook_info["openbook"]["spine"]]
+        download_urls = get_download_urls(audiobook_info)
+        cookie_jar = create_cookie_jar(audiobook_info["cookies"])
 
         filenames = [get_filename_from_url(url) for url in download_urls]
+        # Only one part reopens the book if the cached cookies are rejected, the others wait for it.
+        reopen_lock = threading.Lock()
 
-        for download_url in download_urls:
+        def get_part(download_url: str) -> requests.Response:
+            nonlocal audiobook_info, is_cached, cookie_jar
+            filename = get_filename_from_url(download_url)
+            used_jar = cookie_jar
+            resp = self.http_session.get(download_url, cookies=used_jar, timeout=self.timeout, stream=True)
+            if resp.status_code in (401, 403) and is_cached:
+                resp.close()
+                with reopen_lock:
+                    if cookie_jar is used_jar:
+                        # The CDN doesn't accept the cached cookie anymore, open the book again.
+                        print(f"Cached openbook for {loan['id']} was rejected, opening it again.")
+                        self.remove_open_cache(loan)
+                        with profiler.span("open"):
+                            audiobook_info, is_cached = self.open_audiobook_cached(loan)
+                        cookie_jar = create_cookie_jar(audiobook_info["cookies"])
+                download_url = next(url for url in get_download_urls(audiobook_info)
+                                    if get_filename_from_url(url) == filename)
+                resp = self.http_session.get(download_url, cookies=cookie_jar, timeout=self.timeout, stream=True)
+            if resp.status_code != 200:
+                raise RuntimeError(f"Couldn't download {filename}: HTTP {resp.status_code}.")
+            return resp
+
+        def download_part(download_url: str):
             filename = get_filename_from_url(download_url)
-            if self.should_download(loan["id"], filename):
-                resp = self.http_session.get(download_url, timeout=self.timeout, stream=True)
+            with profiler.span("bandwidth.pause"):
+                bandwidth_limiter.wait_for_window()
+            with profiler.span("download.part"):
+                resp = get_part(download_url)
                 with open(os.path.join(final_path, filename), "wb") as w:
+                    preallocate_file(w.fileno(), part_sizes.get(filename, 0))
+                    # Hash while streaming so we don't have to read the file again.
+                    digest = hashlib.sha256()
                     downloaded = 0
                     mb = 0
-                    for chunk in resp.iter_content(1024):
+                    for chunk in resp.iter_content(256 * 1024):
+                        bandwidth_limiter.consume(len(chunk))
                         w.write(chunk)
-                        downloaded += 1024
+                        digest.update(chunk)
+                        downloaded += len(chunk)
                         if downloaded > 1024 * 1000:
                             mb += 1
                             downloaded = 0
@@ -679,25 +2652,138 @@ class Libby:
                                     f(filename, mb)
                             else:
                                 print(f"{filename}: Downloaded {mb}MB.")
-                if should_embed_metadata:
+                    size = w.tell()
+                    # The expected size can be off, don't leave preallocated space at the end.
+                    w.truncate()
+                    metrics.inc("pylibby_downloaded_bytes_total", size, endpoint="cdn")
+            metrics.inc("pylibby_parts_downloaded_total")
+            sha256 = digest.hexdigest()
+            if should_embed_metadata:
+                with profiler.span("embed_tag_data"):
                     if filename in tocout:
                         embed_tag_data(os.path.join(final_path, filename), tocout[filename], audiobook_info, cover_file_path)
                         print(f"Embedded tags in {filename}.")
                     else:
-                        embed_tag_data(os.path.join(final_path, filename), "<Markers><Marker><Name>(continued)</Name><Time>0:00.000</Time></Marker></Markers>", audiobook_info, cover_file_path)
+                        embed_tag_data(os.path.join(final_path, filename), CONTINUED_MARKERS, audiobook_info, cover_file_path)
                         print("no toc to embed, generated (continued) chapter marker, and embedded it.")
-
-                time.sleep(random.random() * 2)
-
-                self.add_to_archive(loan["id"], filename, loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None)
+                # Tagging rewrote the file, the hash has to match what's on disk.
+                size, sha256 = hash_file(os.path.join(final_path, filename))
+
+            with profiler.span("sleep"):
+                delay = random.random() * self.part_delay
+                time.sleep(delay)
+                metrics.inc("pylibby_part_delay_seconds_total", delay)
+
+            self.add_to_archive(loan["id"], filename, loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None,
+                                path=final_path, size=size, sha256=sha256,
+                                isbns=get_isbns(audiobook_info["media_info"], "audiobook-mp3"), format_id="audiobook-mp3")
+
+        missing_urls = [url for url in download_urls if self.should_download(loan["id"], get_filename_from_url(url))]
+
+        with profiler.span("download.preflight"):
+            part_sizes = self.get_part_sizes(audiobook_info, missing_urls, cookie_jar)
+            required = self.min_free_space
+            for filename, size in part_sizes.items():
+                required += size
+                # Tagging puts the cover in every part.
+                if should_embed_metadata and cover_file_path:
+                    required += os.path.getsize(cover_file_path)
+                # Parts that were partly downloaded are overwritten.
+                if os.path.isfile(os.path.join(final_path, filename)):
+                    required -= os.path.getsize(os.path.join(final_path, filename))
+            title = loan["title"] if "title" in loan else audiobook_info["media_info"].get("title")
+            check_free_space(final_path, required, f"{loan['id']} - {title}")
+        if self.part_workers > 1:
+            # With HTTP/2 these all share one connection to the CDN.
+            with ThreadPoolExecutor(max_workers=self.part_workers) as part_executor:
+                list(part_executor.map(download_part, missing_urls))
+        else:
+            for download_url in missing_urls:
+                download_part(download_url)
 
         # If is finished, store it in archive. is_downloaded will wite Finished=True if completely downloaded.
-        if self.is_downloaded(loan["id"], filenames):
+        is_finished = self.is_downloaded(loan["id"], filenames)
+        if is_finished:
             print(f"Finished downloading {loan['id']} and stored it in archive.")
+            self.remove_open_cache(loan)
+        # Without an archive is_downloaded doesn't know, then the files on disk decide.
+        if should_merge and (is_finished or not self.archive_path) and \
+                all(os.path.isfile(os.path.join(final_path, f)) for f in filenames):
+            self.merge_audiobook(loan["id"], final_path, filenames, audiobook_info,
+                                 cover_file_path if should_embed_metadata else "", should_embed_metadata)
+
+    def needs_merge(self, title_id: str) -> bool:
+        """
+        True if the archive has the book as finished but not merged, with all of its parts on disk.
+        """
+        with archive_lock:
+            self.load_archive()
+            entry = self.archive.get(title_id, {})
+        return bool(entry.get("Finished") and "Merged" not in entry and "Path" in entry and entry["Parts"]) and \
+            all(f.lower().endswith(".mp3") and os.path.isfile(os.path.join(entry["Path"], f)) for f in entry["Parts"])
+
+    def merge_downloaded_audiobook(self, loan: dict, should_embed_metadata: bool = False) -> str:
+        """
+        Merge a book that was downloaded before --merge was used. The book is opened again for its chapters.
+        """
+        with archive_lock:
+            self.load_archive()
+            final_path = self.archive[loan["id"]]["Path"]
+        with profiler.span("open"):
+            audiobook_info, _ = self.get_opened_audiobook(loan)
+        filenames = [get_filename_from_url(url) for url in get_download_urls(audiobook_info)]
+        cover_file_path = next((os.path.join(final_path, f"{name}.jpg")
+                                for name in audiobook_info["media_info"].get("covers", {})
+                                if os.path.isfile(os.path.join(final_path, f"{name}.jpg"))), "")
+        return self.merge_audiobook(loan["id"], final_path, filenames, audiobook_info,
+                                    cover_file_path if should_embed_metadata else "", should_embed_metadata)
+
+    def merge_audiobook(self, title_id: str, final_path: str, filenames: list, audiobook_info: dict,
+                        cover_file_path: str = "", should_embed_metadata: bool = False) -> str:
+        """
+        Merge the downloaded parts into one MP3 named after the folder, with one chapter table for the whole book.
+        The merged file takes the parts' place in the archive before the parts are removed, so an interrupted
+        merge never leaves an archive entry whose files are gone.
+        """
+        file_paths = [os.path.join(final_path, f) for f in filenames]
+        merged_filename = os.path.basename(os.path.normpath(final_path)) + ".mp3"
+        merged_path = os.path.join(final_path, merged_filename)
+        with profiler.span("merge"):
+            scans = [scan_mp3(p) for p in file_paths]
+            durations = [s["Frames"] * s["Samples"] / s["SampleRate"] for s in scans]
+            tag = ID3()
+            if should_embed_metadata:
+                add_book_tags(tag, audiobook_info, cover_file_path)
+                tag_hash = get_tag_hash(get_toc_from_audiobook_info(audiobook_info), audiobook_info["media_info"],
+                                        cover_file_path)
+                tag.add(TXXX(desc=TAG_HASH_DESC, text=tag_hash))
+            add_chapter_tags(tag, get_merged_chapters(audiobook_info, filenames, durations), sum(durations))
+            merge_mp3_files(file_paths, merged_path, tag, scans)
+            try:
+                size, sha256 = hash_file(merged_path)
+                mtime = os.stat(merged_path).st_mtime_ns
+            except BaseException:
+                os.remove(merged_path)
+                raise
+
+        if self.archive_path:
+            with archive_lock:
+                self.load_archive()
+                if title_id in self.archive:
+                    self.archive[title_id]["Merged"] = merged_filename
+                    self.archive[title_id]["Parts"] = [merged_filename]
+                    self.archive[title_id]["Files"] = {merged_filename: {"Size": size, "SHA256": sha256,
+                                                                         "MTime": mtime}}
+                    self.write_archive()
+        for file_path in file_paths:
+            os.remove(file_path)
+        print(f"Merged {len(filenames)} parts into {merged_filename}.")
+        return merged_path
 
     def download_loan(self, loan: dict, format_id: str, output_path: str, should_save_info=False, should_download=True,
                       should_download_cover=True, should_get_odm=False, should_embed_metadata=False,
-                      format_string: str = None, should_replace_space=False, should_create_opf=False):
+                      format_string: str = None, should_replace_space=False, should_create_opf=False,
+                      should_merge=False):
         # Does not actually download ebook, only gets the ODM or ACSM for now.
         # Will however download audiobook-mp3, without ODM
         if not os.path.exists(output_path):
@@ -707,13 +2793,31 @@ class Libby:
             self.load_archive()
             print("Loaded archive", self.archive_path)
             if self.is_downloaded(loan["id"]):
-                print(f"Book has already been downloaded and stored in archive: {loan['id']}")
+                if should_merge and format_id == "audiobook-mp3" and self.needs_merge(loan["id"]):
+                    self.merge_downloaded_audiobook(loan, should_embed_metadata)
+                else:
+                    print(f"Book has already been downloaded and stored in archive: {loan['id']}")
                 return
 
         format_is_available = any(f for f in loan["formats"] if f["id"] == format_id)
         if format_is_available:
-            url = f"https://sentry-read.svc.overdrive.com/card/{loan['cardId']}/loan/{loan['id']}/fulfill/{format_id}"
+            url = get_fulfill_url(loan, format_id)
             media_info = get_media_info(loan["id"], timeout=self.timeout)
+            original_id = self.find_duplicate(media_info, format_id, should_get_odm) \
+                if self.duplicates != "download" else ""
+            if original_id:
+                if self.duplicates == "skip":
+                    title = loan["title"] if "title" in loan else media_info.get("title")
+                    print(f"{loan['id']} - {title} has the same ISBN as {original_id}, which is already "
+                          f"downloaded. Skipping.")
+                    return
+                if format_string is not None:
+                    download_path = get_download_path(media_info, format_string=format_string,
+                                                      should_replace_space=should_replace_space)
+                else:
+                    download_path = get_download_path(media_info, should_replace_space=should_replace_space)
+                if self.link_duplicate(loan, original_id, os.path.join(output_path, download_path)):
+                    return
             if format_id == "audiobook-mp3":
                 if should_get_odm:
                     if format_string is not None:
@@ -730,9 +2834,13 @@ class Libby:
                             fulfill_url = fulfill["fulfill"]["href"]
                             if self.should_download(loan["id"], loan["id"] + ".odm"):
                                 with open(os.path.join(final_path, loan["id"] + ".odm"), "wb") as w:
-                                    w.write(self.http_session.get(fulfill_url, timeout=self.timeout).content)
+                                    content = self.http_session.get(fulfill_url, timeout=self.timeout).content
+                                    w.write(content)
                                     print(f"Downloaded odm file to {w.name}.")
-                                    self.add_to_archive(loan["id"], os.path.basename(w.name), loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None)
+                                # After the file is closed, so the archived mtime is the final one.
+                                self.add_to_archive(loan["id"], os.path.basename(w.name), loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None,
+                                                    path=final_path, size=len(content), sha256=hashlib.sha256(content).hexdigest(),
+                                                    isbns=get_isbns(media_info, format_id), format_id=ODM_FORMAT)
                             if self.is_downloaded(loan["id"], [loan["id"] + ".odm"]):
                                 print(f"Added {loan['id']} to archive.")
                     else:
@@ -742,7 +2850,8 @@ class Libby:
                                                 should_embed_metadata=should_embed_metadata,
                                                 format_string=format_string,
                                                 should_replace_space=should_replace_space,
-                                                should_create_opf=should_create_opf)
+                                                should_create_opf=should_create_opf,
+                                                should_merge=should_merge)
             else:
                 fulfill = self.http_session.get(url, timeout=self.timeout).json()
                 if "fulfill" in fulfill:
@@ -768,9 +2877,13 @@ class Libby:
                             if self.should_download(loan["id"], os.path.basename(os.path.join(final_path,
                                                                 get_filename_from_url(fulfill_url)))):
                                 with open(os.path.join(final_path, get_filename_from_url(fulfill_url)), "wb") as w:
-                                    w.write(self.http_session.get(fulfill_url, timeout=self.timeout).content)
+                                    content = self.http_session.get(fulfill_url, timeout=self.timeout).content
+                                    w.write(content)
                                     print(f"Downloaded acsm file to {w.name}.")
-                                    self.add_to_archive(loan["id"], os.path.basename(w.name), loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None)
+                                # After the file is closed, so the archived mtime is the final one.
+                                self.add_to_archive(loan["id"], os.path.basename(w.name), loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None,
+                                                    path=final_path, size=len(content), sha256=hashlib.sha256(content).hexdigest(),
+                                                    isbns=get_isbns(media_info, format_id), format_id=format_id)
                             if self.is_downloaded(loan["id"], [os.path.basename(os.path.join(final_path, get_filename_from_url(fulfill_url)))]):
                                 print(f"Added {loan['id']} to archive.")
                         else:
@@ -783,7 +2896,10 @@ class Libby:
                             if self.should_download(loan["id"], os.path.basename(filename)):
                                 request.urlretrieve(fulfill_url, filename)
                                 print("Downloaded:", filename)
-                                self.add_to_archive(loan["id"], os.path.basename(filename), loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None)
+                                size, sha256 = hash_file(filename)
+                                self.add_to_archive(loan["id"], os.path.basename(filename), loan["firstCreatorName"] if "firstCreatorName" in loan else get_authors(loan["id"]), loan["title"] if "title" in loan else None,
+                                                    path=final_path, size=size, sha256=sha256,
+                                                    isbns=get_isbns(media_info, format_id), format_id=format_id)
                             if self.is_downloaded(loan["id"], [os.path.basename(filename)]):
                                 print(f"Stored {loan['id']} as Finished in archive.")
                         else:
@@ -813,77 +2929,911 @@ class Libby:
         else:
             raise RuntimeError(f"Format {format_id} not available for title {loan['id']}. Available formats: {str([f['id'] for f in loan['formats']])}.")
 
-    def load_archive(self):
-        if self.archive_path:
-            if os.path.isfile(self.archive_path):
-                with open(self.archive_path, "r") as r:
-                    self.archive = json.loads(r.read())
-
-            # Create archive if it doesn't exist.
+    def download_all_loans(self, format_id: str, output_path: str, **kwargs) -> dict:
+        """
+        Download every loan that is available in format_id, kwargs are passed on to download_loan.
+        Returns how many loans were downloaded, already downloaded, skipped or didn't fit on the disk.
+        """
+        def is_already_downloaded(loan: dict) -> bool:
+            return bool(self.archive_path) and self.is_downloaded(loan["id"]) and \
+                not (kwargs.get("should_merge") and format_id == "audiobook-mp3" and self.needs_merge(loan["id"]))
+
+        counts = {"Downloaded": 0, "Already downloaded": 0, "Skipped": 0, "Not enough space": 0}
+        queue = []
+        for loan in self.get_sync_state().raw["loans"]:
+            if format_id not in get_formats(loan):
+                print(f"Not getting {loan['id']} - {loan['title']}.")
+                counts["Skipped"] += 1
+            elif is_already_downloaded(loan):
+                print(f"Book has already been downloaded and stored in archive: {loan['id']}")
+                counts["Already downloaded"] += 1
             else:
-                self.archive = {}
-                self.write_archive()
+                queue.append(loan)
+        # Fetch all media info at once, download_loan finds it in the cache.
+        get_media_infos([loan["id"] for loan in queue], timeout=self.timeout)
 
-    def add_to_archive(self, title_id: str, filename: str, author: str = None, title: str = None):
+        # Open the next audiobook while the parts of the current one are downloading.
+        should_prefetch = format_id == "audiobook-mp3" and not kwargs.get("should_get_odm")
+        try:
+            for i, loan in enumerate(queue):
+                # Set, not counted up and down, so a failed download can't leave the gauge off for good.
+                metrics.set("pylibby_queue_depth", len(queue) - i, account=self.id_path)
+                try:
+                    if should_prefetch and i + 1 < len(queue) and \
+                            self.will_be_downloaded(queue[i + 1], format_id, kwargs.get("should_get_odm", False)):
+                        self.prefetch_audiobook(queue[i + 1])
+                    with claim_title(loan["id"]):
+                        # Another account may have downloaded it while we waited.
+                        if is_already_downloaded(loan):
+                            print(f"Book has already been downloaded and stored in archive: {loan['id']}")
+                            counts["Already downloaded"] += 1
+                            continue
+                        self.download_loan(loan, format_id, output_path, **kwargs)
+                    counts["Downloaded"] += 1
+                except InsufficientSpaceError as e:
+                    # A smaller book later in the queue may still fit.
+                    print(f"Not enough space, skipping: {e}")
+                    counts["Not enough space"] += 1
+                finally:
+                    # download_loan returns early for books it skips, without using their prefetch.
+                    self.drop_prefetch(loan)
+        finally:
+            metrics.set("pylibby_queue_depth", 0, account=self.id_path)
+            # The executor stays for the next -dla, close() shuts it down.
+            for loan in queue:
+                self.drop_prefetch(loan)
+        return counts
+
+    def load_archive(self):
+        if self.archive_path:
+            with archive_lock:
+                if os.path.isfile(self.archive_path):
+                    with profiler.span("archive.load"), \
+                            metrics.timer("pylibby_archive_operation_duration_seconds", operation="load"), \
+                            open(self.archive_path, "r") as r:
+                        self.archive = json.loads(r.read())
+
+                # Create archive if it doesn't exist.
+                else:
+                    self.archive = {}
+                    self.write_archive()
+
+    def get_isbn_index(self) -> dict:
+        """
+        Title id of every finished book in the archive by ISBN and archived format.
+        """
+        index = {}
         if self.archive_path:
+            with archive_lock:
+                self.load_archive()
+                for title_id, entry in self.archive.items():
+                    if entry["Finished"]:
+                        for isbn in entry.get("ISBNs", []):
+                            index.setdefault((isbn, get_archived_format(entry)), title_id)
+        return index
+
+    def find_duplicate(self, media_info: dict, format_id: str, should_get_odm: bool = False) -> str:
+        """
+        Title id of a finished book in the archive with the same ISBN and format, from any library.
+        Empty if there is none.
+        """
+        archived_format = ODM_FORMAT if should_get_odm and format_id == "audiobook-mp3" else format_id
+        index = self.get_isbn_index()
+        return next((index[(isbn, archived_format)] for isbn in get_isbns(media_info, format_id)
+                     if index.get((isbn, archived_format), media_info["id"]) != media_info["id"]), "")
+
+    def link_duplicate(self, loan: dict, original_id: str, final_path: str) -> bool:
+        """
+        Hard link the files of an already downloaded book to final_path and archive them for this loan as well.
+        Copies if they are on another file system. Returns False if the original files are gone.
+        """
+        with archive_lock:
             self.load_archive()
-            if title_id not in self.archive:
-                self.archive[title_id] = {"Parts": [], "Finished": False}
-                if author:
-                    self.archive[title_id]["Author"] = author
-                if title:
-                    self.archive[title_id]["Title"] = title
-
-            if filename not in self.archive[title_id]["Parts"]:
-                self.archive[title_id]["Parts"].append(filename)
-                print(f"Added {title_id} - {filename} to archive.")
+            original = dict(self.archive[original_id])
+        filenames = list(original.get("Files", {})) or original["Parts"]
+        if "Path" not in original or not all(os.path.isfile(os.path.join(original["Path"], f)) for f in filenames):
+            print(f"Files of {original_id} are missing, downloading {loan['id']} instead of linking it.")
+            return False
 
+        os.makedirs(final_path, exist_ok=True)
+        for filename in filenames:
+            src = os.path.join(original["Path"], filename)
+            dst = os.path.join(final_path, filename)
+            if os.path.exists(dst):
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+        # So --retag and --catalog find its metadata as well.
+        if os.path.isfile(os.path.join(original["Path"], BOOK_INFO_FILE)) and \
+                not os.path.isfile(os.path.join(final_path, BOOK_INFO_FILE)):
+            shutil.copy2(os.path.join(original["Path"], BOOK_INFO_FILE), os.path.join(final_path, BOOK_INFO_FILE))
+        title = loan["title"] if "title" in loan else original.get("Title")
+        print(f"Linked {loan['id']} - {title} to {original_id}, which has the same ISBN.")
+
+        with archive_lock:
+            self.load_archive()
+            entry = {k: v for k, v in original.items()
+                     if k in ["Parts", "Files", "Merged", "Format", "ISBNs", "Author", "Title"]}
+            entry.setdefault("Format", get_archived_format(original))
+            entry.update(Finished=True, Path=os.path.abspath(final_path), DuplicateOf=original_id)
+            if "firstCreatorName" in loan:
+                entry["Author"] = loan["firstCreatorName"]
+            if "title" in loan:
+                entry["Title"] = loan["title"]
+            self.archive[loan["id"]] = entry
             self.write_archive()
-            print(f"Added {title_id} to archive.")
+        return True
+
+    def add_to_archive(self, title_id: str, filename: str, author: str = None, title: str = None, path: str = None,
+                       size: int = None, sha256: str = None, isbns: list = None, format_id: str = None):
+        if self.archive_path:
+            with archive_lock:
+                self.load_archive()
+                if title_id not in self.archive:
+                    self.archive[title_id] = {"Parts": [], "Finished": False}
+                    if author:
+                        self.archive[title_id]["Author"] = author
+                    if title:
+                        self.archive[title_id]["Title"] = title
+
+                if filename not in self.archive[title_id]["Parts"]:
+                    self.archive[title_id]["Parts"].append(filename)
+                    print(f"Added {title_id} - {filename} to archive.")
+
+                # Where the files are and what they should look like, used by verify_archive.
+                if path:
+                    self.archive[title_id]["Path"] = os.path.abspath(path)
+                if sha256:
+                    self.archive[title_id].setdefault("Files", {})[filename] = {"Size": size, "SHA256": sha256}
+                    # Lets reconcile_archive trust files that haven't been touched since without hashing them.
+                    if path and os.path.isfile(os.path.join(path, filename)):
+                        self.archive[title_id]["Files"][filename]["MTime"] = \
+                            os.stat(os.path.join(path, filename)).st_mtime_ns
+                # Used to find the same book borrowed from another library.
+                if isbns:
+                    self.archive[title_id]["ISBNs"] = isbns
+                if format_id:
+                    self.archive[title_id]["Format"] = format_id
+
+                self.write_archive()
+                print(f"Added {title_id} to archive.")
 
     def write_archive(self):
         if self.archive_path:
-            with open(self.archive_path, "w") as w:
+            with archive_lock, profiler.span("archive.write"), \
+                    metrics.timer("pylibby_archive_operation_duration_seconds", operation="write"), \
+                    open(self.archive_path, "w") as w:
                 w.write(json.dumps(self.archive, indent=4, sort_keys=True))
         else:
             print("No archive file specified, not writing archive.")
 
     def is_downloaded(self, title_id, filenames: list = None):
         if self.archive_path:
-            self.load_archive()
-            if title_id in self.archive:
-                if self.archive[title_id]["Finished"]:
-                    return True
-                if filenames:
-                    if "Parts" in self.archive[title_id]:
-                        if len(filenames) == len(self.archive[title_id]["Parts"]):
-                            self.archive[title_id]["Finished"] = True
-                            print(title_id, "Was finished, but not marked. Fixing...")
-                            self.write_archive()
-                            return True
+            with archive_lock:
+                self.load_archive()
+                if title_id in self.archive:
+                    if self.archive[title_id]["Finished"]:
+                        return True
+                    if filenames:
+                        if "Parts" in self.archive[title_id]:
+                            if len(filenames) == len(self.archive[title_id]["Parts"]):
+                                self.archive[title_id]["Finished"] = True
+                                print(title_id, "Was finished, but not marked. Fixing...")
+                                self.write_archive()
+                                return True
 
     def should_download(self, title_id: str, filename: str) -> bool:
         if self.archive_path:
-            self.load_archive()
-            if title_id not in self.archive:
-                print("Title: ", title_id, " not in archive.")
-                return True
-            else:
-                if self.archive[title_id]["Finished"]:
-                    print(f"Title: {title_id} was already completely downloaded.")
-                    return False
+            with archive_lock:
+                self.load_archive()
+                if title_id not in self.archive:
+                    print("Title: ", title_id, " not in archive.")
+                    return True
                 else:
-                    if filename in self.archive[title_id]["Parts"]:
-                        print(f"Title: {title_id} - {filename} was already downloaded.")
+                    if self.archive[title_id]["Finished"]:
+                        print(f"Title: {title_id} was already completely downloaded.")
                         return False
                     else:
-                        print(f"Title: {title_id} was not finished, {filename} was missing, downloading.")
-                        return True
+                        if filename in self.archive[title_id]["Parts"]:
+                            print(f"Title: {title_id} - {filename} was already downloaded.")
+                            return False
+                        else:
+                            print(f"Title: {title_id} was not finished, {filename} was missing, downloading.")
+                            return True
 
         # Should always download if no archive specified.
         else:
             return True
 
+    def verify_archive(self, workers: int = 8) -> list:
+        """
+        Hash every file recorded in the archive and compare with the size and hash stored when it was downloaded.
+        Files that are missing, truncated or corrupt are removed from the archive so the next download only gets
+        those parts again. Returns a list of (title_id, filename, reason).
+        """
+        if not self.archive_path:
+            raise RuntimeError("Can't verify downloads without an archive.")
+        self.load_archive()
+
+        jobs = []
+        unverifiable = 0
+        for title_id, entry in self.archive.items():
+            if "Path" not in entry or "Files" not in entry:
+                unverifiable += 1
+                continue
+            for filename, info in entry["Files"].items():
+                jobs.append((title_id, filename, os.path.join(entry["Path"], filename), info))
+
+        def check(job: tuple) -> str:
+            _, _, file_path, info = job
+            if not os.path.isfile(file_path):
+                return "missing"
+            # Cheap check first, a truncated file doesn't need to be hashed.
+            if os.path.getsize(file_path) != info["Size"]:
+                return "size mismatch"
+            if hash_file(file_path)[1] != info["SHA256"]:
+                return "hash mismatch"
+            return ""
+
+        # hashlib releases the GIL while hashing, so threads are enough to keep several disks busy.
+        bad = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for job, reason in zip(jobs, executor.map(check, jobs)):
+                if reason:
+                    bad.append((job[0], job[1], reason))
+
+        with archive_lock:
+            self.forget_files(bad)
+            if bad:
+                self.write_archive()
+
+        print(f"Verified {len(jobs) - len(bad)} of {len(jobs)} files.")
+        if unverifiable:
+            print(f"{unverifiable} titles in the archive have no hashes and were not verified.")
+        return bad
+
+    def forget_files(self, files: list):
+        """
+        Remove (title_id, filename, reason) from the archive so the next download gets those files again.
+        The caller writes the archive.
+        """
+        with archive_lock:
+            for title_id, filename, reason in files:
+                entry = self.archive[title_id]
+                entry["Finished"] = False
+                if filename == entry.get("Merged"):
+                    # The parts are gone, so all of them have to be downloaded again.
+                    entry["Parts"] = []
+                    entry.pop("Merged")
+                elif filename in entry["Parts"]:
+                    entry["Parts"].remove(filename)
+                entry.get("Files", {}).pop(filename, None)
+
+    def reconcile_archive(self, output_path: str, format_string: str = None, should_replace_space=False,
+                          workers: int = 8) -> dict:
+        """
+        Compare the archive with what is really in output_path, in one parallel pass over the folders.
+        Files are matched by size and mtime, only files whose size is right but mtime changed are hashed.
+        Books that were moved are found again by their folder name, using the output format string.
+        Missing and changed files are removed from the archive so the next download gets them again, like
+        verify_archive does. Returns the missing files as (title_id, filename, reason), the moved books as
+        (title_id, path) and the downloaded files in output_path that no book in the archive has, which can be
+        removed.
+        """
+        if not self.archive_path:
+            raise RuntimeError("Can't reconcile downloads without an archive.")
+        self.load_archive()
+        # The tree has real paths, so an output folder reached through a symlink doesn't make every book moved.
+        output_path = os.path.realpath(output_path)
+        with profiler.span("reconcile.scan"):
+            tree = scan_tree(output_path, workers)
+        paths = {title_id: os.path.realpath(entry["Path"]) for title_id, entry in self.archive.items()
+                 if "Path" in entry}
+
+        def normalize(s: str) -> str:
+            return s.replace("_", " ").casefold()
+
+        def is_in_output_path(path: str) -> bool:
+            try:
+                return os.path.commonpath([output_path, path]) == output_path
+            except ValueError:
+                # On another drive.
+                return False
+
+        # Books that aren't where the archive says. Books in other output folders are left alone.
+        lost = {title_id: entry for title_id, entry in self.archive.items()
+                if paths.get(title_id) not in tree and is_in_output_path(paths.get(title_id, output_path))}
+        lost_by_title = {}
+        for title_id, entry in lost.items():
+            lost_by_title.setdefault(normalize(entry.get("Title", "")), []).append(title_id)
+
+        found = {}
+        pattern = get_download_path_regex(format_string or "%a/%y - %t", should_replace_space)
+        for folder, files in tree.items() if lost else []:
+            m = pattern.fullmatch(os.path.relpath(folder, output_path).replace(os.sep, "/"))
+            if not m or not files:
+                continue
+            groups = m.groupdict()
+            if groups.get("o"):
+                candidates = [groups["o"]] if groups["o"] in lost else []
+            else:
+                # %a is all authors, the archive only has the first one.
+                authors = normalize(groups.get("a") or "")
+                authors = {authors} | set(authors.split(" & "))
+                candidates = [t for t in lost_by_title.get(normalize(groups.get("t") or ""), [])
+                              if normalize(lost[t].get("Author", "")) in authors]
+            for title_id in candidates:
+                if any(f in files for f in get_archived_filenames(lost[title_id])):
+                    found.setdefault(title_id, folder)
+
+        missing, moved, jobs = [], [], []
+        claimed = set()
+        for title_id, entry in self.archive.items():
+            if title_id not in lost and paths.get(title_id) not in tree:
+                # In another output folder.
+                continue
+            folder = paths.get(title_id) if title_id not in lost else found.get(title_id)
+            if folder is None:
+                # Without a path we can't tell whether the book was deleted or downloaded somewhere else.
+                if "Path" in entry:
+                    missing.extend((title_id, f, "missing") for f in get_archived_filenames(entry))
+                continue
+            if folder != paths.get(title_id):
+                moved.append((title_id, folder))
+            for filename in get_archived_filenames(entry):
+                claimed.add(os.path.join(folder, filename))
+                info = entry.get("Files", {}).get(filename)
+                if filename not in tree[folder]:
+                    missing.append((title_id, filename, "missing"))
+                elif info is None:
+                    # Archived by an older version without a size, being there is all we can check.
+                    continue
+                elif tree[folder][filename][0] != info["Size"]:
+                    missing.append((title_id, filename, "size mismatch"))
+                elif tree[folder][filename][1] != info.get("MTime"):
+                    jobs.append((title_id, filename, os.path.join(folder, filename), info))
+
+        def hash_job(job: tuple) -> tuple[int, str]:
+            try:
+                return os.stat(job[2]).st_mtime_ns, hash_file(job[2])[1]
+            except OSError:
+                # Removed since the scan.
+                return None, None
+
+        with profiler.span("reconcile.hash"), ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = list(executor.map(hash_job, jobs))
+        mtimes = []
+        for job, (mtime, sha256) in zip(jobs, hashes):
+            if sha256 is None:
+                missing.append((job[0], job[1], "missing"))
+            elif sha256 != job[3]["SHA256"]:
+                missing.append((job[0], job[1], "hash mismatch"))
+            else:
+                mtimes.append((job, mtime))
+
+        orphans = sorted(os.path.join(folder, f) for folder, files in tree.items() for f in files
+                         if f.lower().endswith(DOWNLOAD_EXTENSIONS) and os.path.join(folder, f) not in claimed)
+
+        with archive_lock:
+            for title_id, folder in moved:
+                self.archive[title_id]["Path"] = folder
+            for (title_id, filename, _, _), mtime in mtimes:
+                self.archive[title_id]["Files"][filename]["MTime"] = mtime
+            self.forget_files(missing)
+            if moved or mtimes or missing:
+                self.write_archive()
+
+        print(f"Scanned {sum(len(files) for files in tree.values())} files in {len(tree)} folders, "
+              f"hashed {len(jobs)}.")
+        return {"Missing": missing, "Moved": moved, "Orphans": orphans}
+
+
+class AsyncLibby:
+    """
+    Asyncio version of Libby for embedding in async applications, needs httpx.
+    Covers syncing, loans, holds, search, borrowing, returning, opening and streaming parts. Downloading and tagging
+    whole books, the archive and the open cache are only in Libby.
+    Use it with "async with AsyncLibby(id_path) as libby:".
+    """
+
+    def __init__(self, id_path: str, code: str = None, timeout: int = 10, max_connections: int = 100):
+        if httpx is None:
+            raise RuntimeError("AsyncLibby needs httpx, install it with: pip install httpx")
+        self.id_path = id_path
+        self.code = code
+        self.timeout = timeout
+        self.identity = ""
+        # Every book has its own CDN cookies that we send ourselves, so the client must not keep any. Otherwise
+        # books opened at the same time would overwrite each other's cookies.
+        self.client = httpx.AsyncClient(headers={"Accept": "application/json"}, cookies=create_no_cookies_jar(),
+                                        timeout=timeout, follow_redirects=True,
+                                        limits=httpx.Limits(max_connections=max_connections))
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def request(self, method: str, url: str, **kwargs):
+        await rate_limiter.acquire_async()
+        return await self.client.request(method, url, **kwargs)
+
+    async def login(self):
+        if os.path.isfile(self.id_path):
+            with open(self.id_path, "r") as r:
+                self.set_identity(json.loads(r.read())["identity"])
+            if not await self.is_logged_in():
+                if not self.code:
+                    raise RuntimeError("Not logged in and no code was given.")
+                await self.clone_by_code(self.code)
+        elif self.code:
+            await self.get_chip()
+            await self.clone_by_code(self.code)
+        else:
+            raise RuntimeError("PyLibby needs a path to a JSON-file with ID-info. To get the file you"
+                               " need to provide a code you can get from libby by going to"
+                               " Settings->Copy To Another Device.")
+        if not await self.is_logged_in():
+            raise RuntimeError("Couldn't log in with code, are you sure you wrote it correctly and that "
+                               "you are within the time limit?"
+                               "You need at least 1 registered library card.")
+
+    def set_identity(self, identity: str):
+        self.identity = identity
+        self.client.headers["Authorization"] = f"Bearer {identity}"
+
+    async def is_logged_in(self) -> bool:
+        s = await self.get_sync()
+        return s.get("result") == "synchronized" and bool(s.get("cards"))
+
+    async def get_chip(self) -> dict:
+        response = (await self.request("POST", get_chip_url(), params={"client": "dewey"})).json()
+        self.set_identity(response["identity"])
+        with open(self.id_path, "w") as w:
+            w.write(json.dumps(response, indent=4, sort_keys=True))
+        return response
+
+    async def clone_by_code(self, code: str) -> dict:
+        resp = await self.request("POST", get_clone_by_code_url(), data={"code": code})
+        await self.get_chip()
+        return resp.json()
+
+    async def get_sync(self) -> dict:
+        return (await self.request("GET", get_sync_url())).json()
+
+    async def get_loans(self) -> list:
+        return (await self.get_sync())["loans"]
+
+    async def get_holds(self) -> list:
+        return (await self.get_sync())["holds"]
+
+    async def get_loan(self, title_id: str) -> dict:
+        return find_title(await self.get_loans(), title_id)
+
+    async def get_hold(self, title_id: str) -> dict:
+        return find_title(await self.get_holds(), title_id)
+
+    async def get_media_info(self, title_id: str) -> dict:
+        # Shares the cache with the sync client, but doesn't wait for fetches running in other threads.
+        media_info = media_info_cache.get(title_id)
+        if media_info is None:
+            media_info = (await self.request("GET", get_media_info_url(title_id))).json()
+            if "id" in media_info:
+                media_info_cache.set(title_id, media_info)
+        return media_info
+
+    async def is_book_available(self, library: str, title_id: str) -> bool:
+        return parse_availability((await self.request("GET", get_availability_url(library, title_id))).json())
+
+    async def search_for_book_in_logged_in_libraries(self, query: str) -> list:
+        libraries = [card["advantageKey"] for card in (await self.get_sync())["cards"]]
+        return (await self.request("GET", get_search_url(libraries, query))).json()
+
+    async def search_for_audiobook_in_logged_in_libraries(self, query: str) -> list:
+        return filter_by_type(await self.search_for_book_in_logged_in_libraries(query), "audiobook")
+
+    async def search_for_ebook_in_logged_in_libraries(self, query: str) -> list:
+        return filter_by_type(await self.search_for_book_in_logged_in_libraries(query), "ebook")
+
+    async def borrow_book(self, title_id: str, card_id: str, days: int = 21) -> dict:
+        media_info = await self.get_media_info(title_id)
+        resp = await self.request("POST", get_loan_url(card_id, title_id), json=create_borrow_json(media_info, days))
+        check_sentry_response(resp, "borrow book")
+        return resp.json()
+
+    async def return_book(self, title_id: str, card_id: str = None):
+        if not card_id:
+            card_id = (await self.get_loan(title_id)).get("cardId")
+        if not card_id:
+            raise RuntimeError("Couldn't find cardId on loan or couldn't find loan at all, can't return it.")
+        check_sentry_response(await self.request("DELETE", get_loan_url(card_id, title_id)), "return book")
+
+    async def hold_book(self, title_id: str, card_id: str) -> dict:
+        sync = await self.get_sync()
+        if find_title(sync["loans"], title_id):
+            print("Book already borrowed. Not creating hold.")
+            return {}
+        if find_title(sync["holds"], title_id):
+            print("Book already on hold. Not creating hold.")
+            return {}
+        availabilities = await asyncio.gather(
+            *[self.is_book_available(card["advantageKey"], title_id) for card in sync["cards"]])
+        for card, is_available in zip(sync["cards"], availabilities):
+            if is_available:
+                print(f"Book available at {card['advantageKey']}. Not creating hold.")
+                return {}
+
+        resp = await self.request("POST", get_hold_url(card_id, title_id), json=create_hold_json())
+        check_sentry_response(resp, "hold book")
+        return resp.json()
+
+    async def cancel_hold(self, title_id: str, card_id: str = None):
+        if not card_id:
+            card_id = (await self.get_hold(title_id)).get("cardId")
+        if not card_id:
+            raise RuntimeError("Couldn't find cardId on hold or couldn't find hold at all, can't cancel it.")
+        check_sentry_response(await self.request("DELETE", get_hold_url(card_id, title_id)), "cancel hold on book")
+
+    async def open_audiobook(self, card_id: str, title_id: str, loan: dict = None) -> dict:
+        """
+        Returns the same dict as Libby.open_audiobook.
+        """
+        media_info_task = asyncio.ensure_future(self.get_media_info(title_id))
+        try:
+            if not loan:
+                loan = await self.get_loan(title_id)
+            if not loan:
+                raise RuntimeError("Can't open a book if it is not checked out.")
+
+            audiobook = (await self.request("GET", get_open_url(loan, card_id, title_id))).json()
+
+            # THIS IS IMPORTANT
+            # The web URL has to be requested without any of our headers.
+            request = self.client.build_request("GET", get_web_url_with_message(audiobook))
+            for header in [h for h in request.headers if h.lower() != "host"]:
+                del request.headers[header]
+            await rate_limiter.acquire_async()
+            response = await self.client.send(request, follow_redirects=True)
+            cookies = get_cookies([r.cookies.jar for r in response.history + [response]])
+
+            openbook_url = audiobook["urls"]["openbook"]
+            openbook = (await self.request("GET", openbook_url,
+                                           headers={"Cookie": get_cookie_header(cookies, openbook_url)})).json()
+            media_info = await media_info_task
+        finally:
+            media_info_task.cancel()
+
+        return {
+                "audiobook_urls": audiobook,
+                "openbook": openbook,
+                "media_info": media_info,
+                "cookies": cookies
+                }
+
+    async def iter_part(self, download_url: str, cookies: list, chunk_size: int = 1024 * 64):
+        """
+        Streams one part of an opened audiobook, cookies are the ones from open_audiobook.
+        """
+        await bandwidth_limiter.wait_for_window_async()
+        await rate_limiter.acquire_async()
+        headers = {"Cookie": get_cookie_header(cookies, download_url)}
+        async with self.client.stream("GET", download_url, headers=headers) as resp:
+            if resp.status_code != 200:
+                raise RuntimeError(f"Couldn't download {get_filename_from_url(download_url)}: HTTP {resp.status_code}.")
+            async for chunk in resp.aiter_bytes(chunk_size):
+                await bandwidth_limiter.consume_async(len(chunk))
+                yield chunk
+
+    async def download_part(self, download_url: str, cookies: list, file_path: str) -> tuple[int, str]:
+        """
+        Returns the size and SHA-256 of the downloaded part.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(file_path, "wb") as w:
+            async for chunk in self.iter_part(download_url, cookies):
+                w.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        metrics.inc("pylibby_downloaded_bytes_total", size, endpoint="cdn")
+        return size, digest.hexdigest()
+
+    async def download_audiobook_parts(self, audiobook_info: dict, output_path: str, concurrency: int = 4) -> dict:
+        """
+        Downloads every part of an opened audiobook into output_path, at most concurrency at a time.
+        Returns {filename: {"Size", "SHA256"}}, the same as the files in the archive.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        os.makedirs(output_path, exist_ok=True)
+
+        async def download(download_url: str) -> tuple[str, dict]:
+            filename = get_filename_from_url(download_url)
+            async with semaphore:
+                size, sha256 = await self.download_part(download_url, audiobook_info["cookies"],
+                                                        os.path.join(output_path, filename))
+            return filename, {"Size": size, "SHA256": sha256}
+
+        return dict(await asyncio.gather(*[download(url) for url in get_download_urls(audiobook_info)]))
+
+
+def load_audiobook_info(book_path: str, title_id: str = None, open_cache_path: str = "") -> dict:
+    """
+    The info.json saved with the book, or its BOOK_INFO_FILE, or else the opened book from the open cache, even if
+    it has expired.
+    """
+    for filename in ["info.json", BOOK_INFO_FILE]:
+        if os.path.isfile(os.path.join(book_path, filename)):
+            with open(os.path.join(book_path, filename), "r") as r:
+                return json.loads(r.read())
+    # Cached by card and title id, any card will do.
+    cache_file = next((os.path.join(open_cache_path, f) for f in sorted(os.listdir(open_cache_path))
+                       if f.endswith(f"-{title_id}.json")), "") if title_id and os.path.isdir(open_cache_path) else ""
+    if cache_file:
+        with open(cache_file, "r") as r:
+            return json.loads(r.read())["AudiobookInfo"]
+    return {}
+
+
+def retag_file(job: tuple) -> tuple:
+    """
+    Runs in the worker processes of retag_library. Returns (file_path, size, sha256), size and sha256 are None
+    if the tags were already current.
+    """
+    file_path, audiobook_info, cover_file_path, markers, chapters, tag_hash = job
+    tags = MP3(file_path).tags
+    if tags is not None and f"TXXX:{TAG_HASH_DESC}" in tags and tags[f"TXXX:{TAG_HASH_DESC}"].text[0] == tag_hash:
+        return file_path, None, None
+    if markers is not None:
+        embed_tag_data(file_path, markers, audiobook_info, cover_file_path)
+    else:
+        embed_merged_tag_data(file_path, chapters, audiobook_info, cover_file_path)
+    size, sha256 = hash_file(file_path)
+    return file_path, size, sha256
+
+
+def retag_library(output_path: str, archive_path: str = "", open_cache_path: str = "", workers: int = None) -> dict:
+    """
+    Embed tags again in every downloaded audiobook under output_path, from its info.json, BOOK_INFO_FILE or the
+    open cache, without using the network. Files that already have current tags are skipped. The sizes and hashes
+    in the archive are updated for the files that changed. Returns how many files were retagged, already current or
+    had no info to tag them with.
+    """
+    archive = {}
+    if archive_path and os.path.isfile(archive_path):
+        with archive_lock, open(archive_path, "r") as r:
+            archive = json.loads(r.read())
+    titles_by_path = {os.path.abspath(e["Path"]): title_id for title_id, e in archive.items() if "Path" in e}
+
+    counts = {"Retagged": 0, "Already current": 0, "No info": 0}
+    jobs = []
+    for book_path, _, filenames in os.walk(output_path):
+        mp3s = sorted(f for f in filenames if f.lower().endswith(".mp3"))
+        if not mp3s:
+            continue
+        audiobook_info = load_audiobook_info(book_path, titles_by_path.get(os.path.abspath(book_path)),
+                                             open_cache_path)
+        if not audiobook_info:
+            print(f"No info.json, {BOOK_INFO_FILE} or cached openbook in {book_path}, not retagging it.")
+            counts["No info"] += len(mp3s)
+            continue
+
+        media_info = audiobook_info["media_info"]
+        cover_file_path = next((os.path.join(book_path, f"{name}.jpg") for name in media_info.get("covers", {})
+                                if os.path.isfile(os.path.join(book_path, f"{name}.jpg"))), "")
+        toc = get_toc_from_audiobook_info(audiobook_info)
+        spine = audiobook_info["openbook"]["spine"]
+        spine_filenames = [get_filename_from_url(url) for url in get_download_urls(audiobook_info)]
+        for filename in mp3s:
+            if filename in spine_filenames:
+                markers = toc.get(filename, CONTINUED_MARKERS)
+                jobs.append((os.path.join(book_path, filename), audiobook_info, cover_file_path, markers, None,
+                             get_tag_hash(markers, media_info, cover_file_path)))
+            else:
+                # Made by --merge, the parts are gone so their durations have to come from the openbook.
+                chapters = None
+                if all("audio-duration" in s for s in spine):
+                    chapters = get_merged_chapters(audiobook_info, spine_filenames,
+                                                   [float(s["audio-duration"]) for s in spine])
+                jobs.append((os.path.join(book_path, filename), audiobook_info, cover_file_path, None, chapters,
+                             get_tag_hash(toc, media_info, cover_file_path)))
+
+    # Tagging is mostly Python, so it needs processes to use more than one core.
+    changed = False
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for file_path, size, sha256 in executor.map(retag_file, jobs, chunksize=4):
+            if size is None:
+                counts["Already current"] += 1
+                continue
+            counts["Retagged"] += 1
+            print(f"Retagged {file_path}.")
+            title_id = titles_by_path.get(os.path.abspath(os.path.dirname(file_path)))
+            files = archive.get(title_id, {}).get("Files", {})
+            if os.path.basename(file_path) in files:
+                files[os.path.basename(file_path)] = {"Size": size, "SHA256": sha256,
+                                                      "MTime": os.stat(file_path).st_mtime_ns}
+                changed = True
+
+    if changed:
+        with archive_lock, open(archive_path, "w") as w:
+            w.write(json.dumps(archive, indent=4, sort_keys=True))
+    return counts
+
+
+def get_book_fingerprint(book_path: str, filenames: list) -> str:
+    """
+    Changes when a file in the folder is added, removed or modified. Only stats the files, nothing is read.
+    """
+    stats = []
+    for filename in sorted(filenames):
+        st = os.stat(os.path.join(book_path, filename))
+        stats.append((filename, st.st_size, st.st_mtime_ns))
+    return hashlib.sha256(json.dumps(stats).encode()).hexdigest()
+
+
+def create_opds_entry(media_info: dict, book_href: str, filenames: list, updated: str) -> str:
+    def xml(text: str) -> str:
+        return dicttoxml.escape_xml(html.unescape(str(text)))
+
+    def href(filename: str) -> str:
+        return xml(urllib.parse.quote(f"{book_href}/{filename}"))
+
+    entry = ["  <entry>",
+             f"    <title>{xml(media_info['title'])}</title>",
+             f"    <id>urn:overdrive:{xml(media_info['id'])}</id>",
+             f"    <updated>{updated}</updated>"]
+    for author in get_authors(media_info, delim=",").split(","):
+        if author:
+            entry.append(f"    <author><name>{xml(author)}</name></author>")
+    if "publisher" in media_info:
+        entry.append(f"    <dc:publisher>{xml(media_info['publisher']['name'])}</dc:publisher>")
+    for language in media_info.get("languages", []):
+        entry.append(f"    <dc:language>{xml(language['id'])}</dc:language>")
+    for subject in media_info.get("subjects", []):
+        entry.append(f'    <category term="{xml(subject["name"])}" label="{xml(subject["name"])}"/>')
+    if "description" in media_info:
+        description = re.sub("<.*?>", "", media_info["description"].replace("<br>", "\n").replace("<BR>", "\n"))
+        entry.append(f"    <summary>{xml(description)}</summary>")
+    for filename in filenames:
+        if filename.lower().endswith(".jpg"):
+            entry.append(f'    <link rel="http://opds-spec.org/image" href="{href(filename)}" type="image/jpeg"/>')
+        elif filename.lower().endswith(".mp3"):
+            entry.append(f'    <link rel="http://opds-spec.org/acquisition" href="{href(filename)}" '
+                         f'type="audio/mpeg" title="{xml(filename)}"/>')
+        elif filename == "metadata.opf":
+            entry.append(f'    <link rel="describedby" href="{href(filename)}" type="application/oebps-package+xml"/>')
+    entry.append("  </entry>")
+    return "\n".join(entry)
+
+
+def build_catalog(output_path: str, archive_path: str = "", open_cache_path: str = "",
+                  manifest_name: str = ".catalog.json", feed_name: str = "catalog.xml") -> dict:
+    """
+    Write a metadata.opf for every book under output_path and one OPDS feed with all of them.
+    A manifest remembers each book's files, so only books that were added, changed or removed since the last run
+    are generated again. Metadata comes from info.json, BOOK_INFO_FILE or the open cache, the network isn't used.
+    Returns how many books were updated, unchanged, removed or had no info.
+    """
+    manifest_path = os.path.join(output_path, manifest_name)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as r:
+            manifest = json.loads(r.read())
+    archive = {}
+    if archive_path and os.path.isfile(archive_path):
+        with archive_lock, open(archive_path, "r") as r:
+            archive = json.loads(r.read())
+    titles_by_path = {os.path.abspath(e["Path"]): title_id for title_id, e in archive.items() if "Path" in e}
+
+    counts = {"Updated": 0, "Unchanged": 0, "Removed": 0, "No info": 0}
+    books = {}
+    for book_path, _, filenames in os.walk(output_path):
+        if not any(f.lower().endswith(".mp3") for f in filenames):
+            continue
+        relative_path = os.path.relpath(book_path, output_path).replace(os.sep, "/")
+        # metadata.opf is written by us, so it doesn't count as a change.
+        fingerprint = get_book_fingerprint(book_path, [f for f in filenames if f != "metadata.opf"])
+        if relative_path in manifest and manifest[relative_path]["Fingerprint"] == fingerprint:
+            books[relative_path] = manifest[relative_path]
+            counts["Unchanged"] += 1
+            continue
+
+        audiobook_info = load_audiobook_info(book_path, titles_by_path.get(os.path.abspath(book_path)),
+                                             open_cache_path)
+        if not audiobook_info:
+            print(f"No info.json, {BOOK_INFO_FILE} or cached openbook in {book_path}, leaving it out of the catalog.")
+            counts["No info"] += 1
+            continue
+        media_info = audiobook_info["media_info"]
+        with open(os.path.join(book_path, "metadata.opf"), "w") as w:
+            w.write(create_opf(media_info))
+        updated = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        files = sorted(f for f in filenames + ["metadata.opf"] if f not in ["info.json", BOOK_INFO_FILE])
+        books[relative_path] = {
+            "Fingerprint": fingerprint,
+            "Updated": updated,
+            "Entry": create_opds_entry(media_info, relative_path, list(dict.fromkeys(files)), updated),
+        }
+        counts["Updated"] += 1
+        print(f"Updated {relative_path} in the catalog.")
+    counts["Removed"] = len(manifest.keys() - books.keys())
+
+    feed_path = os.path.join(output_path, feed_name)
+    if counts["Updated"] or counts["Removed"] or not os.path.isfile(feed_path):
+        updated = max((b["Updated"] for b in books.values()), default="1970-01-01T00:00:00Z")
+        feed = ["<?xml version='1.0' encoding='utf-8'?>",
+                '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" '
+                'xmlns:opds="http://opds-spec.org/2010/catalog">',
+                "  <id>urn:pylibby:catalog</id>",
+                "  <title>PyLibby</title>",
+                f"  <updated>{updated}</updated>",
+                f'  <link rel="self" href="{feed_name}" '
+                f'type="application/atom+xml;profile=opds-catalog;kind=acquisition"/>']
+        feed += [books[path]["Entry"] for path in sorted(books)]
+        feed.append("</feed>")
+        with open(feed_path + ".tmp", "w") as w:
+            w.write("\n".join(feed))
+        os.replace(feed_path + ".tmp", feed_path)
+        with open(manifest_path + ".tmp", "w") as w:
+            w.write(json.dumps(books, indent=4, sort_keys=True))
+        os.replace(manifest_path + ".tmp", manifest_path)
+        print(f"Wrote {feed_path} with {len(books)} books.")
+    return counts
+
+
+def run_accounts(id_paths: list, archive_path: str = "", timeout: int = 10, max_retries: int = 0,
+                 open_cache_path: str = "", http2: bool = False, part_workers: int = 1,
+                 min_free_space: int = 100 * 1000 * 1000, duplicates: str = "download", format_id: str = None,
+                 output_path: str = ".", **download_kwargs) -> list:
+    """
+    Sync, list and, if format_id is given, download all loans for several accounts at the same time.
+    Each account gets its own thread and session. Media info, covers, the rate limiter and the archive are shared.
+    Returns one report per account.
+    """
+    def run(id_path: str) -> dict:
+        start = time.perf_counter()
+        report = {"Account": id_path, "Cards": 0, "Loans": 0, "Holds": 0, "Downloaded": 0, "Already downloaded": 0,
+                  "Skipped": 0, "Not enough space": 0, "Error": "", "loans": [], "holds": []}
+        libby = None
+        try:
+            libby = Libby(id_path, archive_path=archive_path, timeout=timeout, max_retries=max_retries,
+                          open_cache_path=open_cache_path, http2=http2, part_workers=part_workers,
+                          min_free_space=min_free_space, duplicates=duplicates)
+            state = libby.get_sync_state()
+            sync = state.raw
+            report.update(Cards=len(sync["cards"]), Loans=len(sync["loans"]), Holds=len(sync["holds"]))
+            media_infos = get_media_infos([e["id"] for kind in ["loans", "holds"] for e in sync[kind]],
+                                          timeout=timeout)
+            for kind in ["loans", "holds"]:
+                for entry in sync[kind]:
+                    media_info = media_infos[entry["id"]]
+                    report[kind].append({
+                        "Account": id_path,
+                        "Id": entry["id"],
+                        "Type": entry["type"]["id"],
+                        "Library": state.get_library(entry["cardId"]),
+                        "Authors": "\n".join(get_authors(media_info).split(" & ")),
+                        "Title": entry["title"],
+                    })
+            if format_id:
+                report.update(libby.download_all_loans(format_id, output_path, **download_kwargs))
+        except Exception as e:
+            report["Error"] = str(e)
+        finally:
+            if libby:
+                libby.close()
+        report["Time (s)"] = round(time.perf_counter() - start, 2)
+        return report
+
+    with ThreadPoolExecutor(max_workers=len(id_paths)) as executor:
+        return list(executor.map(run, id_paths))
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -912,6 +3862,13 @@ def main():
                         help="Return book. If the same book is borrowed in multiple libraries this will only return the first one.",
                         metavar="id")
     parser.add_argument("-ho", "--hold-book", help="Hold book from the library with the shortest wait.", metavar="id")
+    parser.add_argument("--watch",
+                        help="Keep checking these titles, or all your holds if no ids are given, at all your libraries "
+                             "and\nborrow them as soon as they are available. Titles that should be available soon "
+                             "are checked more often.",
+                        nargs="*", metavar="id")
+    parser.add_argument("--watch-interval", help="Seconds between checks of titles that can be available any moment.",
+                        type=float, metavar="seconds", default=float(os.getenv("WATCH_INTERVAL", 60)))
     parser.add_argument("-ch", "--cancel-hold",
                         help="Cancel hold. If the same book is held in multiple libraries this will only return the first one.",
                         metavar="id")
@@ -931,12 +3888,39 @@ def main():
     parser.add_argument("-a", "--archive",
                         help="Path to archive file. The archive keeps track of what is already downloaded. Defaults to ./config/archive.json",
                         default=os.getenv("ARCHIVE", "./config/archive.json"), type=str, metavar="path")
+    parser.add_argument("-oc", "--open-cache",
+                        help="Keep opened audiobooks (openbook and cookies) in this folder until they expire, so "
+                             "resumed downloads can go straight to the missing parts.\n"
+                             "Off unless set, for example to ./config/open_cache. The files have the CDN cookies, keep it "
+                             "private.",
+                        default=os.getenv("OPEN_CACHE", ""), type=str, metavar="path")
+    parser.add_argument("--http2", help="Use HTTP/2 for sentry, thunder and the CDN, needs httpx[http2].\n"
+                                        "Falls back to HTTP/1.1 if it isn't installed or HTTP/2 fails.",
+                        action="store_true", default=os.getenv("HTTP2"))
+    parser.add_argument("--part-workers", help="Download this many parts of a book at the same time.",
+                        type=int, metavar="n", default=int(os.getenv("PART_WORKERS", 1)))
+    parser.add_argument("--hedge",
+                        help="Send a second request when a GET takes longer than usual for its host (p95), "
+                             "and use\nwhichever answers first. Cuts waiting on slow responses for a few extra "
+                             "requests.",
+                        action="store_true", default=os.getenv("HEDGE"))
+    parser.add_argument("--min-free-space", help="Don't start a book unless this many MB will be left free after it.",
+                        type=int, metavar="MB", default=int(os.getenv("MIN_FREE_SPACE", 100)))
+    parser.add_argument("--duplicates",
+                        help="What to do with a loan that has the same ISBN as a book already in the archive, "
+                             "like the same book\nborrowed from another library. "
+                             "\"link\" hard links the files we already have.",
+                        choices=["download", "skip", "link"], default=os.getenv("DUPLICATES", "download"))
     parser.add_argument("-j", "--json", help="Output verbose JSON instead of tables.", action="store_true")
     parser.add_argument("-e", "--embed-metadata", help="Embeds metadata in MP3 files, including chapter markers.",
                         action="store_true", default=os.getenv("EMBED_METADATA"))
     parser.add_argument("-opf", "--create-opf", help="Create an OPF file with metadata when downloading a book.",
                         action="store_true", default=os.getenv("CREATE_OPF"))
     parser.add_argument("-dlo", "--download-opf", help="Generate an OPF file by title id.", type=str, metavar="id")
+    parser.add_argument("-m", "--merge",
+                        help="Merge the parts of an audiobook into one MP3 with chapters when it's done, "
+                             "without re-encoding.\nThe parts are removed.",
+                        action="store_true", default=os.getenv("MERGE"))
     parser.add_argument("-ofs", "--output-format-string",
                         help=('Format string specifying output folder(s), default is "%%a/%%y - %%t".\n'
                               '%%a = Author(s).\n'
@@ -961,16 +3945,168 @@ def main():
         default=int(os.getenv("RETRY", 0)) if int(os.getenv("RETRY", 0)) < 6 else 0,
         choices=range(0, 6),  # limit max to 5
         dest="max_retries")
+    parser.add_argument("--profile", help="Print time spent in each phase (sync, open, archive, tagging...) at exit.",
+                        action="store_true", default=os.getenv("PROFILE"))
+    parser.add_argument("--profile-output",
+                        help="Also run cProfile and write the stats to this file (open with pstats or snakeviz).",
+                        type=str, metavar="path")
+    parser.add_argument("--trace-http",
+                        help="Write every HTTP request (endpoint, status, bytes, connection reuse, latency) to this "
+                             "JSON file and print a summary at exit.",
+                        type=str, metavar="path", default=os.getenv("TRACE_HTTP"))
+    parser.add_argument("--record",
+                        help="Record all HTTP traffic to this cassette file, with tokens scrubbed, "
+                             "to replay later with --replay.",
+                        type=str, metavar="path")
+    parser.add_argument("--record-max-body",
+                        help="Only keep this many bytes of each recorded audio, image or other binary body, "
+                             "0 keeps all.\nJSON is always kept whole.",
+                        type=int, metavar="bytes", default=Cassette.DEFAULT_MAX_BODY)
+    parser.add_argument("--replay",
+                        help="Answer HTTP requests from a cassette made with --record instead of the network.",
+                        type=str, metavar="path")
+    parser.add_argument("--replay-scale",
+                        help="Multiply the recorded response times by this when replaying, 0 answers right away.",
+                        type=float, metavar="factor", default=1.0)
+    parser.add_argument("--metrics-port", help="Serve Prometheus metrics on http://0.0.0.0:port/metrics while running.",
+                        type=int, metavar="port", default=os.getenv("METRICS_PORT"))
+    parser.add_argument("--metrics-file",
+                        help="Write Prometheus metrics to this file (for node_exporter's textfile collector) "
+                             "every 15 seconds and at exit.",
+                        type=str, metavar="path", default=os.getenv("METRICS_FILE"))
+    parser.add_argument("--verify",
+                        help="Check every downloaded file against the size and hash in the archive.\n"
+                             "Bad files are queued for re-download, run -dl or -dla afterwards to get them.",
+                        action="store_true")
+    parser.add_argument("--reconcile",
+                        help="Compare the archive with the files in this folder, using -ofs to find moved books.\n"
+                             "Missing or changed files are queued for re-download, files that aren't in the "
+                             "archive are listed.",
+                        type=str, metavar="path")
+    parser.add_argument("--verify-workers", help="Number of files to verify or folders to scan in parallel.",
+                        type=int, default=8, metavar="n")
+    parser.add_argument("--retag",
+                        help="Embed tags again in all audiobooks in this folder, from the metadata saved with them.\n"
+                             "No login or network needed, files with current tags are skipped.",
+                        type=str, metavar="path")
+    parser.add_argument("--catalog",
+                        help="Write metadata.opf for every audiobook in this folder and an OPDS feed, catalog.xml, "
+                             "for all of them.\nOnly books that changed since the last run are generated again.",
+                        type=str, metavar="path")
+    parser.add_argument("--retag-workers", help="Number of processes to retag with, defaults to the number of CPUs.",
+                        type=int, metavar="n")
+    parser.add_argument("-mid", "--multi-id",
+                        help="Run several accounts at once, one id JSON per account.\n"
+                             "Syncs and lists loans and holds for all of them, and downloads all loans with -dla.\n"
+                             "Other commands are ignored.",
+                        nargs="+", metavar="path",
+                        default=os.getenv("MULTI_ID").split(",") if os.getenv("MULTI_ID") else None)
+    parser.add_argument("--rate-limit", help="Maximum HTTP requests per second, shared by all accounts.",
+                        type=float, metavar="n", default=float(os.getenv("RATE_LIMIT", 0)))
+    parser.add_argument("--bandwidth-limit",
+                        help="Maximum download speed for all transfers together in bytes per second, like 500K or 2M.",
+                        type=str, metavar="rate", default=os.getenv("BANDWIDTH_LIMIT", "0"))
+    parser.add_argument("--bandwidth-schedule",
+                        help="Different limits by time of day, like \"08:00-18:00=500K,22:00-06:00=0\".\n"
+                             "0 is unlimited and \"pause\" stops downloading between parts until the window ends.\n"
+                             "Outside the windows --bandwidth-limit is used.",
+                        type=str, metavar="windows", default=os.getenv("BANDWIDTH_SCHEDULE", ""))
     parser.add_argument("-v", "--version", help="Print version.", action="store_true")
     args = parser.parse_args()
     if args.version:
         print(f"PyLibby {VERSION}")
         quit()
 
+    if args.profile or args.profile_output:
+        profiler.start(use_cprofile=bool(args.profile_output))
+    if args.trace_http:
+        http_tracer.enabled = True
+    if args.record:
+        cassette.start_recording(args.record_max_body)
+    elif args.replay:
+        cassette.start_replay(args.replay, args.replay_scale)
+    if args.metrics_port or args.metrics_file:
+        metrics.enabled = True
+        if args.metrics_port:
+            metrics.serve(int(args.metrics_port))
+        if args.metrics_file:
+            metrics.start_file_writer(args.metrics_file)
+
+    def print_report():
+        if profiler.enabled:
+            profiler.stop(args.profile_output)
+            print("Profile:")
+            print(tabulate(profiler.summary(), headers="keys", tablefmt="grid"))
+        if http_tracer.enabled:
+            http_tracer.write(args.trace_http)
+            print("HTTP requests:")
+            print(tabulate(http_tracer.summary(), headers="keys", tablefmt="grid"))
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+            print(f"Wrote metrics to {args.metrics_file}.")
+        if args.record:
+            cassette.write(args.record)
+
+    # Registered with atexit so we also get a report when a run fails halfway.
+    atexit.register(print_report)
+
+    rate_limiter.rate = args.rate_limit
+    bandwidth_limiter.rate = parse_bandwidth(args.bandwidth_limit)
+    bandwidth_limiter.schedule = parse_bandwidth_schedule(args.bandwidth_schedule)
+    request_guard.hedge = args.hedge
+    # Thunder and covers get the same retries as the Libby sessions.
+    adapter_class = HTTP2Adapter if args.http2 else LibbyHTTPAdapter
+    mount_adapter(anonymous_session,
+                  adapter_class(max_retries=CountingRetry(total=args.max_retries, backoff_factor=0.1)))
+
+    if args.retag:
+        counts = retag_library(args.retag, archive_path=args.archive, open_cache_path=args.open_cache,
+                               workers=args.retag_workers)
+        if args.json:
+            print(json.dumps(counts, indent=4))
+        else:
+            print(tabulate([counts], headers="keys", tablefmt="grid"))
+        return
+
+    if args.catalog:
+        counts = build_catalog(args.catalog, archive_path=args.archive, open_cache_path=args.open_cache)
+        if args.json:
+            print(json.dumps(counts, indent=4))
+        else:
+            print(tabulate([counts], headers="keys", tablefmt="grid"))
+        return
+
+    if args.multi_id:
+        reports = run_accounts(args.multi_id, archive_path=args.archive, timeout=args.timeout,
+                               max_retries=args.max_retries, open_cache_path=args.open_cache,
+                               http2=args.http2, part_workers=args.part_workers,
+                               min_free_space=args.min_free_space * 1000 * 1000,
+                               duplicates=args.duplicates,
+                               format_id=args.download_all, output_path=args.output,
+                               should_save_info=args.save_info,
+                               should_get_odm=args.odm,
+                               should_embed_metadata=args.embed_metadata,
+                               format_string=args.output_format_string,
+                               should_replace_space=args.replace_space,
+                               should_create_opf=args.create_opf,
+                               should_merge=args.merge)
+        if args.json:
+            print(json.dumps(reports, indent=4))
+        else:
+            print("Loans:")
+            print(tabulate([lo for r in reports for lo in r["loans"]], headers="keys", tablefmt="grid"))
+            print("Holds:")
+            print(tabulate([h for r in reports for h in r["holds"]], headers="keys", tablefmt="grid"))
+            print("Accounts:")
+            print(tabulate([{k: v for k, v in r.items() if k not in ["loans", "holds"]} for r in reports],
+                           headers="keys", tablefmt="grid"))
+        return
 
     # We should not be logging in here, stuff like -i and -dlo do not require it. This causes slowdown.
     L = Libby(args.id_file, code=args.code, archive_path=args.archive, timeout=args.timeout,
-              max_retries=args.max_retries)
+              max_retries=args.max_retries, open_cache_path=args.open_cache, http2=args.http2,
+              part_workers=args.part_workers, min_free_space=args.min_free_space * 1000 * 1000,
+              duplicates=args.duplicates)
 
     def create_table(media_infos: list, narrators=True):
         table = []
@@ -996,26 +4132,38 @@ def main():
         sys.argv.append(os.getenv("DOWNLOAD_ALL"))
 
     # Doing it this way makes the program more flexible.
+    borrow_ids = [sys.argv[i + 1] for i, a in enumerate(sys.argv[:-1])
+                  if a in ["-b", "--borrow-book", "-ho", "--hold-book"]]
+    prefetched = {}
+    if len(borrow_ids) > 1:
+        # Look them all up at once. Borrowing takes longer than the caches keep availability, so it's passed on.
+        get_media_infos(borrow_ids, timeout=args.timeout)
+        prefetched = L.get_availabilities(borrow_ids)
+
+    def get_prefetched(title_id: str) -> dict:
+        return {library: a[title_id] for library, a in prefetched.items() if title_id in a} or None
+
     # You can do stuff like -ls -b 999 -ls -dl 999 -r 999 -ls
     # or -b 111 -b 222 -b 333.
     # This is not how argparse is usually used.
     arg_pos = 0
     for arg in sys.argv:
         if arg in ["-ls", "--list-loans"]:
-            loans = L.get_loans()
+            s = L.get_sync_state()
+            loans = s.raw["loans"]
             if args.json:
                 print(json.dumps(loans, indent=4))
             else:
-                s = L.get_sync()
                 t = []
                 print("Loans:")
+                media_infos = get_media_infos([lo["id"] for lo in loans], timeout=args.timeout)
                 for lo in loans:
-                    mi = get_media_info(lo["id"], timeout=args.timeout)
+                    mi = media_infos[lo["id"]]
                     t.append({
                         "Id": lo['id'],
                         "Type": lo['type']['id'],
                         "Formats": "\n".join(get_formats(lo)) or "unavailable",
-                        "Library": next((c["advantageKey"] for c in s["cards"] if c["cardId"] == lo["cardId"]), ""),
+                        "Library": s.get_library(lo["cardId"]),
                         "CardId": lo["cardId"],
                         "Authors": "\n".join(get_authors(mi).split(" & ")),
                         "Title": lo['title'],
@@ -1024,19 +4172,20 @@ def main():
                 print(tabulate(t, headers="keys", tablefmt="grid"))
 
         elif arg in ["-lsh", "--list-holds"]:
-            s = L.get_sync()
+            s = L.get_sync_state()
             if args.json:
-                print(json.dumps(s["holds"], indent=4))
+                print(json.dumps(s.raw["holds"], indent=4))
             else:
                 t = []
                 print("Holds:")
-                for h in s["holds"]:
-                    mi = get_media_info(h["id"], timeout=args.timeout)
+                media_infos = get_media_infos([h["id"] for h in s.raw["holds"]], timeout=args.timeout)
+                for h in s.raw["holds"]:
+                    mi = media_infos[h["id"]]
                     t.append({
                         "Id": h['id'],
                         "Type": h['type']['id'],
                         "Formats": "\n".join(get_formats(h)) or "unavailable",
-                        "Library": next((c["advantageKey"] for c in s["cards"] if c["cardId"] == h["cardId"]), ""),
+                        "Library": s.get_library(h["cardId"]),
                         "CardId": h["cardId"],
                         "Authors": "\n".join(get_authors(mi).split(" & ")),
                         "Title": h['title'],
@@ -1048,13 +4197,13 @@ def main():
                 print(tabulate(t, headers="keys", tablefmt="grid"))
 
         elif arg in ["-lsc", "--list-cards"]:
-            s = L.get_sync()
+            s = L.get_sync_state()
             if args.json:
-                print(json.dumps(s["cards"], indent=4))
+                print(json.dumps(s.raw["cards"], indent=4))
             else:
                 t = []
                 print("Cards:")
-                for c in s["cards"]:
+                for c in s.raw["cards"]:
                     t.append({
                         "Id": c['cardId'],
                         "Library": c["advantageKey"]
@@ -1068,22 +4217,19 @@ def main():
                             should_embed_metadata=args.embed_metadata,
                             format_string=args.output_format_string,
                             should_replace_space=args.replace_space,
-                            should_create_opf=args.create_opf)
+                            should_create_opf=args.create_opf,
+                            should_merge=args.merge)
 
         elif arg in ["-dla", "--download-all"]:
             format_to_dl = sys.argv[arg_pos + 1]
             print("Downloading all loans with format", format_to_dl)
-            for loan in L.get_loans():
-                formats = get_formats(loan)
-                if format_to_dl in formats:
-                    L.download_loan(loan, format_to_dl, args.output, args.save_info,
-                                    should_get_odm=args.odm,
-                                    should_embed_metadata=args.embed_metadata,
-                                    format_string=args.output_format_string,
-                                    should_replace_space=args.replace_space,
-                                    should_create_opf=args.create_opf)
-                else:
-                    print(f"Not getting {loan['id']} - {loan['title']}.")
+            L.download_all_loans(format_to_dl, args.output, should_save_info=args.save_info,
+                                 should_get_odm=args.odm,
+                                 should_embed_metadata=args.embed_metadata,
+                                 format_string=args.output_format_string,
+                                 should_replace_space=args.replace_space,
+                                 should_create_opf=args.create_opf,
+                                 should_merge=args.merge)
 
         elif arg in ["-dlo", "--download-opf"]:
             print("Downloading OPF for", sys.argv[arg_pos + 1])
@@ -1104,15 +4250,23 @@ def main():
             print(f"Book returned: {sys.argv[arg_pos + 1]}")
 
         elif arg in ["-b", "--borrow-book"]:
-            r = L.borrow_book_on_any_logged_in_library(sys.argv[arg_pos + 1])
+            r = L.borrow_book_on_any_logged_in_library(sys.argv[arg_pos + 1],
+                                                       availabilities=get_prefetched(sys.argv[arg_pos + 1]))
             if r:
                 print(f"Book borrowed: {sys.argv[arg_pos + 1]}")
 
         elif arg in ["-ho", "--hold-book"]:
-            r = L.hold_book_on_library_with_shortest_wait_time(sys.argv[arg_pos + 1])
+            r = L.hold_book_on_library_with_shortest_wait_time(sys.argv[arg_pos + 1],
+                                                               availabilities=get_prefetched(sys.argv[arg_pos + 1]))
             if r:
                 print(f"Book on hold: {sys.argv[arg_pos + 1]}")
 
+        elif arg in ["--watch"]:
+            loans = L.watch_holds(args.watch, min_interval=args.watch_interval,
+                                  max_interval=max(60 * 60, args.watch_interval))
+            if args.json:
+                print(json.dumps(loans, indent=4))
+
         elif arg in ["-ch", "--cancel-hold"]:
             r = L.cancel_hold(sys.argv[arg_pos + 1])
             print(f"Hold canceled: {sys.argv[arg_pos + 1]}")
@@ -1121,6 +4275,35 @@ def main():
             mi = get_media_info(sys.argv[arg_pos + 1], timeout=args.timeout)
             print(json.dumps(mi, indent=4))
 
+        elif arg in ["--verify"]:
+            bad = L.verify_archive(workers=args.verify_workers)
+            if args.json:
+                print(json.dumps([{"Id": b[0], "File": b[1], "Reason": b[2]} for b in bad], indent=4))
+            elif bad:
+                print("Queued for re-download:")
+                print(tabulate([{"Id": b[0], "File": b[1], "Reason": b[2]} for b in bad], headers="keys",
+                               tablefmt="grid"))
+
+        elif arg in ["--reconcile"]:
+            result = L.reconcile_archive(sys.argv[arg_pos + 1], format_string=args.output_format_string,
+                                         should_replace_space=args.replace_space, workers=args.verify_workers)
+            if args.json:
+                print(json.dumps({"Missing": [{"Id": m[0], "File": m[1], "Reason": m[2]} for m in result["Missing"]],
+                                  "Moved": [{"Id": m[0], "Path": m[1]} for m in result["Moved"]],
+                                  "Orphans": result["Orphans"]}, indent=4))
+            else:
+                if result["Moved"]:
+                    print("Moved:")
+                    print(tabulate([{"Id": m[0], "Path": m[1]} for m in result["Moved"]], headers="keys",
+                                   tablefmt="grid"))
+                if result["Missing"]:
+                    print("Queued for re-download:")
+                    print(tabulate([{"Id": m[0], "File": m[1], "Reason": m[2]} for m in result["Missing"]],
+                                   headers="keys", tablefmt="grid"))
+                if result["Orphans"]:
+                    print("Not in the archive, can be removed:")
+                    print("\n".join(result["Orphans"]))
+
         elif arg in ["-s", "--search"]:
             hits = L.search_for_book_in_logged_in_libraries(sys.argv[arg_pos + 1])
             if args.json:
@@ -1147,6 +4330,8 @@ def main():
 
         arg_pos += 1
 
+    L.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
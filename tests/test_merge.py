@@ -0,0 +1,109 @@
+# Copyright (C) 2022 Raymond Olsen
+#
+# This file is part of PyLibby.
+#
+# PyLibby is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyLibby is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyLibby. If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for --merge on synthetic constant bitrate parts, run with: python -m pytest tests
+
+import os
+import struct
+import sys
+
+import pytest
+from mutagen.id3 import ID3
+from mutagen.mp3 import MP3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pylibby  # noqa: E402
+
+# MPEG1 Layer III, no CRC, 128 kbit/s, 44100 Hz, stereo. Every frame is 144 * 128000 / 44100 = 417 bytes.
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0x00])
+FRAME_LENGTH = 417
+SAMPLES = 1152
+SAMPLE_RATE = 44100
+
+
+def write_part(path: str, frames: int, id3_size: int = 0, id3v1: bool = False):
+    with open(path, "wb") as w:
+        if id3_size:
+            # ID3v2 header with the size as 4 bytes of 7 bits, followed by that many bytes of padding.
+            w.write(b"ID3\x03\x00\x00" + bytes([(id3_size >> s) & 0x7F for s in (21, 14, 7, 0)]) + bytes(id3_size))
+        for _ in range(frames):
+            w.write(FRAME_HEADER + bytes(FRAME_LENGTH - 4))
+        if id3v1:
+            w.write(b"TAG" + bytes(125))
+
+
+@pytest.fixture
+def parts(tmp_path):
+    first, second = str(tmp_path / "Part01.mp3"), str(tmp_path / "Part02.mp3")
+    write_part(first, 10, id3_size=100)
+    write_part(second, 5, id3v1=True)
+    return [first, second]
+
+
+def test_scan_mp3_skips_tags(parts):
+    first, second = [pylibby.scan_mp3(p) for p in parts]
+    assert (first["Start"], first["End"], first["Frames"]) == (110, 110 + 10 * FRAME_LENGTH, 10)
+    assert (second["Start"], second["End"], second["Frames"]) == (0, 5 * FRAME_LENGTH, 5)
+    assert (first["Samples"], first["SampleRate"], first["Bitrates"]) == (SAMPLES, SAMPLE_RATE, {9})
+
+
+def test_create_xing_frame(parts):
+    scans = [pylibby.scan_mp3(p) for p in parts]
+    frame = pylibby.create_xing_frame(scans)
+    frame_length = pylibby.parse_mp3_frame_header(frame[:4])[0]
+    assert len(frame) == frame_length
+    offset = pylibby.get_xing_offset(frame[:4])
+    # Constant bitrate, so Info rather than Xing.
+    assert frame[offset:offset + 4] == b"Info"
+    flags, frames, size = struct.unpack(">III", frame[offset + 4:offset + 16])
+    assert (flags, frames, size) == (7, 15, frame_length + 15 * FRAME_LENGTH)
+    toc = frame[offset + 16:offset + 116]
+    assert toc[0] == frame_length * 256 // size
+    assert list(toc) == sorted(toc)
+
+
+def test_merge_mp3_files(parts, tmp_path):
+    scans = [pylibby.scan_mp3(p) for p in parts]
+    durations = [s["Frames"] * s["Samples"] / s["SampleRate"] for s in scans]
+    audiobook_info = {"openbook": {"nav": {"toc": [{"title": "One", "path": "Part01.mp3"},
+                                                   {"title": "Two", "path": "Part02.mp3#0.1"}]}}}
+    chapters = pylibby.get_merged_chapters(audiobook_info, ["Part01.mp3", "Part02.mp3"], durations)
+    assert chapters == [("One", 0), ("Two", pytest.approx(durations[0] + 0.1))]
+
+    tag = ID3()
+    pylibby.add_chapter_tags(tag, chapters, sum(durations))
+    merged_path = str(tmp_path / "Book.mp3")
+    pylibby.merge_mp3_files(parts, merged_path, tag, scans)
+    assert not os.path.exists(merged_path + ".part")
+
+    merged = pylibby.scan_mp3(merged_path)
+    assert merged["Frames"] == 15
+    assert merged["End"] - merged["Start"] == 15 * FRAME_LENGTH
+    assert MP3(merged_path).info.length == pytest.approx(15 * SAMPLES / SAMPLE_RATE, abs=0.001)
+    chaps = sorted(ID3(merged_path).getall("CHAP"), key=lambda c: c.start_time)
+    assert [(c.start_time, c.end_time) for c in chaps] == [(0, int((durations[0] + 0.1) * 1000)),
+                                                           (int((durations[0] + 0.1) * 1000),
+                                                            int(sum(durations) * 1000))]
+
+
+def test_merge_mp3_files_cleans_up(parts, tmp_path):
+    scans = [pylibby.scan_mp3(p) for p in parts]
+    os.remove(parts[1])
+    merged_path = str(tmp_path / "Book.mp3")
+    with pytest.raises(OSError):
+        pylibby.merge_mp3_files(parts, merged_path, ID3(), scans)
+    assert not os.path.exists(merged_path) and not os.path.exists(merged_path + ".part")